@@ -9,8 +9,10 @@
 #
 # WARNING! All changes made in this file will be lost!
 
-from PyQt4.QtGui import *
-from PyQt4.QtCore import *
+from PyQt4.QtGui import (QAction, QApplication, QDialog, QDialogButtonBox, QErrorMessage, QFileDialog, QGridLayout,
+    QHBoxLayout, QIcon, QLabel, QLineEdit, QMainWindow, QMenu, QMessageBox, QPixmap, QProgressBar, QPushButton,
+    QSizePolicy, QStatusBar, QTabWidget, QToolBar, QTreeWidget, QVBoxLayout, QWidget)
+from PyQt4.QtCore import QMetaObject, QObject, QRect, QSize, QString, Qt, SIGNAL
 import os, types, sys
 import controller
 
@@ -267,6 +269,11 @@ class Ui_MainWindow(object):
         self.statusbar.setSizeGripEnabled(True)
         self.statusbar.setObjectName(_fromUtf8("statusbar"))
         MainWindow.setStatusBar(self.statusbar)
+        # shown while the trees are read in the background
+        self.progressBar = QProgressBar(self.statusbar)
+        self.progressBar.setMaximumWidth(200)
+        self.progressBar.hide()
+        self.statusbar.addPermanentWidget(self.progressBar)
         
         # Tool Bar
         self.toolbar = QToolBar(MainWindow)
@@ -468,6 +475,7 @@ class Ui_MainWindow(object):
         QObject.connect(self.localFilesTreeWidget, SIGNAL("customContextMenuRequested(QPoint)"), self.localFilesContextMenu)
         QObject.connect(self.projectFilesTreeWidget, SIGNAL("itemSelectionChanged()"), self.projectItemSelectionChanged)
         QObject.connect(self.projectFilesTreeWidget, SIGNAL("customContextMenuRequested(QPoint)"), self.projectFilesContextMenu)
+        QObject.connect(self.projectFilesTreeWidget, SIGNAL("itemExpanded(QTreeWidgetItem*)"), self.projectItemExpanded)
     
     def refresh(self):
     	controller.refreshTree(self)
@@ -517,6 +525,9 @@ class Ui_MainWindow(object):
     def projectFilesContextMenu(self, point):
         controller.projectFilesContextMenu(self, point)
     
+    def projectItemExpanded(self, item):
+        controller.projectItemExpanded(self, item)
+    
     def getTreeItemPath(self, treeItem, path):
         if not type(treeItem.parent()) == types.NoneType:
             path = self.getTreeItemPath(treeItem.parent(), path)
@@ -535,7 +546,6 @@ class Ui_MainWindow(object):
 
 
 if __name__ == "__main__":
-    import sys
     app = QApplication(sys.argv)
     MainWindow = QMainWindow()
     ui = Ui_MainWindow()
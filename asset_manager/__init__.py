@@ -1,6 +1,25 @@
 __all__ = (
     "utilities.py",
+    "nodeinfo.py",
+    "commentlog.py",
+    "assetindex.py",
+    "scanner.py",
+    "walker.py",
+    "fileclone.py",
+    "copyengine.py",
+    "blobstore.py",
+    "trash.py",
+    "archive.py",
+    "journal.py",
+    "versioncache.py",
+    "lockfile.py",
+    "metadaemon.py",
+    "checkinjobs.py",
+    "relic.py",
+    "benchmarks.py",
+    "importtime.py",
     "controller.py",
+    "treeworkers.py",
     "installHoudiniFile.py",
     "installMayaFile.py",
 )
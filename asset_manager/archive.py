@@ -0,0 +1,176 @@
+"""
+This module contains the archive of cold versions of a versioned folder.
+
+When a checkin pushes a version out of the versions to keep, purgeVersions() in
+utilities (run by the checkin job, or "relic.py purge") packs it into
+a compressed tar (<versioned folder>/archive/vNNN.tar.zst with the optional
+zstandard package, vNNN.tar.gz otherwise) instead of deleting it, so it can still
+be rolled back to. The tar is streamed straight into the compressor and written
+through a temporary file and rename. rehydrate() unpacks an archived version into
+src/vNNN again, storing its files in the blob store like a checkin.
+
+Archives are kept for the last RELIC_ARCHIVE_KEEP versions (50 by default,
+0 keeps them all); older ones are deleted. RELIC_ARCHIVE_COMPRESSION picks
+'zstd' or 'gzip' (zstd if it is installed).
+"""
+
+import os, re, errno, shutil, socket, tarfile, tempfile
+
+import blobstore, walker, trash
+from nodeinfo import versionName
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+ARCHIVE_DIR = 'archive'
+EXTENSIONS = {'zstd': '.tar.zst', 'gzip': '.tar.gz'}
+
+_ARCHIVE_PATTERN = re.compile(r'v([0-9]+)\.tar\.(gz|zst)$')
+
+def getCompression():
+	compression = os.environ.get('RELIC_ARCHIVE_COMPRESSION')
+	if compression is None:
+		return 'zstd' if zstandard is not None else 'gzip'
+	if compression not in EXTENSIONS:
+		raise Exception("Unknown archive compression " + compression + ", expected one of " + ', '.join(EXTENSIONS))
+	if compression == 'zstd' and zstandard is None:
+		raise Exception("zstd archives need the zstandard package")
+	return compression
+
+def getArchiveKeep():
+	"""@returns: the number of most recent versions whose archives are kept, 0 for all"""
+	return int(os.environ.get('RELIC_ARCHIVE_KEEP', 50))
+
+def getArchiveDir(dirPath):
+	return os.path.join(dirPath, ARCHIVE_DIR)
+
+def archivedVersions(dirPath):
+	"""@returns: (version number, archive path) of each archived version of the versioned folder dirPath, sorted"""
+	listing = walker.listDir(getArchiveDir(dirPath))
+	if listing is None:
+		return []
+	versions = []
+	for e in listing.entries:
+		m = _ARCHIVE_PATTERN.match(e.name)
+		if m:
+			versions.append((int(m.group(1)), e.path))
+	versions.sort()
+	return versions
+
+def findArchive(dirPath, version):
+	"""@returns: the archive of version, or None if it is not archived"""
+	for v, archivePath in archivedVersions(dirPath):
+		if v == int(version):
+			return archivePath
+	return None
+
+def _openWriter(f, compression):
+	"""@returns: (tarfile writing to f, the compressor stream to close after it or None)"""
+	if compression == 'zstd':
+		stream = zstandard.ZstdCompressor().stream_writer(f)
+		return tarfile.open(fileobj=stream, mode='w|'), stream
+	return tarfile.open(fileobj=f, mode='w|gz'), None
+
+def _openReader(archivePath, f):
+	if archivePath.endswith(EXTENSIONS['zstd']):
+		if zstandard is None:
+			raise Exception(archivePath + " needs the zstandard package")
+		return tarfile.open(fileobj=zstandard.ZstdDecompressor().stream_reader(f), mode='r|')
+	return tarfile.open(fileobj=f, mode='r|gz')
+
+def archiveVersion(dirPath, versionDir):
+	"""
+	Packs the version folder versionDir of the versioned folder dirPath into its archive
+	(unless it is already archived) and moves versionDir to the trash.
+	@returns: the archive path
+	"""
+	version = int(os.path.basename(versionDir)[1:])
+	archivePath = findArchive(dirPath, version)
+	if archivePath is None:
+		compression = getCompression()
+		archiveDir = getArchiveDir(dirPath)
+		try:
+			os.makedirs(archiveDir)
+		except OSError as e:
+			if e.errno != errno.EEXIST:
+				raise
+		archivePath = os.path.join(archiveDir, versionName(version) + EXTENSIONS[compression])
+		tmpPath = os.path.join(archiveDir, '.%s.tmp.%s.%d' % (os.path.basename(archivePath), socket.gethostname(), os.getpid()))
+		f = open(tmpPath, 'wb')
+		try:
+			try:
+				tar, stream = _openWriter(f, compression)
+				tar.add(versionDir, arcname=versionName(version))
+				tar.close()
+				if stream is not None:
+					stream.close()
+			finally:
+				f.close()
+			os.rename(tmpPath, archivePath)
+		except:
+			if os.path.exists(tmpPath):
+				os.remove(tmpPath)
+			raise
+	trash.moveToTrash(versionDir)
+	return archivePath
+
+def rehydrate(dirPath, version):
+	"""
+	Unpacks the archived version into dirPath/src/vNNN, unless it is already there.
+	The version is stored into a hidden staging folder in src/ and published with a single
+	rename, like a checkin: src/vNNN is never seen half written, even if this is interrupted.
+	@returns: the version folder
+	@raises: Exception if the version is neither in src nor archived
+	"""
+	versionDir = os.path.join(dirPath, 'src', versionName(version))
+	if os.path.isdir(versionDir):
+		return versionDir
+	archivePath = findArchive(dirPath, version)
+	if archivePath is None:
+		raise Exception(versionName(version) + " is not archived")
+	staging = tempfile.mkdtemp(prefix='.rehydrate.', dir=os.path.join(dirPath, 'src'))
+	try:
+		f = open(archivePath, 'rb')
+		try:
+			tar = _openReader(archivePath, f)
+			tar.extractall(staging)
+			tar.close()
+		finally:
+			f.close()
+		unpacked = os.path.join(staging, versionName(version))
+		manifest = blobstore.readManifest(unpacked)
+		if manifest is not None:
+			# the blob links were read-only; give the files back what they were checked in with
+			for relPath, entry in manifest['files'].items():
+				os.chmod(os.path.join(unpacked, relPath), entry['mode'])
+				os.utime(os.path.join(unpacked, relPath), (entry['mtime'], entry['mtime']))
+		stored = os.path.join(staging, 'stored')
+		blobstore.storeTree(unpacked, stored)
+		try:
+			os.rename(stored, versionDir)
+		except OSError as e:
+			if e.errno in (errno.EEXIST, errno.ENOTEMPTY) and os.path.isdir(versionDir):
+				# rehydrated by someone else meanwhile; the blobs stored here are shared or collected
+				return versionDir
+			raise
+	finally:
+		shutil.rmtree(staging, ignore_errors=True)
+	return versionDir
+
+def expire(dirPath, latestVersion, keep=None):
+	"""
+	Deletes the archives of versions older than the last keep versions.
+	@returns: the versions whose archives were deleted
+	"""
+	if keep is None:
+		keep = getArchiveKeep()
+	if keep <= 0:
+		return []
+	expired = []
+	for version, archivePath in archivedVersions(dirPath):
+		if version <= latestVersion - keep:
+			os.remove(archivePath)
+			expired.append(version)
+	return expired
@@ -0,0 +1,214 @@
+"""
+This module contains a workstation-local SQLite index of the versioned folders in
+the production tree, so the user interfaces can list assets without walking the
+file server.
+
+The index only caches what is stored in each folder's .nodeInfo file.
+The asset operations in utilities keep it up to date; rebuild() re-walks a root.
+"""
+
+import os, time, threading, sqlite3
+from collections import namedtuple
+
+import nodeinfo, commentlog, walker
+
+IndexEntry = namedtuple('IndexEntry', ['path', 'parent', 'name', 'versioned', 'latestVersion',
+	'lockedBy', 'lastCheckinUser', 'lastCheckinTime', 'latestComment', 'installed', 'installPath'])
+
+_COLUMNS = 'path, parent, name, versioned, latest_version, locked_by, last_checkin_user, last_checkin_time, latest_comment, installed, install_path'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS folders (
+	path TEXT PRIMARY KEY,
+	parent TEXT,
+	name TEXT,
+	versioned INTEGER NOT NULL DEFAULT 0,
+	latest_version INTEGER,
+	locked_by TEXT,
+	last_checkin_user TEXT,
+	last_checkin_time TEXT,
+	latest_comment TEXT,
+	installed INTEGER,
+	install_path TEXT,
+	updated REAL
+);
+CREATE INDEX IF NOT EXISTS folders_parent ON folders (parent);
+CREATE TABLE IF NOT EXISTS roots (
+	path TEXT PRIMARY KEY,
+	indexed REAL
+);
+"""
+
+def getDefaultIndexPath():
+	if 'RELIC_INDEX_DB' in os.environ:
+		return os.environ['RELIC_INDEX_DB']
+	project = os.environ.get('PROJECT_NAME', 'relic')
+	return os.path.join(os.path.expanduser('~'), '.relic', project + '-index.db')
+
+def _normpath(path):
+	return os.path.normpath(os.path.abspath(str(path)))
+
+def _descendantRange(path):
+	"""Returns the (low, high) bounds of the paths below path, for an indexed range query"""
+	return (path + os.sep, path + chr(ord(os.sep) + 1))
+
+def _getInstall(dirPath):
+	installed = walker.stableInstalls(dirPath)
+	if installed:
+		return True, installed[0]
+	return False, ''
+
+class AssetIndex(object):
+	def __init__(self, dbPath=None):
+		if dbPath is None:
+			dbPath = getDefaultIndexPath()
+		self.dbPath = dbPath
+		self._local = threading.local()
+		dbDir = os.path.dirname(dbPath)
+		if dbDir and not os.path.isdir(dbDir):
+			os.makedirs(dbDir)
+		self._connection().executescript(_SCHEMA)
+
+	def _connection(self):
+		# sqlite connections can not be shared between threads
+		conn = getattr(self._local, 'conn', None)
+		if conn is None:
+			conn = sqlite3.connect(self.dbPath, timeout=30)
+			conn.text_factory = str
+			self._local.conn = conn
+		return conn
+
+	def _rootFor(self, path):
+		"""Returns the longest indexed root containing path, or None"""
+		best = None
+		for (root,) in self._connection().execute('SELECT path FROM roots'):
+			if (path == root or path.startswith(root + os.sep)) and (best is None or len(root) > len(best)):
+				best = root
+		return best
+
+	def _folderRow(self, path, nodeInfo):
+		if nodeInfo is None:
+			return (path, os.path.dirname(path), os.path.basename(path), 0,
+				None, None, None, None, None, None, None, time.time())
+		installed, installPath = _getInstall(path)
+		lockedBy = nodeInfo.lastCheckoutUser if nodeInfo.locked else ''
+		return (path, os.path.dirname(path), os.path.basename(path), 1,
+			nodeInfo.latestVersion, lockedBy, nodeInfo.lastCheckinUser, nodeInfo.lastCheckinTime,
+			commentlog.latestComment(nodeInfo), int(installed), installPath, time.time())
+
+	def _write(self, conn, rows):
+		conn.executemany('INSERT OR REPLACE INTO folders (' + _COLUMNS + ', updated) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)', rows)
+
+	def update(self, dirPath, nodeInfo=None):
+		"""
+		Records the current state of the versioned folder dirPath.
+		@param nodeInfo: the NodeInfo just committed for dirPath; read from disk if not given
+		"""
+		path = _normpath(dirPath)
+		if nodeInfo is None:
+			nodeInfo = nodeinfo.NodeInfo.load(path)
+		conn = self._connection()
+		with conn:
+			self._write(conn, [self._folderRow(path, nodeInfo)])
+			# make sure the folder can be reached from its root
+			root = self._rootFor(path)
+			parent = os.path.dirname(path)
+			while root is not None and len(parent) >= len(root):
+				conn.execute('INSERT OR IGNORE INTO folders (path, parent, name, versioned, updated) VALUES (?,?,?,0,?)',
+					(parent, os.path.dirname(parent), os.path.basename(parent), time.time()))
+				parent = os.path.dirname(parent)
+
+	def remove(self, dirPath):
+		"""Removes dirPath and everything below it from the index"""
+		path = _normpath(dirPath)
+		low, high = _descendantRange(path)
+		conn = self._connection()
+		with conn:
+			conn.execute('DELETE FROM folders WHERE path = ? OR (path >= ? AND path < ?)', (path, low, high))
+
+	def isIndexed(self, root):
+		"""@returns: True if root or one of its parents has been indexed by rebuild()"""
+		return self._rootFor(_normpath(root)) is not None
+
+	def addFolder(self, dirPath):
+		"""Records dirPath as a plain (not versioned) project folder"""
+		conn = self._connection()
+		with conn:
+			self._write(conn, [self._folderRow(_normpath(dirPath), None)])
+
+	def rebuild(self, root, folders=None):
+		"""
+		Replaces everything indexed below root.
+		@param folders: (path, NodeInfo or None) pairs for every folder below root.
+			If not given, root is walked; directories are not descended past versioned
+			folders, and hidden directories are skipped.
+		@returns: the number of versioned folders indexed
+		"""
+		root = _normpath(root)
+		if folders is None:
+			folders = _walk(root)
+		rows = [self._folderRow(root, None)]
+		count = 0
+		for dirPath, nodeInfo in folders:
+			dirPath = _normpath(dirPath)
+			if dirPath == root:
+				continue
+			rows.append(self._folderRow(dirPath, nodeInfo))
+			if nodeInfo is not None:
+				count += 1
+		low, high = _descendantRange(root)
+		conn = self._connection()
+		with conn:
+			conn.execute('DELETE FROM folders WHERE path = ? OR (path >= ? AND path < ?)', (root, low, high))
+			self._write(conn, rows)
+			conn.execute('INSERT OR REPLACE INTO roots (path, indexed) VALUES (?, ?)', (root, time.time()))
+		return count
+
+	def get(self, dirPath):
+		row = self._connection().execute('SELECT ' + _COLUMNS + ' FROM folders WHERE path = ?', (_normpath(dirPath),)).fetchone()
+		if row is None:
+			return None
+		return _entry(row)
+
+	def children(self, dirPath):
+		"""Returns the entries directly below dirPath, sorted by name"""
+		rows = self._connection().execute('SELECT ' + _COLUMNS + ' FROM folders WHERE parent = ? ORDER BY name', (_normpath(dirPath),))
+		return [_entry(row) for row in rows]
+
+	def descendants(self, dirPath, versionedOnly=False):
+		"""Returns all entries below dirPath, parents before children"""
+		low, high = _descendantRange(_normpath(dirPath))
+		query = 'SELECT ' + _COLUMNS + ' FROM folders WHERE path >= ? AND path < ?'
+		if versionedOnly:
+			query += ' AND versioned = 1'
+		rows = self._connection().execute(query + ' ORDER BY path', (low, high))
+		return [_entry(row) for row in rows]
+
+def _walk(root):
+	for listing in walker.walk(root):
+		if listing.isVersioned():
+			try:
+				yield listing.path, nodeinfo.NodeInfo.load(listing.path)
+			except Exception as e:
+				print "asset index: skipping " + listing.path + ": " + str(e)
+		else:
+			yield listing.path, None
+
+def _entry(row):
+	row = list(row)
+	row[3] = bool(row[3])
+	if row[9] is not None:
+		row[9] = bool(row[9])
+	return IndexEntry(*row)
+
+_indexes = {}
+_indexesLock = threading.Lock()
+
+def getIndex(dbPath=None):
+	"""Returns the shared AssetIndex for dbPath (the default index if not given)"""
+	if dbPath is None:
+		dbPath = getDefaultIndexPath()
+	with _indexesLock:
+		if dbPath not in _indexes:
+			_indexes[dbPath] = AssetIndex(dbPath)
+		return _indexes[dbPath]
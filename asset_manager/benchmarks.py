@@ -0,0 +1,446 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks for the asset manager's file system and metadata paths.
+Each benchmark builds its own synthetic data in a temporary directory.
+
+usage: python benchmarks.py [<benchmark> ...]   (runs all benchmarks if none are named)
+"""
+
+import os, sys, time, shutil, tempfile
+from ConfigParser import ConfigParser
+
+import nodeinfo
+from nodeinfo import NodeInfo, versionName
+
+def _timeit(func, repeat):
+	start = time.time()
+	for i in xrange(repeat):
+		func()
+	return (time.time() - start) / repeat
+
+def _report(name, seconds, baseline=None):
+	line = '  %-40s %10.1f us' % (name, seconds * 1e6)
+	if baseline:
+		line += '   (%.1fx)' % (baseline / seconds)
+	print line
+
+def _sampleNodeInfo(dirPath, comments=5):
+	ni = NodeInfo(dirPath, 'artist', 5)
+	ni.latestVersion = comments
+	for v in range(comments + 1):
+		ni.comments[versionName(v)] = ('artist: Mon, 01 Jan 2024 01:00:00 PM: "comment for version %d"' % v)
+	return ni
+
+def benchNodeInfo(repeat=2000):
+	"""Parsing and writing .nodeInfo: legacy ConfigParser vs JSON"""
+	tmp = tempfile.mkdtemp()
+	try:
+		iniDir = os.path.join(tmp, 'ini')
+		jsonDir = os.path.join(tmp, 'json')
+		os.mkdir(iniDir)
+		os.mkdir(jsonDir)
+		_sampleNodeInfo(iniDir).commit('ini')
+		_sampleNodeInfo(jsonDir).commit('json')
+		iniPath = os.path.join(iniDir, nodeinfo.NODE_INFO)
+		jsonPath = os.path.join(jsonDir, nodeinfo.NODE_INFO)
+
+		def legacyRead():
+			# what every utilities function did before: a fresh ConfigParser per call
+			cp = ConfigParser()
+			cp.read(iniPath)
+			cp.getboolean('Versioning', 'locked')
+			cp.get('Versioning', 'lastcheckinuser')
+			cp.get('Comments', 'v%03d' % cp.getint('Versioning', 'latestversion'))
+		def iniRead():
+			f = open(iniPath, 'rb')
+			data = f.read()
+			f.close()
+			ni = NodeInfo.fromConfig(iniDir, nodeinfo.parseDocument(data))
+			ni.comments[versionName(ni.latestVersion)]
+		def jsonRead():
+			f = open(jsonPath, 'rb')
+			data = f.read()
+			f.close()
+			ni = NodeInfo.fromDict(jsonDir, nodeinfo.parseDocument(data))
+			ni.comments[versionName(ni.latestVersion)]
+		def cachedRead():
+			ni = NodeInfo.load(jsonDir)
+			ni.comments[versionName(ni.latestVersion)]
+
+		print 'nodeinfo: read + parse (%d iterations)' % repeat
+		baseline = _timeit(legacyRead, repeat)
+		_report('ConfigParser.read (legacy)', baseline)
+		_report('legacy INI through NodeInfo', _timeit(iniRead, repeat), baseline)
+		_report('JSON through NodeInfo', _timeit(jsonRead, repeat), baseline)
+		_report('JSON through the stat cache', _timeit(cachedRead, repeat), baseline)
+
+		ni = NodeInfo.load(jsonDir)
+		def legacyWrite():
+			f = open(iniPath, 'wb')
+			ni.toConfig().write(f)
+			f.close()
+		print 'nodeinfo: write (%d iterations)' % (repeat / 10)
+		baseline = _timeit(legacyWrite, repeat / 10)
+		_report('in-place ConfigParser.write (legacy)', baseline)
+		_report('atomic JSON (tmp + fsync + rename)', _timeit(lambda: ni.commit('json'), repeat / 10), baseline)
+	finally:
+		shutil.rmtree(tmp)
+
+def benchFolderInfo(folders=200, repeat=5):
+	"""Reading the project tree columns: one folder at a time vs getVersionedFolderInfoMany"""
+	import utilities
+	tmp = tempfile.mkdtemp()
+	try:
+		paths = []
+		for i in range(folders):
+			dirPath = os.path.join(tmp, 'asset%03d' % i)
+			os.makedirs(os.path.join(dirPath, 'stable'))
+			_sampleNodeInfo(dirPath).commit()
+			paths.append(dirPath)
+
+		def serial():
+			nodeinfo.getCache().clear()
+			for dirPath in paths:
+				utilities.getVersionedFolderInfo(dirPath)
+		def bulk():
+			nodeinfo.getCache().clear()
+			utilities.getVersionedFolderInfoMany(paths)
+
+		print 'folderinfo: %d folders, cold cache (%d iterations)' % (folders, repeat)
+		baseline = _timeit(serial, repeat)
+		_report('getVersionedFolderInfo per folder', baseline)
+		_report('getVersionedFolderInfoMany (%d threads)' % utilities.INFO_THREADS, _timeit(bulk, repeat), baseline)
+	finally:
+		shutil.rmtree(tmp)
+
+class _SyscallCounter(object):
+	"""Counts the directory listings and stats made while it is active, by wrapping the os functions"""
+	NAMES = ('listdir', 'stat', 'lstat')
+
+	def __init__(self):
+		self.counts = {}
+
+	def __enter__(self):
+		import walker
+		self._saved = [(os, name, getattr(os, name)) for name in self.NAMES]
+		if walker.hasScandir():
+			self._saved.append((walker, '_scandir', walker._scandir))
+		for module, name, func in self._saved:
+			setattr(module, name, self._wrap(name.lstrip('_'), func))
+		return self
+
+	def __exit__(self, *exc):
+		for module, name, func in self._saved:
+			setattr(module, name, func)
+
+	def _wrap(self, name, func):
+		def counted(*args, **kwargs):
+			self.counts[name] = self.counts.get(name, 0) + 1
+			return func(*args, **kwargs)
+		return counted
+
+	def total(self):
+		return sum(self.counts.values())
+
+	def __str__(self):
+		return ', '.join('%s %d' % item for item in sorted(self.counts.items()))
+
+def _syntheticProject(root, assets=50, versions=5, files=3):
+	for a in range(assets):
+		for part in ('model', 'rig'):
+			dirPath = os.path.join(root, 'assets', 'asset%02d' % a, part)
+			for v in range(versions):
+				versionDir = os.path.join(dirPath, 'src', versionName(v))
+				os.makedirs(versionDir)
+				for f in range(files):
+					open(os.path.join(versionDir, 'file%d.mb' % f), 'w').close()
+			os.makedirs(os.path.join(dirPath, 'stable'))
+			open(os.path.join(dirPath, 'stable', 'asset%02d_%s_stable.mb' % (a, part)), 'w').close()
+			_sampleNodeInfo(dirPath).commit()
+
+def benchWalker():
+	"""Syscalls made listing the project: glob and os.walk with exists/isdir probes vs the shared walker"""
+	import glob, re, walker
+	tmp = tempfile.mkdtemp()
+	try:
+		_syntheticProject(tmp)
+		versioned = sorted(os.path.dirname(p) for p in glob.glob(os.path.join(tmp, 'assets', '*', '*', 'src')))
+
+		def legacyWalk():
+			# the asset index walk before the walker
+			for dirPath, dirNames, fileNames in os.walk(tmp):
+				dirNames[:] = [d for d in dirNames if not d.startswith('.')]
+				if nodeinfo.NODE_INFO in fileNames:
+					dirNames[:] = []
+		def walkerWalk():
+			for listing in walker.walk(tmp):
+				listing.isVersioned()
+		def legacyVersions():
+			# set_version/purge: glob then an isdir probe per entry
+			for dirPath in versioned:
+				for f in glob.glob(os.path.join(dirPath, 'src', '*')):
+					if os.path.isdir(f) and re.match('v[0-9]+', os.path.basename(f)):
+						pass
+		def walkerVersions():
+			for dirPath in versioned:
+				walker.versionFolders(os.path.join(dirPath, 'src'))
+		def legacyInstalled():
+			for dirPath in versioned:
+				glob.glob(os.path.join(dirPath, 'stable', '*stable*'))
+		def walkerInstalled():
+			for dirPath in versioned:
+				walker.stableInstalls(dirPath)
+
+		print 'walker: syscalls for %d versioned folders (scandir %s)' % (len(versioned), 'available' if walker.hasScandir() else 'not available, listdir fallback')
+		for name, legacy, new in [('project walk', legacyWalk, walkerWalk),
+				('version folders', legacyVersions, walkerVersions),
+				('stable installs', legacyInstalled, walkerInstalled)]:
+			with _SyscallCounter() as before:
+				legacy()
+			with _SyscallCounter() as after:
+				new()
+			print '  %-18s legacy %6d (%s)' % (name, before.total(), before)
+			print '  %-18s walker %6d (%s)' % ('', after.total(), after)
+	finally:
+		shutil.rmtree(tmp)
+
+def benchCheckout(files=40, size=2 << 20):
+	"""Checkout of a version folder: plain copy vs each fileclone mode"""
+	import fileclone
+	tmp = tempfile.mkdtemp()
+	try:
+		src = os.path.join(tmp, 'v000')
+		os.makedirs(os.path.join(src, 'textures'))
+		block = os.urandom(1 << 20)
+		for i in range(files):
+			f = open(os.path.join(src, 'textures', 'tex%02d.exr' % i), 'wb')
+			for j in range(size >> 20):
+				f.write(block)
+			f.close()
+		f = open(os.path.join(src, 'scene.mb'), 'wb')
+		f.write(block)
+		f.close()
+
+		print 'checkout: %d files, %d MB (1 iteration each)' % (files + 1, (files * size + len(block)) >> 20)
+		dst = os.path.join(tmp, 'checkout')
+		start = time.time()
+		shutil.copytree(src, dst)
+		baseline = time.time() - start
+		shutil.rmtree(dst)
+		_report('shutil.copytree (legacy)', baseline)
+		for mode in fileclone.MODES:
+			start = time.time()
+			# as for a checkout that does not lock, which is the only kind that is hard linked
+			fileclone.cloneTree(src, dst, mode, writable=False)
+			used = mode if mode != 'reflink' else fileclone.detectedMode(src, tmp)
+			_report('%s (used %s)' % (mode, used), time.time() - start, baseline)
+			shutil.rmtree(dst)
+	finally:
+		shutil.rmtree(tmp)
+
+def _writeFiles(dirPath, count, size):
+	os.makedirs(dirPath)
+	data = os.urandom(size)
+	for i in range(count):
+		f = open(os.path.join(dirPath, 'file%04d' % i), 'wb')
+		f.write(data)
+		f.close()
+
+def benchCopy():
+	"""Copying trees: shutil.copytree vs the parallel copy engine"""
+	import copyengine
+	tmp = tempfile.mkdtemp()
+	try:
+		print 'copy: kernel copy calls: %s, %d threads' % (', '.join(copyengine.getCopyMethods()) or 'none',
+			copyengine.COPY_THREADS)
+		for name, count, size in [('many small files', 2000, 4 << 10), ('few large files', 8, 16 << 20)]:
+			src = os.path.join(tmp, 'src')
+			_writeFiles(os.path.join(src, 'a'), count / 2, size)
+			_writeFiles(os.path.join(src, 'b'), count - count / 2, size)
+			dst = os.path.join(tmp, 'dst')
+			print '  %s: %d x %d KB' % (name, count, size >> 10)
+			start = time.time()
+			shutil.copytree(src, dst)
+			baseline = time.time() - start
+			shutil.rmtree(dst)
+			_report('shutil.copytree (legacy)', baseline)
+			stats = copyengine.copyTree(src, dst)
+			_report('copyengine.copyTree', stats.seconds, baseline)
+			print '    ' + stats.summary()
+			shutil.rmtree(dst)
+			shutil.rmtree(src)
+	finally:
+		shutil.rmtree(tmp)
+
+def _holdLock(dirPath, hold):
+	"""The critical section: @returns: False if somebody else is in it too"""
+	marker = os.path.join(dirPath, 'holder')
+	try:
+		fd = os.open(marker, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+	except OSError:
+		return False
+	os.close(fd)
+	time.sleep(hold)
+	os.remove(marker)
+	return True
+
+def _lockWorker(args):
+	"""Acquires and releases the lock of dirPath for seconds. @returns: (grants, double grants)"""
+	import lockfile
+	dirPath, protocol, seconds, hold = args
+	grants = doubles = 0
+	deadline = time.time() + seconds
+	while time.time() < deadline:
+		if protocol == 'lockfile':
+			token = lockfile.acquire(dirPath, 'bench')
+			if token is None:
+				continue
+			grants += 1
+			if not _holdLock(dirPath, hold):
+				doubles += 1
+			lockfile.release(dirPath, token=token)
+		else:
+			# the legacy protocol: read the flag, copy, then write the flag
+			ni = NodeInfo.load(dirPath)
+			if ni.locked:
+				continue
+			time.sleep(hold)
+			ni.locked = True
+			ni.commit()
+			grants += 1
+			if not _holdLock(dirPath, hold):
+				doubles += 1
+			ni = NodeInfo.load(dirPath)
+			ni.locked = False
+			ni.commit()
+	return grants, doubles
+
+def benchLocking(processes=8, seconds=2.0, hold=0.0005):
+	"""Checkout locks under contention: the legacy .nodeInfo flag vs the O_EXCL lock file"""
+	from multiprocessing import Pool
+	tmp = tempfile.mkdtemp()
+	try:
+		print 'locking: %d processes racing for one folder for %.1f s each' % (processes, seconds)
+		for protocol in ('legacy', 'lockfile'):
+			dirPath = os.path.join(tmp, protocol)
+			os.mkdir(dirPath)
+			NodeInfo(dirPath, 'bench').commit()
+			pool = Pool(processes)
+			try:
+				results = pool.map(_lockWorker, [(dirPath, protocol, seconds, hold)] * processes)
+			finally:
+				pool.close()
+				pool.join()
+			grants = sum(r[0] for r in results)
+			doubles = sum(r[1] for r in results)
+			print '  %-10s %8.0f acquisitions/s   %6d double grants' % (protocol, grants / seconds, doubles)
+	finally:
+		shutil.rmtree(tmp)
+
+def _diskUsage(*paths):
+	"""Bytes used below paths, counting hard linked files once"""
+	seen = set()
+	total = 0
+	for dirPath, dirNames, fileNames in [w for path in paths for w in os.walk(path)]:
+		for name in fileNames:
+			st = os.lstat(os.path.join(dirPath, name))
+			if st.st_ino not in seen:
+				seen.add(st.st_ino)
+				total += st.st_size
+	return total
+
+def benchBlobStore(versions=5, textures=8, size=1 << 20):
+	"""Disk used by retained versions: full copies vs the blob store"""
+	import blobstore
+	tmp = tempfile.mkdtemp()
+	try:
+		work = os.path.join(tmp, 'work')
+		os.makedirs(os.path.join(work, 'textures'))
+		for i in range(textures):
+			f = open(os.path.join(work, 'textures', 'tex%02d.exr' % i), 'wb')
+			f.write(os.urandom(size))
+			f.close()
+		copies = os.path.join(tmp, 'copies')
+		store = blobstore.BlobStore(os.path.join(tmp, 'blobs'))
+		stored = os.path.join(tmp, 'stored')
+		written = 0
+		hashed = 0
+		for v in range(versions):
+			# an artist's checkin: only the scene changes
+			f = open(os.path.join(work, 'scene.mb'), 'wb')
+			f.write(os.urandom(size / 4))
+			f.close()
+			shutil.copytree(work, os.path.join(copies, versionName(v)))
+			base = os.path.join(stored, versionName(v - 1)) if v else None
+			stats = blobstore.storeTree(work, os.path.join(stored, versionName(v)), store, base)
+			written += stats.newBytes
+			hashed += stats.hashedFiles
+
+		print 'blobstore: %d versions of %d MB of textures and a changing scene' % (versions, textures * size >> 20)
+		print '  %-40s %10.1f MB' % ('full copies (legacy)', _diskUsage(copies) / 1048576.0)
+		print '  %-40s %10.1f MB' % ('manifests + blob store', _diskUsage(stored, store.root) / 1048576.0)
+		print '  %-40s %10.1f MB' % ('bytes written by checkins', written / 1048576.0)
+		print '  %-40s %10d of %d' % ('files read by checkins', hashed, versions * (textures + 1))
+	finally:
+		shutil.rmtree(tmp)
+
+def benchDaemon(folders=200, repeat=5):
+	"""A new session reading .nodeInfo files: its own cold cache vs the metadata daemon's warm one"""
+	import subprocess, metadaemon
+	tmp = tempfile.mkdtemp()
+	server = None
+	try:
+		paths = []
+		for i in range(folders):
+			dirPath = os.path.join(tmp, 'asset%03d' % i)
+			os.makedirs(dirPath)
+			_sampleNodeInfo(dirPath).commit()
+			paths.append(dirPath)
+		socketPath = os.path.join(tmp, 'meta.sock')
+		server = subprocess.Popen([sys.executable, metadaemon.__file__.replace('.pyc', '.py'), 'serve', socketPath],
+			stdout=open(os.devnull, 'w'))
+		client = metadaemon.Client(socketPath)
+		while not os.path.exists(socketPath):
+			time.sleep(0.05)
+
+		def direct():
+			nodeinfo.getCache().clear()
+			for dirPath in paths:
+				NodeInfo.load(dirPath)
+		def daemon():
+			for dirPath in paths:
+				NodeInfo.load(dirPath)
+
+		print 'daemon: %d folders read by a new session (%d iterations)' % (folders, repeat)
+		baseline = _timeit(direct, repeat)
+		_report('own cold cache', baseline)
+		nodeinfo.setRemote(client)
+		try:
+			# warmed by the sessions before
+			daemon()
+			_report('metadata daemon', _timeit(daemon, repeat), baseline)
+			print '  (the daemon saves the open and read of each file; on a local disk that costs less than its socket round trip)'
+		finally:
+			nodeinfo.setRemote(None)
+	finally:
+		if server is not None:
+			server.terminate()
+			server.wait()
+		shutil.rmtree(tmp)
+
+BENCHMARKS = [
+	('nodeinfo', benchNodeInfo),
+	('folderinfo', benchFolderInfo),
+	('walker', benchWalker),
+	('checkout', benchCheckout),
+	('copy', benchCopy),
+	('locking', benchLocking),
+	('blobstore', benchBlobStore),
+	('daemon', benchDaemon),
+]
+
+if __name__ == '__main__':
+	names = sys.argv[1:]
+	for name, func in BENCHMARKS:
+		if not names or name in names:
+			func()
@@ -0,0 +1,595 @@
+"""
+This module contains the project's content-addressed store of checked in files.
+
+Every file checked in is stored once, under its SHA-256, in the project's blob
+store (PRODUCTION_DIR/.blobs, or RELIC_BLOB_DIR). A version folder (src/vNNN)
+holds a .manifest describing its files (hash, size, mode, mtime) and a read-only
+hard link to the blob of each file, so versions that share a file share its
+disk space, and the version folders can still be browsed as before.
+
+A blob's link count is its reference count: once no version (or checkout) links
+to it any more, its count drops to one and collect() deletes it. Removing a
+version is deleting its folder and collecting the blobs its manifest names.
+Where the store can not be hard linked into a version folder (another volume),
+the version folder gets a reflink of the blob, or a plain copy, instead. That is
+also the case for blobs another user stored where Linux protects hard links
+(fs.protected_hardlinks=1, the default): only the owner of a blob may link it,
+so the files of other users' blobs are neither shared nor counted as references.
+Such files are counted in StoreStats.unlinkedFiles and reported; a studio where
+several users check in should have checkins stored by one user (see checkinjobs)
+or turn the protection off on the machines writing to the store.
+
+The SHA-256 of a file is computed in the same read that stores it. Run this
+module with "verify [<root> ...]" to re-hash versions against their manifests.
+"""
+
+import os, stat, json, errno, shutil, hashlib, tempfile, threading
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+import nodeinfo, fileclone, copyengine
+from nodeinfo import CHECKOUT_INFO
+
+MANIFEST = '.manifest'
+MANIFEST_FORMAT = 'relic-manifest/1'
+
+BLOB_DIR = '.blobs'
+
+# read size used when hashing and copying
+CHUNK_SIZE = 1 << 20
+
+# transferred: (path, bytes written) of each file that had to be written to the store
+# unlinkedFiles: the files that could not be linked to their blob (reflinked or copied instead)
+StoreStats = namedtuple('StoreStats', ['files', 'bytes', 'newFiles', 'newBytes', 'hashedFiles', 'unlinkedFiles', 'transferred', 'seconds'])
+
+# mtimes restored by materialize() may lose their sub-microsecond part
+_MTIME_TOLERANCE = 1e-5
+
+# files hashed at once by verify
+VERIFY_THREADS = 8
+
+class IntegrityError(Exception):
+	"""Raised when files do not match their version's manifest; problems are (path, what is wrong)"""
+	def __init__(self, versionDir, problems):
+		Exception.__init__(self, versionDir + ": " + ', '.join('%s (%s)' % p for p in problems))
+		self.versionDir = versionDir
+		self.problems = problems
+
+def getStoreDir():
+	if 'RELIC_BLOB_DIR' in os.environ:
+		return os.environ['RELIC_BLOB_DIR']
+	return os.path.join(os.environ['PRODUCTION_DIR'], BLOB_DIR)
+
+def hashFile(filePath):
+	"""@returns: the hex SHA-256 of the contents of filePath"""
+	h = hashlib.sha256()
+	f = open(filePath, 'rb')
+	try:
+		while True:
+			chunk = f.read(CHUNK_SIZE)
+			if not chunk:
+				break
+			h.update(chunk)
+	finally:
+		f.close()
+	return h.hexdigest()
+
+class BlobStore(object):
+	def __init__(self, root=None):
+		if root is None:
+			root = getStoreDir()
+		self.root = root
+
+	def blobPath(self, digest):
+		return os.path.join(self.root, digest[:2], digest[2:])
+
+	def has(self, digest):
+		return os.path.exists(self.blobPath(digest))
+
+	def _makeDirs(self, dirPath):
+		if not os.path.isdir(dirPath):
+			try:
+				os.makedirs(dirPath)
+			except OSError as e:
+				if e.errno != errno.EEXIST:
+					raise
+
+	def _publish(self, tmpPath, digest):
+		"""
+		Makes the finished temporary file tmpPath the blob digest, or removes it if the blob exists.
+		@returns: the number of bytes added to the store
+		"""
+		blobPath = self.blobPath(digest)
+		if os.path.exists(blobPath):
+			os.remove(tmpPath)
+			return 0
+		self._makeDirs(os.path.dirname(blobPath))
+		# blobs are shared by every version linking to them, so they must never be written in place
+		os.chmod(tmpPath, 0444)
+		# linked, not renamed, into place: a rename would replace the blob another writer of the
+		# same bytes published meanwhile, and the versions already linked to it would stop sharing it
+		try:
+			os.link(tmpPath, blobPath)
+		except OSError as e:
+			if e.errno != errno.EEXIST:
+				raise
+			os.remove(tmpPath)
+			return 0
+		os.remove(tmpPath)
+		return os.path.getsize(blobPath)
+
+	def _tempPath(self):
+		self._makeDirs(self.root)
+		fd, tmpPath = tempfile.mkstemp(prefix='.incoming.', dir=self.root)
+		os.close(fd)
+		return tmpPath
+
+	def put(self, filePath, digest):
+		"""
+		Stores a copy of filePath as the blob digest, unless it is already stored.
+		@returns: the number of bytes written
+		"""
+		if os.path.exists(self.blobPath(digest)):
+			return 0
+		tmpPath = self._tempPath()
+		try:
+			copyengine.copyFile(filePath, tmpPath)
+			return self._publish(tmpPath, digest)
+		except:
+			if os.path.exists(tmpPath):
+				os.remove(tmpPath)
+			raise
+
+	def putHashed(self, filePath):
+		"""
+		Stores filePath, hashing it while it is copied, so it is read only once
+		(a copy that turns out to be stored already is dropped).
+		@returns: (its digest, the number of bytes written)
+		"""
+		tmpPath = self._tempPath()
+		try:
+			size, digest = copyengine.copyFileHashed(filePath, tmpPath)
+			return digest, self._publish(tmpPath, digest)
+		except:
+			if os.path.exists(tmpPath):
+				os.remove(tmpPath)
+			raise
+
+	def adopt(self, filePath, digest):
+		"""
+		Makes filePath itself the blob digest by linking it into the store (it is made read-only).
+		@returns: False if the blob already exists or filePath is on another volume
+		"""
+		blobPath = self.blobPath(digest)
+		if os.path.exists(blobPath):
+			return False
+		try:
+			os.makedirs(os.path.dirname(blobPath))
+		except OSError as e:
+			if e.errno != errno.EEXIST:
+				raise
+		os.chmod(filePath, 0444)
+		try:
+			os.link(filePath, blobPath)
+		except OSError as e:
+			if e.errno in (errno.EEXIST, errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP):
+				return False
+			raise
+		return True
+
+	def link(self, digest, dest):
+		"""Hard links the blob digest to dest, raises OSError if it can not"""
+		os.link(self.blobPath(digest), dest)
+
+	def collect(self, digests=None):
+		"""
+		Deletes the blobs that nothing links to any more.
+		@param digests: the blobs to check; every blob in the store if not given
+		@returns: (blobs deleted, bytes freed)
+		"""
+		if digests is None:
+			digests = self._allDigests()
+		count = 0
+		freed = 0
+		for digest in set(digests):
+			blobPath = self.blobPath(digest)
+			try:
+				st = os.lstat(blobPath)
+			except OSError:
+				continue
+			if st.st_nlink == 1:
+				try:
+					os.remove(blobPath)
+				except OSError:
+					continue
+				count += 1
+				freed += st.st_size
+		return count, freed
+
+	def _allDigests(self):
+		digests = []
+		if not os.path.isdir(self.root):
+			return digests
+		for prefix in os.listdir(self.root):
+			prefixDir = os.path.join(self.root, prefix)
+			if len(prefix) != 2 or not os.path.isdir(prefixDir):
+				continue
+			digests.extend(prefix + name for name in os.listdir(prefixDir) if not name.startswith('.'))
+		return digests
+
+################################################################################
+# Manifests
+################################################################################
+def readManifest(versionDir):
+	"""@returns: the manifest of versionDir as a dict, or None if it is a legacy (plain copy) version"""
+	try:
+		f = open(os.path.join(versionDir, MANIFEST), 'rb')
+	except IOError:
+		return None
+	try:
+		return json.load(f)
+	finally:
+		f.close()
+
+def writeManifest(versionDir, manifest):
+	manifest['format'] = MANIFEST_FORMAT
+	nodeinfo.atomicWrite(os.path.join(versionDir, MANIFEST), json.dumps(manifest, sort_keys=True, separators=(',', ':')))
+
+def _isExcluded(relPath):
+	return relPath in (MANIFEST, CHECKOUT_INFO)
+
+def _linkOrCopy(store, digest, srcPath, dest):
+	"""
+	Links the blob digest (stored from srcPath) to dest, or reflinks or copies it where it can not be linked.
+	@returns: (the bytes written to the store, None or the OSError that kept it from being linked)
+	"""
+	written = store.put(srcPath, digest)
+	try:
+		store.link(digest, dest)
+	except OSError as e:
+		if e.errno == errno.ENOENT:
+			# collected by a concurrent purge between put and link
+			written += store.put(srcPath, digest)
+			store.link(digest, dest)
+		elif e.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP):
+			# EPERM: a blob of another user, under fs.protected_hardlinks (see the module docstring)
+			try:
+				fileclone.reflinkFile(store.blobPath(digest), dest)
+			except (IOError, OSError):
+				copyengine.copyFile(srcPath, dest)
+			return written, e
+		else:
+			raise
+	return written, None
+
+def _unchangedDigest(srcPath, st, relPath, base, baseManifest):
+	"""
+	@returns: the hash of srcPath if it is known to be unchanged from relPath in the
+		base version (the same inode, or the same size and mtime), None if it has to be hashed
+	"""
+	entry = baseManifest['files'].get(relPath)
+	if entry is None or entry['size'] != st.st_size:
+		return None
+	if abs(entry['mtime'] - st.st_mtime) < _MTIME_TOLERANCE:
+		return entry['sha256']
+	try:
+		baseSt = os.stat(os.path.join(base, relPath))
+	except OSError:
+		return None
+	if (baseSt.st_ino, baseSt.st_dev) == (st.st_ino, st.st_dev):
+		# hard linked at checkout
+		return entry['sha256']
+	return None
+
+def storeTree(src, versionDir, store=None, base=None, progress=None):
+	"""
+	Checks the directory src in as versionDir (which must not exist): new files are
+	added to store, and versionDir gets a manifest and a link to the blob of each file.
+	.checkoutInfo and .manifest files at the top of src are left out.
+	Files are hashed and stored several at a time (see copyengine.copyFiles()).
+	@param base: the version folder src was checked out from. Files unchanged since
+		(same inode, or same size and mtime as in its manifest) are not even read.
+	@param progress: see copyengine.copyFiles()
+	@returns: a StoreStats of the files in src and of the new blobs written
+	"""
+	if store is None:
+		store = BlobStore()
+	baseManifest = None
+	if base is not None:
+		baseManifest = readManifest(base)
+	manifest = {'files': {}, 'links': {}, 'dirs': []}
+	counts = {'newFiles': 0, 'newBytes': 0, 'hashedFiles': 0, 'unlinkedFiles': 0}
+	unlinked = []
+	transferred = []
+	lock = threading.Lock()
+	pairs = []
+	os.makedirs(versionDir)
+	for dirPath, dirNames, fileNames in os.walk(src):
+		relDir = os.path.relpath(dirPath, src)
+		destDir = versionDir if relDir == '.' else os.path.join(versionDir, relDir)
+		for name in sorted(dirNames):
+			if os.path.islink(os.path.join(dirPath, name)):
+				fileNames.append(name)
+				dirNames.remove(name)
+		for name in dirNames:
+			os.mkdir(os.path.join(destDir, name))
+			manifest['dirs'].append(os.path.normpath(os.path.join(relDir, name)))
+		for name in fileNames:
+			relPath = os.path.normpath(os.path.join(relDir, name))
+			if _isExcluded(relPath):
+				continue
+			srcPath = os.path.join(dirPath, name)
+			dest = os.path.join(destDir, name)
+			if os.path.islink(srcPath):
+				target = os.readlink(srcPath)
+				os.symlink(target, dest)
+				manifest['links'][relPath] = target
+				continue
+			pairs.append((srcPath, dest))
+
+	def storeFile(srcPath, dest):
+		relPath = os.path.relpath(srcPath, src)
+		st = os.stat(srcPath)
+		digest = None
+		if baseManifest is not None:
+			digest = _unchangedDigest(srcPath, st, relPath, base, baseManifest)
+		hashed = digest is None
+		written = 0
+		if hashed:
+			# hashed in the same read that stores it
+			digest, written = store.putHashed(srcPath)
+		stored, error = _linkOrCopy(store, digest, srcPath, dest)
+		written += stored
+		with lock:
+			if error is not None:
+				counts['unlinkedFiles'] += 1
+				unlinked.append(error)
+			manifest['files'][relPath] = {'sha256': digest, 'size': st.st_size,
+				'mode': stat.S_IMODE(st.st_mode), 'mtime': st.st_mtime}
+			if hashed:
+				counts['hashedFiles'] += 1
+			if written:
+				counts['newFiles'] += 1
+				counts['newBytes'] += written
+				transferred.append((relPath, written))
+		return st.st_size
+
+	copied = copyengine.copyFiles(pairs, progress, storeFile)
+	writeManifest(versionDir, manifest)
+	transferred.sort()
+	if unlinked:
+		print "blobstore: %d files of %s could not be linked to the store and take space of their own (%s)" % (
+			len(unlinked), versionDir, os.strerror(unlinked[0].errno))
+	return StoreStats(copied.files, copied.bytes, counts['newFiles'], counts['newBytes'], counts['hashedFiles'],
+		counts['unlinkedFiles'], transferred, copied.seconds)
+
+def materialize(versionDir, dest, mode=None, progress=None, verify=False, writable=True):
+	"""
+	Copies the version versionDir to dest (which must not exist) with a fileclone mode,
+	giving copied files back the mode and mtime they were checked in with.
+	Legacy versions without a manifest are copied as they are.
+	@param progress: see copyengine.copyFiles()
+	@param verify: if True, check every file of dest against the manifest. Copied files are
+		hashed as they are copied and linked or cloned ones are hashed once, so nothing is read twice.
+	@param writable: False for a read-only checkout, which may hard link the blobs (see fileclone)
+	@raises: IntegrityError if verify finds a file that does not match the manifest
+	@returns: a copyengine.CopyStats of the run
+	"""
+	manifest = readManifest(versionDir)
+	if manifest is None:
+		return fileclone.cloneTree(versionDir, dest, mode, progress, writable)
+	if mode is None:
+		mode = fileclone.getCheckoutMode()
+	os.makedirs(dest)
+	key = fileclone.deviceKey(versionDir, dest)
+	for relDir in sorted(manifest['dirs']):
+		os.mkdir(os.path.join(dest, relDir))
+	for relPath, target in manifest['links'].items():
+		os.symlink(target, os.path.join(dest, relPath))
+	files = manifest['files']
+	problems = []
+
+	def cloneFile(blobLink, filePath):
+		relPath = os.path.relpath(filePath, dest)
+		entry = files[relPath]
+		if not verify:
+			fileclone.cloneFile(blobLink, filePath, mode, key, writable=writable)
+		else:
+			copied = []
+			def copyHashed(src, dst):
+				copied.append(copyengine.copyFileHashed(src, dst)[1])
+			fileclone.cloneFile(blobLink, filePath, mode, key, copyHashed, writable)
+			digest = copied[0] if copied else hashFile(filePath)
+			if digest != entry['sha256']:
+				problems.append((relPath, 'checksum mismatch'))
+		if os.stat(filePath).st_nlink == 1:
+			# a file of its own, not a (read-only) link to the blob
+			os.chmod(filePath, entry['mode'])
+			os.utime(filePath, (entry['mtime'], entry['mtime']))
+		return entry['size']
+
+	pairs = [(os.path.join(versionDir, relPath), os.path.join(dest, relPath)) for relPath in sorted(files)]
+	stats = copyengine.copyFiles(pairs, progress, cloneFile)
+	if problems:
+		raise IntegrityError(versionDir, sorted(problems))
+	return stats
+
+def removeVersion(versionDir, store=None):
+	"""
+	Deletes the version folder versionDir and the blobs only it was using.
+	@returns: (blobs deleted, bytes freed)
+	"""
+	manifest = readManifest(versionDir)
+	shutil.rmtree(versionDir)
+	if manifest is None:
+		return 0, 0
+	if store is None:
+		store = BlobStore()
+	return store.collect(entry['sha256'] for entry in manifest['files'].values())
+
+def convertVersion(versionDir, store=None):
+	"""
+	Moves the files of a legacy (plain copy) version folder into the store: a file is
+	linked into the store, or replaced with a link to the blob already there, so nothing is copied.
+	Files on another volume than the store are left as they are.
+	@returns: False if versionDir already has a manifest
+	"""
+	if readManifest(versionDir) is not None:
+		return False
+	if store is None:
+		store = BlobStore()
+	manifest = {'files': {}, 'links': {}, 'dirs': []}
+	for dirPath, dirNames, fileNames in os.walk(versionDir):
+		relDir = os.path.relpath(dirPath, versionDir)
+		for name in dirNames:
+			if os.path.islink(os.path.join(dirPath, name)):
+				manifest['links'][os.path.normpath(os.path.join(relDir, name))] = os.readlink(os.path.join(dirPath, name))
+			else:
+				manifest['dirs'].append(os.path.normpath(os.path.join(relDir, name)))
+		for name in fileNames:
+			relPath = os.path.normpath(os.path.join(relDir, name))
+			filePath = os.path.join(dirPath, name)
+			if _isExcluded(relPath):
+				continue
+			if os.path.islink(filePath):
+				manifest['links'][relPath] = os.readlink(filePath)
+				continue
+			st = os.stat(filePath)
+			digest = hashFile(filePath)
+			manifest['files'][relPath] = {'sha256': digest, 'size': st.st_size,
+				'mode': stat.S_IMODE(st.st_mode), 'mtime': st.st_mtime}
+			if store.adopt(filePath, digest) or not store.has(digest):
+				continue
+			# already stored by another version: share its blob
+			tmpPath = filePath + '.blob'
+			try:
+				store.link(digest, tmpPath)
+				os.rename(tmpPath, filePath)
+			except OSError as e:
+				if os.path.lexists(tmpPath):
+					os.remove(tmpPath)
+				if e.errno not in (errno.ENOENT, errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP):
+					raise
+	writeManifest(versionDir, manifest)
+	return True
+
+def convertTree(root, store=None):
+	"""
+	Converts every legacy version folder (<versioned folder>/src/vNNN) below root.
+	@returns: the number of versions converted
+	"""
+	if store is None:
+		store = BlobStore()
+	count = 0
+	for dirPath, dirNames, fileNames in os.walk(root):
+		dirNames[:] = [d for d in dirNames if not d.startswith('.')]
+		if nodeinfo.NODE_INFO in fileNames:
+			dirNames[:] = []
+			srcDir = os.path.join(dirPath, 'src')
+			if not os.path.isdir(srcDir):
+				continue
+			for name in sorted(os.listdir(srcDir)):
+				if os.path.isdir(os.path.join(srcDir, name)) and convertVersion(os.path.join(srcDir, name), store):
+					count += 1
+	return count
+
+################################################################################
+# Verification
+################################################################################
+_verifyPool = None
+_verifyPoolLock = threading.Lock()
+
+def _getVerifyPool():
+	global _verifyPool
+	with _verifyPoolLock:
+		if _verifyPool is None:
+			_verifyPool = ThreadPool(VERIFY_THREADS)
+		return _verifyPool
+
+def _checkFile(filePath, entry, hashed):
+	"""@returns: what is wrong with filePath, or None if it matches entry"""
+	try:
+		st = os.stat(filePath)
+	except OSError:
+		return 'missing'
+	if st.st_size != entry['size']:
+		return 'size %d, expected %d' % (st.st_size, entry['size'])
+	# versions sharing a blob link to the same inode: hash it once per run
+	inode = (st.st_dev, st.st_ino)
+	digest = hashed.get(inode)
+	if digest is None:
+		try:
+			digest = hashFile(filePath)
+		except IOError as e:
+			return 'unreadable (%s)' % e.strerror
+		hashed[inode] = digest
+	if digest != entry['sha256']:
+		return 'checksum mismatch'
+	return None
+
+def verifyVersion(versionDir, hashed=None):
+	"""
+	Re-hashes the files of versionDir (several at a time) and compares them with its manifest.
+	@param hashed: (device, inode) -> digest of the files already hashed, shared between calls
+	@returns: (path, what is wrong) of each file that does not match, [] if the version is intact
+	@raises: Exception if versionDir has no manifest
+	"""
+	manifest = readManifest(versionDir)
+	if manifest is None:
+		raise Exception(versionDir + " has no manifest (convert it first)")
+	if hashed is None:
+		hashed = {}
+	entries = sorted(manifest['files'].items())
+	results = _getVerifyPool().map(lambda item: _checkFile(os.path.join(versionDir, item[0]), item[1], hashed), entries)
+	return [(relPath, problem) for (relPath, entry), problem in zip(entries, results) if problem is not None]
+
+def verifyTree(root):
+	"""
+	Verifies every version folder (<versioned folder>/src/vNNN) below root.
+	@returns: (version folder, problems) of each version, problems being None for legacy versions without a manifest
+	"""
+	hashed = {}
+	results = []
+	for dirPath, dirNames, fileNames in os.walk(root):
+		dirNames[:] = sorted(d for d in dirNames if not d.startswith('.'))
+		if nodeinfo.NODE_INFO in fileNames:
+			dirNames[:] = []
+			srcDir = os.path.join(dirPath, 'src')
+			if not os.path.isdir(srcDir):
+				continue
+			for name in sorted(os.listdir(srcDir)):
+				versionDir = os.path.join(srcDir, name)
+				if name.startswith('.') or not os.path.isdir(versionDir):
+					continue
+				if readManifest(versionDir) is None:
+					results.append((versionDir, None))
+				else:
+					results.append((versionDir, verifyVersion(versionDir, hashed)))
+	return results
+
+if __name__ == '__main__':
+	import sys
+	args = sys.argv[1:]
+	if args and args[0] == 'convert':
+		roots = args[1:] or [os.environ['PRODUCTION_DIR']]
+		for root in roots:
+			print root + ': ' + str(convertTree(root)) + ' versions converted'
+	elif args and args[0] == 'verify':
+		roots = args[1:] or [os.environ['PRODUCTION_DIR']]
+		corrupt = 0
+		for root in roots:
+			for versionDir, problems in verifyTree(root):
+				if problems is None:
+					print versionDir + ': no manifest, not verified'
+				elif problems:
+					corrupt += 1
+					for relPath, problem in problems:
+						print versionDir + ': ' + relPath + ': ' + problem
+		print '%d corrupt versions' % corrupt
+		sys.exit(1 if corrupt else 0)
+	elif args and args[0] == 'collect':
+		count, freed = BlobStore().collect()
+		print '%d unreferenced blobs deleted, %d bytes freed' % (count, freed)
+	else:
+		print 'usage: blobstore.py convert [<root> ...] | verify [<root> ...] | collect'
+		sys.exit(2)
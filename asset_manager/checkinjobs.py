@@ -0,0 +1,218 @@
+"""
+This module runs checkins in a background worker process, so the artist gets
+their application back as soon as the checkin is submitted.
+
+submit() checks that the folder can be checked in, records the job in a status
+file in the user's job folder (~/.relic/jobs, or RELIC_JOB_DIR) and starts
+"python checkinjobs.py run <job id>" detached from the caller. The worker does
+the checkin and keeps the status file up to date:
+
+	queued		submitted, the worker has not started yet
+	running		storing files; done/total are the bytes stored so far
+	done		committed, dest is the versioned folder
+	failed		error says why; nothing was committed
+
+Once the checkin is done, the worker archives the versions the new one pushed out
+of the versions to keep (see utilities.purgeVersions()). That is not part of the
+checkin: the folder is already unlocked, and a failure is only logged.
+
+The versioned folder stays locked until the worker commits the new version, and
+a failed checkin leaves both the lock and the checked out folder as they were.
+"""
+
+import os, sys, time, json, errno, socket, signal, subprocess, threading, traceback
+from collections import namedtuple
+
+import nodeinfo, lockfile
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# seconds between status file updates while files are stored
+PROGRESS_INTERVAL = 0.5
+# seconds a worker has to start before its queued job is reported as failed
+START_TIMEOUT = 60
+
+CheckinJob = namedtuple('CheckinJob', ['id', 'toCheckin', 'comment', 'state', 'done', 'total',
+	'error', 'dest', 'user', 'host', 'pid', 'submitted', 'finished'])
+
+def getJobDir():
+	if 'RELIC_JOB_DIR' in os.environ:
+		return os.environ['RELIC_JOB_DIR']
+	return os.path.join(os.path.expanduser('~'), '.relic', 'jobs')
+
+def getWorkerPython():
+	"""@returns: the Python the worker is run with: RELIC_PYTHON, mayapy inside Maya, or this Python"""
+	if 'RELIC_PYTHON' in os.environ:
+		return os.environ['RELIC_PYTHON']
+	if os.path.basename(sys.executable).lower().startswith('maya') and 'MAYA_LOCATION' in os.environ:
+		return os.path.join(os.environ['MAYA_LOCATION'], 'bin', 'mayapy')
+	return sys.executable
+
+def _jobPath(jobId):
+	return os.path.join(getJobDir(), jobId + '.json')
+
+def _writeJob(job):
+	nodeinfo.atomicWrite(_jobPath(job.id), json.dumps(job._asdict(), sort_keys=True))
+
+def _isAlive(job):
+	if job.pid is None:
+		return time.time() - job.submitted < START_TIMEOUT
+	if job.host != socket.gethostname():
+		# can not tell from here
+		return True
+	try:
+		os.kill(job.pid, 0)
+	except OSError as e:
+		return e.errno == errno.EPERM
+	return True
+
+def getJob(jobId):
+	"""
+	@returns: the CheckinJob jobId, or None if there is no such job. A job whose
+		worker has gone away without finishing is reported as failed.
+	"""
+	try:
+		f = open(_jobPath(jobId), 'rb')
+	except IOError:
+		return None
+	try:
+		job = CheckinJob(**json.load(f))
+	finally:
+		f.close()
+	if job.state in (QUEUED, RUNNING) and not _isAlive(job):
+		job = job._replace(state=FAILED, error='The checkin worker exited unexpectedly.')
+	return job
+
+def listJobs():
+	"""@returns: the CheckinJobs in the job folder, oldest first"""
+	try:
+		names = os.listdir(getJobDir())
+	except OSError:
+		return []
+	jobs = [getJob(name[:-len('.json')]) for name in names if name.endswith('.json') and not name.startswith('.')]
+	return sorted((job for job in jobs if job is not None), key=lambda job: job.submitted)
+
+def activeJobs():
+	return [job for job in listJobs() if job.state in (QUEUED, RUNNING)]
+
+def finishedJobs():
+	return [job for job in listJobs() if job.state in (DONE, FAILED)]
+
+def activeJobFor(toCheckin):
+	"""@returns: the queued or running job checking in toCheckin, or None"""
+	toCheckin = os.path.abspath(toCheckin)
+	for job in activeJobs():
+		if job.toCheckin == toCheckin:
+			return job
+	return None
+
+def _logPath(jobId):
+	return os.path.join(getJobDir(), '.' + jobId + '.log')
+
+def forget(jobId):
+	"""Removes the status file and log of a finished job once it has been reported"""
+	for path in (_jobPath(jobId), _logPath(jobId)):
+		try:
+			os.remove(path)
+		except OSError as e:
+			if e.errno != errno.ENOENT:
+				raise
+
+def submit(toCheckin, comment=None):
+	"""
+	Starts checking toCheckin in in a background worker process.
+	@precondition: canCheckin(toCheckin) == True
+	@returns: the CheckinJob as submitted
+	"""
+	import utilities
+	toCheckin = os.path.abspath(toCheckin)
+	if not utilities.canCheckin(toCheckin):
+		raise Exception("Can not overwrite locked folder.")
+	if activeJobFor(toCheckin) is not None:
+		raise Exception(os.path.basename(toCheckin) + " is already being checked in.")
+	jobDir = getJobDir()
+	if not os.path.isdir(jobDir):
+		try:
+			os.makedirs(jobDir)
+		except OSError as e:
+			if e.errno != errno.EEXIST:
+				raise
+	jobId = '%s-%d-%s' % (time.strftime('%Y%m%d%H%M%S'), os.getpid(), os.path.basename(toCheckin))
+	job = CheckinJob(jobId, toCheckin, comment, QUEUED, 0, 0, None, None, utilities.getUsername(),
+		socket.gethostname(), None, time.time(), None)
+	_writeJob(job)
+	logFile = open(_logPath(jobId), 'ab')
+	devNull = open(os.devnull, 'rb')
+	try:
+		subprocess.Popen([getWorkerPython(), os.path.abspath(__file__).replace('.pyc', '.py'), 'run', jobId],
+			stdin=devNull, stdout=logFile, stderr=subprocess.STDOUT, close_fds=True,
+			# its own session, so closing the artist's application does not stop the checkin
+			preexec_fn=os.setsid)
+	except OSError:
+		forget(jobId)
+		raise
+	finally:
+		devNull.close()
+		logFile.close()
+	return job
+
+def runJob(jobId):
+	"""Does the checkin of the job jobId (in the worker process)"""
+	import utilities
+	utilities.connectMetadataDaemon()
+	# the worker outlives the process that started it; do not die with it
+	signal.signal(signal.SIGHUP, signal.SIG_IGN)
+	job = getJob(jobId)._replace(state=RUNNING, pid=os.getpid(), host=socket.gethostname())
+	_writeJob(job)
+	lock = threading.Lock()
+	state = {'job': job, 'written': 0}
+
+	def progress(done, total):
+		# called from the copying threads
+		with lock:
+			state['job'] = state['job']._replace(done=done, total=total)
+			now = time.time()
+			if now - state['written'] >= PROGRESS_INTERVAL:
+				state['written'] = now
+				_writeJob(state['job'])
+
+	# the artist's session may be gone: keep the lease of the folder alive until it is checked in
+	try:
+		chkInDest = nodeinfo.CheckoutInfo.load(job.toCheckin).checkedOutFrom
+	except Exception:
+		chkInDest = None
+	heartbeat = lockfile.LeaseHeartbeat(lambda: chkInDest and lockfile.renew(chkInDest, job.user))
+	heartbeat.start()
+	try:
+		dest = utilities.checkin(job.toCheckin, job.comment, progress)
+	except Exception as e:
+		traceback.print_exc()
+		with lock:
+			_writeJob(state['job']._replace(state=FAILED, error=str(e) or e.__class__.__name__, finished=time.time()))
+		return False
+	finally:
+		heartbeat.stop()
+	with lock:
+		_writeJob(state['job']._replace(state=DONE, done=state['job'].total, dest=dest, finished=time.time()))
+	try:
+		archived = utilities.purgeVersions(dest)
+		if archived:
+			print "archived " + ', '.join(nodeinfo.versionName(v) for v in archived)
+	except Exception:
+		print "could not archive the old versions of " + dest
+		traceback.print_exc()
+	return True
+
+if __name__ == '__main__':
+	args = sys.argv[1:]
+	if len(args) == 2 and args[0] == 'run':
+		sys.exit(0 if runJob(args[1]) else 1)
+	elif args == ['list']:
+		for job in listJobs():
+			print '%-40s %-8s %d/%d %s' % (job.id, job.state, job.done, job.total, job.error or job.dest or '')
+	else:
+		print 'usage: checkinjobs.py run <job id> | list'
+		sys.exit(2)
@@ -0,0 +1,159 @@
+"""
+This module contains the append-only check-in comment journal of a versioned folder.
+
+Comments used to live in the [Comments] section of .nodeInfo, so recording one
+rewrote the whole file. They are now appended to two files next to it:
+
+	.comments.log	records of (version, length, comment text)
+	.comments.idx	fixed-size (version, offset, length) records pointing into .comments.log
+
+The latest comment is found by reading the last index record, and the whole
+history comes back from one sequential read of the log. Appends only take a
+lock on the journal, never on .nodeInfo. Comments still stored in a legacy
+.nodeInfo are used as a fallback.
+"""
+
+import os, struct, fcntl
+
+LOG_FILE = '.comments.log'
+INDEX_FILE = '.comments.idx'
+
+_LOG_HEADER = struct.Struct('>II')		# version, length
+_INDEX_RECORD = struct.Struct('>IQI')	# version, offset of the text in the log, length
+
+def _versionNumber(version):
+	"""Accepts 3, '3', '003' or 'v003'"""
+	if isinstance(version, basestring):
+		version = version.lstrip('v')
+	return int(version)
+
+def append(dirPath, version, comment):
+	"""Records comment for version of the versioned folder dirPath"""
+	if isinstance(comment, unicode):
+		comment = comment.encode('utf-8')
+	version = _versionNumber(version)
+	indexFd = os.open(os.path.join(dirPath, INDEX_FILE), os.O_RDWR | os.O_CREAT | os.O_APPEND, 0664)
+	try:
+		# the index lock serializes appenders; readers never block
+		fcntl.lockf(indexFd, fcntl.LOCK_EX)
+		logFd = os.open(os.path.join(dirPath, LOG_FILE), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0664)
+		try:
+			offset = os.fstat(logFd).st_size + _LOG_HEADER.size
+			os.write(logFd, _LOG_HEADER.pack(version, len(comment)) + comment)
+			os.fsync(logFd)
+		finally:
+			os.close(logFd)
+		# a crash before this point leaves an unindexed record, which readers ignore
+		indexSize = os.fstat(indexFd).st_size
+		if indexSize % _INDEX_RECORD.size:
+			# drop a torn record left by an earlier crash
+			os.ftruncate(indexFd, indexSize - indexSize % _INDEX_RECORD.size)
+		os.write(indexFd, _INDEX_RECORD.pack(version, offset, len(comment)))
+		os.fsync(indexFd)
+	finally:
+		os.close(indexFd)
+
+def _readText(dirPath, offset, length):
+	f = open(os.path.join(dirPath, LOG_FILE), 'rb')
+	try:
+		f.seek(offset)
+		return f.read(length)
+	finally:
+		f.close()
+
+def latest(dirPath):
+	"""
+	@returns: (version, comment) of the last recorded comment, or None if there is none
+	"""
+	try:
+		f = open(os.path.join(dirPath, INDEX_FILE), 'rb')
+	except IOError:
+		return None
+	try:
+		f.seek(0, os.SEEK_END)
+		size = f.tell()
+		size -= size % _INDEX_RECORD.size
+		if size == 0:
+			return None
+		f.seek(size - _INDEX_RECORD.size)
+		version, offset, length = _INDEX_RECORD.unpack(f.read(_INDEX_RECORD.size))
+	finally:
+		f.close()
+	return version, _readText(dirPath, offset, length)
+
+def get(dirPath, version):
+	"""
+	@returns: the most recent comment recorded for version, or None if there is none
+	"""
+	version = _versionNumber(version)
+	last = latest(dirPath)
+	if last is None:
+		return None
+	if last[0] == version:
+		return last[1]
+	f = open(os.path.join(dirPath, INDEX_FILE), 'rb')
+	try:
+		data = f.read()
+	finally:
+		f.close()
+	count = len(data) // _INDEX_RECORD.size
+	for i in xrange(count - 1, -1, -1):
+		recVersion, offset, length = _INDEX_RECORD.unpack_from(data, i * _INDEX_RECORD.size)
+		if recVersion == version:
+			return _readText(dirPath, offset, length)
+	return None
+
+def history(dirPath):
+	"""
+	Reads the whole journal in one sequential read.
+	@returns: a list of (version, comment) in the order they were recorded
+	"""
+	try:
+		f = open(os.path.join(dirPath, LOG_FILE), 'rb')
+	except IOError:
+		return []
+	try:
+		data = f.read()
+	finally:
+		f.close()
+	records = []
+	pos = 0
+	while pos + _LOG_HEADER.size <= len(data):
+		version, length = _LOG_HEADER.unpack_from(data, pos)
+		pos += _LOG_HEADER.size
+		if pos + length > len(data):
+			# torn write at the tail
+			break
+		records.append((version, data[pos:pos + length]))
+		pos += length
+	return records
+
+################################################################################
+# Lookups that fall back to the legacy [Comments] section of .nodeInfo
+################################################################################
+def getComment(nodeInfo, version):
+	"""
+	@returns: the comment for version of the folder described by nodeInfo
+	@raises: KeyError if there is none
+	"""
+	comment = get(nodeInfo.dirPath, version)
+	if comment is None:
+		comment = nodeInfo.comments['v%03d' % _versionNumber(version)]
+	return comment
+
+def latestComment(nodeInfo):
+	"""@returns: the comment for nodeInfo's latest version, or '' if there is none"""
+	try:
+		return getComment(nodeInfo, nodeInfo.latestVersion)
+	except KeyError:
+		return ''
+
+def allComments(nodeInfo):
+	"""
+	@returns: a dict of 'vNNN' -> comment for every version with a comment,
+		the journal taking precedence over the legacy .nodeInfo comments
+	"""
+	comments = dict(nodeInfo.comments)
+	for version, comment in history(nodeInfo.dirPath):
+		comments['v%03d' % version] = comment
+	return comments
@@ -1,8 +1,11 @@
-from PyQt4.QtGui import *
-from PyQt4.QtCore import *
-import os, glob, types, subprocess, sys
-import utilities
-from utilities import *
+from PyQt4.QtGui import QInputDialog, QLineEdit, QMessageBox, QTreeWidgetItem
+from PyQt4.QtCore import QObject, Qt, SIGNAL
+import os, types, subprocess, sys
+import utilities, walker
+from utilities import (addVersionedFolder, canCheckin, canRemove, canRename, checkin, checkout, createNewAssetFolders,
+    discard, getAssetIndex, getProductionDir, getUserCheckoutDir, getUsername, getVersionedFolderInfoMany, isEmptyFolder,
+    isVersionedFolder, removeFolder, renameFolder)
+from treeworkers import ProjectTreeWorker, LocalTreeWorker
 
 _tabNum = 0
 
@@ -15,8 +18,10 @@ def setup(ui):
     #    runSettings(ui)
     #else:
     #    configureProject(os.path.abspath(os.path.join(sys.path[0],'.myConfig.ini')))
+    utilities.connectMetadataDaemon()
     populateLocalTree(ui)
-    populateProjectTree(ui)
+    # pick up what was checked in or created from other workstations since the last session
+    populateProjectTree(ui, rescan=True)
     enableComponents(ui)
     
 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Common User Actions
@@ -63,18 +68,8 @@ def runDiscard(ui):
 		populateProjectTree(ui)
 
 def runInstall(ui):
-    tabNum = ui.fileTabs.currentIndex()
-    if tabNum == 1:
-        curItem = ui.projectFilesTreeWidget.currentItem()
-        vDirPath = ui.getTreeItemPath(curItem, getProductionDir())
-        files = getAvailableInstallFiles(vDirPath)
-        selected = ui.file_select_dialog.selectFile(convertToFileSelectionDialogItems(files))
-        if not selected == None:
-            srcFilePath = str(selected.text(1))
-            install(vDirPath, srcFilePath)
-            setProjectTreeVersionedItemInfo(curItem, vDirPath)
-    else:
-        ui.errorMessage.showMessage("You can only install project files")
+    # installing needs the mayapy/Houdini scripts (installMayaFile.py, installHoudiniFile.py) wired in
+    ui.errorMessage.showMessage("Not Implemented")
 
 
 def runNew(ui):
@@ -139,7 +134,8 @@ def runOpen(ui):
     if ui.fileTabs.currentIndex() == 0:
         curItem = ui.localFilesTreeWidget.currentItem()
         dirPath = ui.getTreeItemPath(curItem, getUserCheckoutDir())
-        files = glob.glob(os.path.join(dirPath, "*"))
+        listing = walker.listDir(dirPath)
+        files = [e.path for e in listing.match("*")] if listing is not None else []
         selected = ui.file_select_dialog.selectFile(convertToFileSelectionDialogItems(files))
         if not selected == None:
             toOpen = str(selected.text(1))
@@ -152,7 +148,7 @@ def refreshTree(ui):
 	if ui.fileTabs.currentIndex() == 0:
 		populateLocalTree(ui)
 	else:
-		populateProjectTree(ui)
+		populateProjectTree(ui, rescan=True)
 
 def runSettings(ui):
     settings = 'Username: '+getUsername()+'\nProject Folder: '+getProductionDir()+'\nChecked Out Folder: '+getUserCheckoutDir()
@@ -170,15 +166,16 @@ def convertToFileSelectionDialogItems(files):
         treeItems.append(item)
     return treeItems
 
-def convertToLocalTreeItems(files):
+def convertToLocalTreeItems(folders):
+    """@param folders: (path, checkout time or None, modification time) as sent by treeworkers.LocalTreeWorker"""
     treeItems = []
-    for f in files:
+    for f, checkoutTime, modified in folders:
         item = QTreeWidgetItem()
         item.setText(0, os.path.basename(f))
-        item.setText(2, time.strftime("%a, %d %b %Y %I:%M:%S %p", time.localtime(os.path.getmtime(f))))
-        try:
-        	item.setText(1, getFilesCheckoutTime(f))
-        except:
+        if checkoutTime is not None:
+        	item.setText(1, checkoutTime)
+        	item.setText(2, modified)
+        else:
         	item.setText(1, "Not a versioned Folder")
         	item.setText(2, "N/A") #TODO last opened stuff
         treeItems.append(item)
@@ -186,44 +183,189 @@ def convertToLocalTreeItems(files):
 
 def convertToProjectTreeItems(files):
     treeItems = []
-    for f in files:
+    for f, info in zip(files, getVersionedFolderInfoMany(files)):
         item = QTreeWidgetItem()
         item.setText(0, os.path.basename(f))
-        if isVersionedFolder(f):
-            setProjectTreeVersionedItemInfo(item, f)
+        if info is not None:
+            setProjectTreeItemInfo(item, info)
         treeItems.append(item)
     return treeItems
 
 def setProjectTreeVersionedItemInfo(pTreeItem, curDir):
-    info = getVersionedFolderInfo(curDir)
-    pTreeItem.setText(1, info[0])
-    pTreeItem.setText(2, info[1])
-    pTreeItem.setText(3, info[2])
-    pTreeItem.setText(4, info[3])
-    pTreeItem.setText(5, info[4])
-
-def populateProjectTree(ui):
+    info = getVersionedFolderInfoMany([curDir])[0]
+    if info is not None:
+        setProjectTreeItemInfo(pTreeItem, info)
+
+def setProjectTreeItemInfo(pTreeItem, info):
+    """
+    Fills in the versioned folder columns of pTreeItem
+    @param info: a utilities.VersionedFolderInfo or an assetindex.IndexEntry
+    """
+    pTreeItem.setText(1, info.lockedBy)
+    pTreeItem.setText(2, info.lastCheckinUser)
+    pTreeItem.setText(3, info.lastCheckinTime)
+    pTreeItem.setText(4, info.latestComment)
+    pTreeItem.setText(5, "Yes" if info.installed else "No")
+
+# text of the placeholder child given to folders whose children have not been loaded yet
+_PLACEHOLDER_TEXT = "Loading..."
+
+def _addPlaceholder(item):
+    placeholder = QTreeWidgetItem(item)
+    placeholder.setText(0, _PLACEHOLDER_TEXT)
+    placeholder.setFlags(Qt.NoItemFlags)
+
+def _takePlaceholder(item):
+    """Removes the placeholder child of item, returns False if it had none (already loaded)"""
+    for i in range(item.childCount()):
+        child = item.child(i)
+        if child.text(0) == _PLACEHOLDER_TEXT and int(child.flags()) == 0:
+            item.takeChild(i)
+            return True
+    return False
+
+def _addProjectTreeEntries(parent, entries, existing=()):
+    """
+    Adds a row below parent for each assetindex.IndexEntry in entries.
+    Plain folders get a placeholder child and are filled in when expanded.
+    """
+    for entry in entries:
+        if entry.name in existing:
+            continue
+        item = QTreeWidgetItem(parent)
+        item.setText(0, entry.name)
+        if entry.versioned:
+            setProjectTreeItemInfo(item, entry)
+        else:
+            _addPlaceholder(item)
+
+def _expandedProjectPaths(ui):
+    """Returns the paths of the expanded project tree folders, parents before children"""
+    paths = []
+    tree = ui.projectFilesTreeWidget
+    pending = [tree.topLevelItem(i) for i in range(tree.topLevelItemCount())]
+    while pending:
+        item = pending.pop(0)
+        if item.isExpanded():
+            paths.append(ui.getTreeItemPath(item, getProductionDir()))
+            pending.extend(item.child(i) for i in range(item.childCount()))
+    return paths
+
+def _findProjectTreeItem(ui, path):
+    parts = os.path.relpath(path, getProductionDir()).split(os.sep)
+    tree = ui.projectFilesTreeWidget
+    items = [tree.topLevelItem(i) for i in range(tree.topLevelItemCount())]
+    item = None
+    for part in parts:
+        matches = [i for i in items if str(i.text(0)) == part]
+        if not matches:
+            return None
+        item = matches[0]
+        items = [item.child(i) for i in range(item.childCount())]
+    return item
+
+def populateProjectTree(ui, rescan=False):
+    """
+    Builds the top level of the project tree from the local asset index, in the background.
+    Folders below it are loaded from the index when they are expanded (see projectItemExpanded),
+    and folders that were expanded before are expanded again.
+    @param rescan: pick up changes made outside this program (only changed folders are re-read)
+    """
+    root = os.path.normpath(os.path.abspath(getProductionDir()))
+    running = _treeWorkers.get('project')
+    expanded = _expandedProjectPaths(ui)
+    if not expanded and running is not None:
+        # the tree is still being filled in by the refresh this one replaces
+        expanded = running.expanded
     ui.projectFilesTreeWidget.clear()
-    recurseProjectFiles(ui, ui.projectFilesTreeWidget, getProductionDir())
-    ui.projectFilesTreeWidget.sortItems(0,0)
 
-def recurseProjectFiles(ui, parent, curDir):
-    if isVersionedFolder(curDir):
-        setProjectTreeVersionedItemInfo(parent, curDir)
+    def addEntries(entries):
+        _addProjectTreeEntries(ui.projectFilesTreeWidget, entries)
+    def done():
+        ui.projectFilesTreeWidget.sortItems(0,0)
+        for path in expanded:
+            item = _findProjectTreeItem(ui, path)
+            if item is not None:
+                item.setExpanded(True)
+
+    worker = ProjectTreeWorker(root, rescan)
+    worker.expanded = expanded
+    _startTreeWorker(ui, 'project', worker, addEntries, done)
+
+def projectItemExpanded(ui, item):
+    """Loads the children of a project folder the first time it is expanded"""
+    if not _takePlaceholder(item):
         return
-    if os.path.isdir(curDir):
-        files = glob.glob(os.path.join(curDir, '*'))
-        for f in files:
-            item = QTreeWidgetItem(parent)
-            item.setText(0, os.path.basename(f))
-            recurseProjectFiles(ui, item, f)
+    path = ui.getTreeItemPath(item, getProductionDir())
+    # rows added while the folder was collapsed (see runNew) are already there
+    existing = set(str(item.child(i).text(0)) for i in range(item.childCount()))
+    _addProjectTreeEntries(item, getAssetIndex().children(path), existing)
+    item.sortChildren(0,0)
 
 def populateLocalTree(ui):
+    """Lists the user's checked out folders in the background"""
     ui.localFilesTreeWidget.clear()
-    files = glob.glob(os.path.join(str(getUserCheckoutDir()),'*'))
-    items = convertToLocalTreeItems(files)
-    ui.localFilesTreeWidget.addTopLevelItems(items)
-    ui.localFilesTreeWidget.sortItems(1,0)
+
+    def addFolders(folders):
+        ui.localFilesTreeWidget.addTopLevelItems(convertToLocalTreeItems(folders))
+    def done():
+        ui.localFilesTreeWidget.sortItems(1,0)
+
+    _startTreeWorker(ui, 'local', LocalTreeWorker(str(getUserCheckoutDir())), addFolders, done)
+
+#>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Background Tree Workers
+
+# the running worker of each tree; starting a new one cancels the one it replaces
+_treeWorkers = {}
+# cancelled workers are kept here until their thread has stopped
+_cancelledWorkers = []
+
+def _startTreeWorker(ui, name, worker, onBatch, onDone):
+    """
+    Runs a treeworkers.TreeWorker, handing its batches to onBatch on the GUI thread
+    and calling onDone once it has finished. Results of a cancelled worker are dropped.
+    """
+    old = _treeWorkers.get(name)
+    if old is not None:
+        old.cancel()
+        _cancelledWorkers.append(old)
+    _treeWorkers[name] = worker
+
+    def isCurrent():
+        return _treeWorkers.get(name) is worker
+    def batch(results):
+        if isCurrent():
+            onBatch(results)
+    def progress(done, total):
+        if isCurrent():
+            _showProgress(ui, done, total)
+    def failed(message):
+        if isCurrent():
+            ui.errorMessage.showMessage(message)
+    def finished():
+        if isCurrent():
+            del _treeWorkers[name]
+            if not worker.isCancelled():
+                onDone()
+        elif worker in _cancelledWorkers:
+            _cancelledWorkers.remove(worker)
+        if not _treeWorkers:
+            ui.progressBar.hide()
+            ui.statusbar.clearMessage()
+
+    QObject.connect(worker, SIGNAL('batch(PyQt_PyObject)'), batch)
+    QObject.connect(worker, SIGNAL('progress(int, int)'), progress)
+    QObject.connect(worker, SIGNAL('failed(QString)'), failed)
+    QObject.connect(worker, SIGNAL('finished()'), finished)
+    ui.statusbar.showMessage("Reading files...")
+    _showProgress(ui, 0, 0)
+    worker.start()
+
+def _showProgress(ui, done, total):
+    # a total of 0 shows a busy indicator
+    ui.progressBar.setRange(0, total)
+    ui.progressBar.setValue(done)
+    ui.progressBar.show()
 
 #>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>> Other Helper Functions
 
@@ -0,0 +1,226 @@
+"""
+This module contains the file copy engine shared by checkout, checkin and install.
+
+Files are copied concurrently on a pool of COPY_THREADS threads, so the file
+server round trips of many small files overlap. Each file's data is moved by
+the kernel (copy_file_range, or sendfile) where available; otherwise it is read
+and written in BUFFER_SIZE chunks. Permissions and mtimes are preserved.
+"""
+
+import os, time, errno, shutil, hashlib, threading
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+# files copied at once
+COPY_THREADS = 8
+# chunk size of the read/write fallback, and the most moved by one kernel call
+BUFFER_SIZE = 1 << 20
+
+def _libcFunction(name, restype, argtypes):
+	try:
+		import ctypes, ctypes.util
+		libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+		func = getattr(libc, name)
+	except (ImportError, OSError, AttributeError):
+		return None
+	func.restype = restype
+	func.argtypes = argtypes
+	return func
+
+def _kernelCopiers():
+	"""@returns: a list of copy(inFd, outFd, count) functions, best first, that return the bytes moved"""
+	copiers = []
+	if hasattr(os, 'copy_file_range'):
+		copiers.append(('copy_file_range', lambda inFd, outFd, count: os.copy_file_range(inFd, outFd, count)))
+	if hasattr(os, 'sendfile'):
+		copiers.append(('sendfile', lambda inFd, outFd, count: os.sendfile(outFd, inFd, None, count)))
+	if copiers:
+		return copiers
+	# Python 2: call libc directly
+	import ctypes
+	copyFileRange = _libcFunction('copy_file_range', ctypes.c_ssize_t,
+		[ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint])
+	if copyFileRange is not None:
+		def viaCopyFileRange(inFd, outFd, count):
+			moved = copyFileRange(inFd, None, outFd, None, count, 0)
+			if moved < 0:
+				e = ctypes.get_errno()
+				raise OSError(e, os.strerror(e))
+			return moved
+		copiers.append(('copy_file_range', viaCopyFileRange))
+	sendfile = _libcFunction('sendfile', ctypes.c_ssize_t, [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t])
+	if sendfile is not None:
+		def viaSendfile(inFd, outFd, count):
+			moved = sendfile(outFd, inFd, None, count)
+			if moved < 0:
+				e = ctypes.get_errno()
+				raise OSError(e, os.strerror(e))
+			return moved
+		copiers.append(('sendfile', viaSendfile))
+	return copiers
+
+# found on first use: looking them up loads ctypes and searches for libc
+_copiers = None
+_copiersLock = threading.Lock()
+
+def _getCopiers():
+	global _copiers
+	if _copiers is not None:
+		return _copiers
+	with _copiersLock:
+		if _copiers is None:
+			_copiers = _kernelCopiers()
+		return _copiers
+
+# errors meaning a kernel copy can not be used for this pair of files
+_UNSUPPORTED = set([errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF])
+
+def getCopyMethods():
+	"""@returns: the names of the kernel copy calls available, best first"""
+	return [name for name, copier in _getCopiers()]
+
+class CopyStats(namedtuple('CopyStats', ['files', 'bytes', 'seconds'])):
+	def throughput(self):
+		"""@returns: bytes per second"""
+		if not self.seconds:
+			return 0.0
+		return self.bytes / self.seconds
+
+	def summary(self):
+		return '%d files, %.1f MB in %.2f s (%.1f MB/s)' % (self.files, self.bytes / 1048576.0,
+			self.seconds, self.throughput() / 1048576.0)
+
+def _copyData(inFd, outFd, size):
+	for name, copier in _getCopiers():
+		try:
+			done = 0
+			while done < size:
+				moved = copier(inFd, outFd, min(size - done, BUFFER_SIZE))
+				if moved == 0:
+					# the file shrank while it was copied
+					break
+				done += moved
+			return
+		except OSError as e:
+			if e.errno not in _UNSUPPORTED or done:
+				raise
+	_readWrite(inFd, outFd)
+
+def _readWrite(inFd, outFd, hasher=None):
+	"""Copies the rest of inFd to outFd through user space, feeding the data to hasher if given"""
+	while True:
+		data = os.read(inFd, BUFFER_SIZE)
+		if not data:
+			break
+		if hasher is not None:
+			hasher.update(data)
+		while data:
+			written = os.write(outFd, data)
+			data = data[written:]
+
+def copyFile(src, dst):
+	"""
+	Copies the file src to dst, with its permissions and mtime (like shutil.copy2).
+	@returns: the number of bytes copied
+	"""
+	inFd = os.open(src, os.O_RDONLY)
+	try:
+		size = os.fstat(inFd).st_size
+		outFd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+		try:
+			_copyData(inFd, outFd, size)
+		finally:
+			os.close(outFd)
+	finally:
+		os.close(inFd)
+	shutil.copystat(src, dst)
+	return size
+
+def copyFileHashed(src, dst, algorithm='sha256'):
+	"""
+	Copies src to dst like copyFile(), hashing the data on its way through, so src is read once.
+	@returns: (the number of bytes copied, the hex digest of the data)
+	"""
+	hasher = hashlib.new(algorithm)
+	inFd = os.open(src, os.O_RDONLY)
+	try:
+		outFd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+		try:
+			_readWrite(inFd, outFd, hasher)
+			size = os.fstat(outFd).st_size
+		finally:
+			os.close(outFd)
+	finally:
+		os.close(inFd)
+	shutil.copystat(src, dst)
+	return size, hasher.hexdigest()
+
+_pool = None
+_poolLock = threading.Lock()
+
+def _getPool():
+	global _pool
+	with _poolLock:
+		if _pool is None:
+			_pool = ThreadPool(COPY_THREADS)
+		return _pool
+
+def copyFiles(pairs, progress=None, copy=copyFile):
+	"""
+	Copies the files of pairs concurrently.
+	@param pairs: (src, dst) of each file; the destination folders must exist
+	@param progress: called as progress(bytes done, bytes total) as files finish,
+		from the copying threads
+	@param copy: called as copy(src, dst) for each pair, returning the bytes it copied
+	@returns: a CopyStats of the run
+	"""
+	pairs = list(pairs)
+	start = time.time()
+	total = 0
+	if progress is not None:
+		for src, dst in pairs:
+			try:
+				total += os.path.getsize(src)
+			except OSError:
+				pass
+	state = {'bytes': 0}
+	lock = threading.Lock()
+	def copyOne(pair):
+		copied = copy(pair[0], pair[1])
+		with lock:
+			state['bytes'] += copied
+			done = state['bytes']
+		if progress is not None:
+			progress(done, total)
+		return copied
+	if len(pairs) < 2:
+		map(copyOne, pairs)
+	else:
+		_getPool().map(copyOne, pairs)
+	return CopyStats(len(pairs), state['bytes'], time.time() - start)
+
+def copyTree(src, dst, progress=None, copy=copyFile):
+	"""
+	Copies the directory src to dst (which must not exist) like shutil.copytree,
+	copying the files concurrently (see copyFiles()).
+	@returns: a CopyStats of the run
+	"""
+	pairs = []
+	for dirPath, dirNames, fileNames in os.walk(src):
+		relDir = os.path.relpath(dirPath, src)
+		destDir = dst if relDir == '.' else os.path.join(dst, relDir)
+		os.makedirs(destDir)
+		for name in list(dirNames):
+			if os.path.islink(os.path.join(dirPath, name)):
+				dirNames.remove(name)
+				fileNames.append(name)
+		for name in fileNames:
+			srcPath = os.path.join(dirPath, name)
+			if os.path.islink(srcPath):
+				os.symlink(os.readlink(srcPath), os.path.join(destDir, name))
+			else:
+				pairs.append((srcPath, os.path.join(destDir, name)))
+	stats = copyFiles(pairs, progress, copy)
+	for dirPath, dirNames, fileNames in os.walk(src):
+		shutil.copystat(dirPath, os.path.join(dst, os.path.relpath(dirPath, src)))
+	return stats
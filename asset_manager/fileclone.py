@@ -0,0 +1,146 @@
+"""
+This module contains the ways a version folder can be copied into a checkout.
+
+	reflink		FICLONE copy-on-write clones: only metadata is written, and the
+				checkout gets its own copy of a block when it is modified
+	hardlink	files the artist does not save over (textures, caches, ...) are hard
+				linked and made read-only; scene files are copied
+	copy		a plain copy of every file
+
+Hard links are only made for read-only checkouts (checkouts that do not lock):
+a link shares its inode with the version and the blob store, and read-only is
+only a permission its owner can change back, after which writing to the file
+would change every version and checkout that shares it. A writable checkout
+gets a plain copy of whatever can not be reflinked.
+
+The mode is chosen with RELIC_CHECKOUT_MODE ('auto' by default). In auto mode the
+first files of a tree are used to find out what the file systems support, and the
+answer is remembered for that pair of devices.
+"""
+
+import os, stat, shutil, errno, fcntl, threading
+
+import copyengine
+
+MODES = ('reflink', 'hardlink', 'copy')
+
+# _IOW(0x94, 9, int), from linux/fs.h
+FICLONE = 0x40049409
+
+# files the artist saves over in the checkout; these are never hard linked
+SCENE_EXTENSIONS = ('.mb', '.ma', '.hip', '.hipnc', '.hiplc', '.nk', '.blend', '.psd')
+
+# errors meaning the file system (pair) can not clone or link, rather than a real failure
+_UNSUPPORTED = set([errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EPERM, errno.ENOSYS, errno.EMLINK])
+
+# (source device, destination device) -> the best mode that worked
+_detected = {}
+_detectedLock = threading.Lock()
+
+def getCheckoutMode():
+	mode = os.environ.get('RELIC_CHECKOUT_MODE', 'auto')
+	if mode != 'auto' and mode not in MODES:
+		raise Exception("Unknown checkout mode " + mode + ", expected auto or one of " + ', '.join(MODES))
+	return mode
+
+def isSceneFile(path):
+	return os.path.splitext(path)[1].lower() in SCENE_EXTENSIONS
+
+def reflinkFile(src, dst):
+	"""Clones src to dst with FICLONE, raises IOError/OSError if the file systems can not"""
+	srcFd = os.open(src, os.O_RDONLY)
+	try:
+		dstFd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+		try:
+			fcntl.ioctl(dstFd, FICLONE, srcFd)
+		except (IOError, OSError):
+			os.close(dstFd)
+			os.remove(dst)
+			raise
+		os.close(dstFd)
+	finally:
+		os.close(srcFd)
+	shutil.copystat(src, dst)
+
+def hardlinkFile(src, dst):
+	"""
+	Hard links src to dst and removes its write permission (shared with src).
+	This does not protect src: whoever owns the inode can make it writable again
+	(see the module docstring), so it is only used for read-only checkouts.
+	"""
+	os.link(src, dst)
+	mode = stat.S_IMODE(os.stat(dst).st_mode)
+	readOnly = mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+	if readOnly != mode:
+		os.chmod(dst, readOnly)
+
+def copyFile(src, dst):
+	copyengine.copyFile(src, dst)
+
+def deviceKey(srcDir, dstDir):
+	"""@returns: the key cloneFile() remembers what works under, for copies from srcDir into dstDir"""
+	return (os.stat(srcDir).st_dev, os.stat(dstDir).st_dev)
+
+def detectedMode(srcDir, dstDir):
+	"""@returns: the mode auto mode uses for copies from srcDir into dstDir, as far as it has found out"""
+	with _detectedLock:
+		return _detected.get(deviceKey(srcDir, dstDir), 'reflink')
+
+def cloneFile(src, dst, mode, key, copy=copyFile, writable=True):
+	"""
+	Copies the file src to dst with mode, falling back (and remembering it for key) if it is not supported.
+	@param mode: 'auto' or one of MODES
+	@param key: see deviceKey()
+	@param copy: called as copy(src, dst) for the files that are plainly copied
+	@param writable: if True, dst will be worked in and is copied rather than hard linked
+	@returns: the mode that was used
+	"""
+	if mode == 'auto':
+		with _detectedLock:
+			mode = _detected.get(key, 'reflink')
+	if mode == 'reflink':
+		try:
+			reflinkFile(src, dst)
+			return 'reflink'
+		except (IOError, OSError) as e:
+			if e.errno not in _UNSUPPORTED:
+				raise
+			mode = _fallBack(key, 'hardlink')
+	if mode == 'hardlink' and writable:
+		mode = 'copy'
+	if mode == 'hardlink':
+		if isSceneFile(src):
+			copy(src, dst)
+			return 'hardlink'
+		try:
+			hardlinkFile(src, dst)
+			return 'hardlink'
+		except OSError as e:
+			if e.errno not in _UNSUPPORTED:
+				raise
+			mode = _fallBack(key, 'copy')
+	copy(src, dst)
+	return 'copy'
+
+def _fallBack(key, mode):
+	with _detectedLock:
+		_detected[key] = mode
+	return mode
+
+def cloneTree(src, dst, mode=None, progress=None, writable=True):
+	"""
+	Copies the directory src to dst (which must not exist) like shutil.copytree,
+	using mode for the files (see the module docstring), several files at a time.
+	A mode the file systems do not support falls back to the next one, down to a plain copy.
+	@param mode: 'auto' or one of MODES; getCheckoutMode() if not given
+	@param progress: see copyengine.copyFiles()
+	@param writable: see cloneFile()
+	@returns: a copyengine.CopyStats of the run
+	"""
+	if mode is None:
+		mode = getCheckoutMode()
+	key = deviceKey(src, os.path.dirname(os.path.abspath(dst)))
+	def clone(srcPath, dstPath):
+		cloneFile(srcPath, dstPath, mode, key, writable=writable)
+		return os.path.getsize(dstPath)
+	return copyengine.copyTree(src, dst, progress, clone)
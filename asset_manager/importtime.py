@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""
+This module measures what importing the asset manager costs, like python -X importtime
+(which Python 2 does not have): each module is imported in a fresh interpreter, so
+the times are those of a cold start.
+
+	python importtime.py <module> ...		the import tree of each module, in -X importtime format
+	python importtime.py check [<module> ...]	import times against BUDGETS
+
+check imports each module RUNS times and compares the median with its budget; the
+exit status is 1 if any module is over, so it can gate a release. Set
+RELIC_IMPORT_BUDGET_SCALE to scale the budgets for slower machines (2 doubles them).
+Modules whose dependencies are not installed (PyQt4, Maya) are skipped.
+"""
+
+import os, sys, time, json, subprocess, __builtin__
+
+# module -> cold import budget, in ms
+BUDGETS = [
+	('relic', 15),
+	('utilities', 40),
+	('checkinjobs', 25),
+	('metadaemon', 30),
+	('controller', 400),
+]
+
+RUNS = 5
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+
+def getBudgetScale():
+	return float(os.environ.get('RELIC_IMPORT_BUDGET_SCALE', 1))
+
+def profile(module):
+	"""
+	Imports module (in this process, so it must not be imported yet) and times every import it makes.
+	@returns: (self us, cumulative us, depth, name) of each module imported, in the order they finished
+	"""
+	rows = []
+	stack = [0]
+	original = __builtin__.__import__
+
+	def timedImport(name, globals=None, locals=None, fromlist=None, level=-1):
+		if name in sys.modules:
+			return original(name, globals, locals, fromlist, level)
+		stack.append(0)
+		start = time.time()
+		try:
+			return original(name, globals, locals, fromlist, level)
+		finally:
+			cumulative = (time.time() - start) * 1e6
+			children = stack.pop()
+			stack[-1] += cumulative
+			rows.append((cumulative - children, cumulative, len(stack) - 1, name))
+
+	__builtin__.__import__ = timedImport
+	try:
+		__import__(module)
+	finally:
+		__builtin__.__import__ = original
+	return rows
+
+def _child(args):
+	"""Runs python importtime.py with args in a fresh interpreter; @returns: its parsed output"""
+	process = subprocess.Popen([sys.executable, os.path.join(_HERE, 'importtime.py')] + args,
+		stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=_HERE)
+	output, errors = process.communicate()
+	if process.returncode != 0:
+		# the last line of the traceback says why
+		raise ImportError((errors.strip().splitlines() or [' '.join(args)])[-1])
+	return json.loads(output)
+
+def coldProfile(module):
+	return _child(['--profile', module])
+
+def coldImportTime(module):
+	"""@returns: the seconds importing module takes in a fresh interpreter"""
+	return _child(['--time', module])
+
+def check(modules=None, runs=RUNS):
+	"""
+	Compares the median cold import time of each module with its budget (see BUDGETS).
+	@returns: (module, median ms or why it can not be imported here, budget ms) of each
+	"""
+	scale = getBudgetScale()
+	results = []
+	for module, budget in BUDGETS:
+		if modules and module not in modules:
+			continue
+		try:
+			times = sorted(coldImportTime(module) for i in range(runs))
+		except ImportError as e:
+			results.append((module, str(e), budget * scale))
+			continue
+		results.append((module, times[len(times) / 2] * 1000, budget * scale))
+	return results
+
+if __name__ == '__main__':
+	args = sys.argv[1:]
+	sys.path.insert(0, _HERE)
+	if len(args) == 2 and args[0] == '--profile':
+		print json.dumps(profile(args[1]))
+	elif len(args) == 2 and args[0] == '--time':
+		start = time.time()
+		__import__(args[1])
+		print json.dumps(time.time() - start)
+	elif args and args[0] == 'check':
+		over = 0
+		for module, ms, budget in check(args[1:]):
+			if isinstance(ms, str):
+				print '%-15s skipped: %s' % (module, ms)
+				continue
+			status = 'ok' if ms <= budget else 'OVER BUDGET'
+			over += ms > budget
+			print '%-15s %7.1f ms  budget %5.0f ms  %s' % (module, ms, budget, status)
+		sys.exit(1 if over else 0)
+	elif args and not args[0].startswith('-'):
+		for module in args:
+			print 'import time: self [us] | cumulative | imported package'
+			for own, cumulative, depth, name in coldProfile(module):
+				print 'import time: %9d | %10d | %s%s' % (own, cumulative, '  ' * depth, name)
+	else:
+		print 'usage: importtime.py <module> ... | check [<module> ...]'
+		sys.exit(2)
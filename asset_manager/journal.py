@@ -0,0 +1,184 @@
+"""
+This module contains the intent journal that makes checkins recoverable.
+
+A checkin records what it is about to do in the .intent file of the versioned
+folder before it touches anything, and the step it has reached after each one:
+
+	stage		the files are being stored into a hidden staging folder in src/
+	published	the staging folder has been renamed to src/vNNN (atomically)
+	committed	.nodeInfo names the new version and is unlocked; the working copy
+				is being removed
+
+If the process dies, recover() looks at the intent and the step and either rolls
+back (an unpublished checkin: the staging folder is removed, and the folder stays
+locked by and checked out to the artist, as before the checkin) or rolls forward
+(a published one is committed and cleaned up). Run it with
+
+	python journal.py recover [--force] [<root> ...]
+
+An intent is only recovered once it is stale, or --force is given. On the host
+that recorded it, it is stale when its process is gone or is not running it any
+more: a checkin that failed in a long running process (Maya) is recovered by the
+next checkin from that process, and a process that got the pid of the dead one
+(told apart by its start time) does not keep it. An intent from another host is
+stale after RELIC_RECOVER_AFTER seconds (3600 by default).
+"""
+
+import os, sys, time, json, errno, socket, shutil, threading
+
+import nodeinfo, walker
+
+INTENT_FILE = '.intent'
+
+STAGE = 'stage'
+PUBLISHED = 'published'
+COMMITTED = 'committed'
+
+# the intents whose operation is running in this process, by _key()
+_running = set()
+_runningLock = threading.Lock()
+
+def _key(intent):
+	return (intent['host'], intent['pid'], intent['started'])
+
+def _processStart(pid):
+	"""@returns: when the process pid started (clock ticks after boot), or None if that can not be told"""
+	try:
+		f = open('/proc/%d/stat' % pid, 'rb')
+	except IOError:
+		return None
+	try:
+		data = f.read()
+	finally:
+		f.close()
+	try:
+		# after the command name, which is in parentheses and may contain anything
+		return int(data[data.rindex(')') + 2:].split()[19])
+	except (ValueError, IndexError):
+		return None
+
+def _intentPath(dirPath):
+	return os.path.join(dirPath, INTENT_FILE)
+
+def _write(dirPath, intent):
+	nodeinfo.atomicWrite(_intentPath(dirPath), json.dumps(intent, sort_keys=True))
+
+def begin(dirPath, operation, **fields):
+	"""
+	Records the intent to run operation on the versioned folder dirPath, at its first step.
+	@returns: the intent (a dict of fields, with operation, step, host, pid and started)
+	"""
+	intent = dict(fields)
+	intent.update(operation=operation, step=STAGE, host=socket.gethostname(), pid=os.getpid(),
+		pidStart=_processStart(os.getpid()), started=time.time())
+	with _runningLock:
+		_running.add(_key(intent))
+	_write(dirPath, intent)
+	return intent
+
+def end(intent):
+	"""
+	Records that this process is no longer running the operation of intent, finished or not;
+	an intent that has not been cleared can be recovered from then on
+	"""
+	with _runningLock:
+		_running.discard(_key(intent))
+
+def advance(dirPath, intent, step):
+	intent['step'] = step
+	_write(dirPath, intent)
+
+def read(dirPath):
+	"""@returns: the unfinished intent of dirPath, or None"""
+	try:
+		f = open(_intentPath(dirPath), 'rb')
+	except IOError:
+		return None
+	try:
+		return json.load(f)
+	finally:
+		f.close()
+
+def clear(dirPath):
+	try:
+		os.remove(_intentPath(dirPath))
+	except OSError as e:
+		if e.errno != errno.ENOENT:
+			raise
+
+def getRecoverAfter():
+	return float(os.environ.get('RELIC_RECOVER_AFTER', 3600))
+
+def _isSameProcess(intent):
+	"""@returns: False if the process with intent's pid is not the one that recorded it (the pid was reused)"""
+	if intent.get('pidStart') is None:
+		return True
+	started = _processStart(intent['pid'])
+	return started is None or started == intent['pidStart']
+
+def isStale(intent):
+	"""@returns: True if the process that recorded intent can no longer be running it"""
+	if intent['host'] != socket.gethostname():
+		return time.time() - intent['started'] > getRecoverAfter()
+	if intent['pid'] == os.getpid() and _isSameProcess(intent):
+		with _runningLock:
+			return _key(intent) not in _running
+	try:
+		os.kill(intent['pid'], 0)
+	except OSError as e:
+		if e.errno != errno.EPERM:
+			return True
+	return not _isSameProcess(intent)
+
+def recover(dirPath, force=False):
+	"""
+	Finishes or rolls back the interrupted operation on the versioned folder dirPath.
+	@returns: what was done, or None if there was nothing (stale) to recover
+	"""
+	import utilities
+	intent = read(dirPath)
+	if intent is None or not (force or isStale(intent)):
+		return None
+	version = intent['version']
+	versionPath = os.path.join(dirPath, 'src', nodeinfo.versionName(version))
+	staging = intent['staging']
+	if intent['step'] == STAGE:
+		if os.path.isdir(staging) or not os.path.isdir(versionPath):
+			shutil.rmtree(staging, ignore_errors=True)
+			clear(dirPath)
+			return 'rolled back the checkin of ' + nodeinfo.versionName(version)
+		# died between the rename and recording it
+		intent['step'] = PUBLISHED
+	if intent['step'] == PUBLISHED:
+		nodeInfo = nodeinfo.NodeInfo.load(dirPath)
+		if nodeInfo.latestVersion < version:
+			utilities._commitCheckin(nodeInfo, version, intent.get('comment'), intent.get('user'))
+		advance(dirPath, intent, COMMITTED)
+	utilities._removeWorkingCopy(intent['toCheckin'], dirPath)
+	clear(dirPath)
+	return 'finished the checkin of ' + nodeinfo.versionName(version)
+
+def recoverTree(root, force=False):
+	"""
+	Recovers every versioned folder below root with an interrupted operation.
+	@returns: (versioned folder, what was done) of each
+	"""
+	recovered = []
+	for listing in walker.walk(root):
+		if INTENT_FILE in listing.names:
+			done = recover(listing.path, force)
+			if done is not None:
+				recovered.append((listing.path, done))
+	return recovered
+
+if __name__ == '__main__':
+	args = sys.argv[1:]
+	if args and args[0] == 'recover':
+		force = '--force' in args
+		roots = [a for a in args[1:] if a != '--force'] or [os.environ['PRODUCTION_DIR']]
+		for root in roots:
+			for dirPath, done in recoverTree(root, force):
+				print dirPath + ': ' + done
+	else:
+		print 'usage: journal.py recover [--force] [<root> ...]'
+		sys.exit(2)
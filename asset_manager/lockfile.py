@@ -0,0 +1,247 @@
+"""
+This module contains the lock that gives one artist at a time a versioned folder.
+
+The lock is the .lock file of the versioned folder, created with O_CREAT | O_EXCL:
+the file system grants it to exactly one of any number of racing clients, with
+no global mutex, so checkout takes it before copying anything. The file records
+who holds it (user, host, pid, time) and a token identifying this grant.
+
+.nodeInfo's locked flag is still written for the tools that display it and for
+older copies of the tools. A lock file whose folder is not marked locked, and
+that is older than RELIC_LOCK_GRACE seconds (600 by default, longer than any
+checkout copy), was left by a checkout that died or released by older tools; it
+is broken by the next acquire().
+
+A lock is a lease: it expires RELIC_LEASE_TTL seconds (900 by default, 0 for
+never) after it was taken or last renewed, and the session holding it renews it
+in the background (see LeaseHeartbeat). Nothing sweeps expired leases: a lock
+whose lease has run out is simply not held any more when it is read, and the
+next acquire() breaks it; it can not be renewed any more. Renewing and breaking
+take turns through the .lock.break file, so a lock is never renewed and broken
+at once.
+"""
+
+import os, time, json, errno, socket, threading
+
+from nodeinfo import NodeInfo
+
+LOCK_FILE = '.lock'
+
+# the seconds renew() waits for a client breaking the lock
+RENEW_WAIT = 2.0
+
+def _lockPath(dirPath):
+	return os.path.join(dirPath, LOCK_FILE)
+
+def getGrace():
+	return float(os.environ.get('RELIC_LOCK_GRACE', 600))
+
+def getLeaseTime():
+	"""@returns: the seconds a lease lasts without being renewed, 0 if leases never expire"""
+	return float(os.environ.get('RELIC_LEASE_TTL', 900))
+
+def _expires():
+	leaseTime = getLeaseTime()
+	if leaseTime <= 0:
+		return None
+	return time.time() + leaseTime
+
+def newToken():
+	return '%s-%d-%s' % (socket.gethostname(), os.getpid(), os.urandom(8).encode('hex'))
+
+def owner(dirPath):
+	"""@returns: the lock record of dirPath (user, host, pid, time, expires, token), or None if it is not locked"""
+	try:
+		f = open(_lockPath(dirPath), 'rb')
+	except IOError:
+		return None
+	try:
+		data = f.read()
+		created = os.fstat(f.fileno()).st_mtime
+	finally:
+		f.close()
+	try:
+		return json.loads(data)
+	except ValueError:
+		# created but not written yet (or lost in a crash): the file itself is the lock
+		return {'user': None, 'host': None, 'pid': None, 'time': created, 'expires': None, 'token': None}
+
+def _create(dirPath, record):
+	try:
+		fd = os.open(_lockPath(dirPath), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0664)
+	except OSError as e:
+		if e.errno == errno.EEXIST:
+			return False
+		raise
+	try:
+		# not fsync'ed: the record only says who holds the lock, the file's existence is the lock
+		os.write(fd, json.dumps(record, sort_keys=True))
+	finally:
+		os.close(fd)
+	return True
+
+def isStale(dirPath, record):
+	"""@returns: True if the lease of the lock record of dirPath has expired, or it was left behind (see the module docstring)"""
+	if record.get('expires') is not None:
+		return time.time() >= record['expires']
+	if time.time() - record['time'] < getGrace():
+		return False
+	try:
+		return not NodeInfo.load(dirPath).locked
+	except Exception:
+		return False
+
+def _takeBreak(dirPath):
+	"""
+	Creates the .lock.break file of dirPath, with O_EXCL: whoever has it is the only one
+	changing an existing lock file (breaking it, or renewing its lease).
+	@returns: its path, or None if another client has it
+	"""
+	breakPath = _lockPath(dirPath) + '.break'
+	try:
+		fd = os.open(breakPath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0664)
+	except OSError as e:
+		if e.errno != errno.EEXIST:
+			raise
+		# a break file left by a client that died goes after the grace period
+		try:
+			if time.time() - os.stat(breakPath).st_mtime > getGrace():
+				os.remove(breakPath)
+		except OSError:
+			pass
+		return None
+	os.close(fd)
+	return breakPath
+
+def _breakStale(dirPath, record):
+	"""
+	Removes the lock file of dirPath if it still holds the stale record, and it is still stale;
+	see _takeBreak(): none of the breakers can remove a lock granted or renewed since.
+	@returns: True if the lock file is gone
+	"""
+	breakPath = _takeBreak(dirPath)
+	if breakPath is None:
+		return False
+	try:
+		current = owner(dirPath)
+		if current is None:
+			return True
+		if current.get('token') != record.get('token') or not isStale(dirPath, current):
+			return False
+		os.remove(_lockPath(dirPath))
+		return True
+	finally:
+		os.remove(breakPath)
+
+def acquire(dirPath, user):
+	"""
+	Locks dirPath for user, atomically.
+	@returns: the token of the grant, or None if somebody else holds the lock
+	"""
+	record = {'user': user, 'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time(),
+		'expires': _expires(), 'token': newToken()}
+	if _create(dirPath, record):
+		return record['token']
+	held = owner(dirPath)
+	if held is not None and isStale(dirPath, held) and _breakStale(dirPath, held):
+		record['time'] = time.time()
+		record['expires'] = _expires()
+		if _create(dirPath, record):
+			return record['token']
+	return None
+
+def release(dirPath, user=None, token=None):
+	"""Unlocks dirPath; only if the lock is held by user, or is still the grant token, if given"""
+	if user is not None or token is not None:
+		held = owner(dirPath)
+		if held is None:
+			return
+		if user is not None and held.get('user') != user:
+			return
+		if token is not None and held.get('token') != token:
+			return
+	try:
+		os.remove(_lockPath(dirPath))
+	except OSError as e:
+		if e.errno != errno.ENOENT:
+			raise
+
+def isHeld(dirPath):
+	held = owner(dirPath)
+	return held is not None and not isStale(dirPath, held)
+
+def remaining(record):
+	"""@returns: the seconds left on the lease of the lock record, or None if it does not expire"""
+	if record.get('expires') is None:
+		return None
+	return max(0.0, record['expires'] - time.time())
+
+def renew(dirPath, user=None, token=None, wait=RENEW_WAIT):
+	"""
+	Extends the lease on dirPath by getLeaseTime(), if the lock is still held by user
+	(and is still the grant token, if given). A lease that has expired is not renewed:
+	anybody may be breaking it (see _breakStale()).
+	@param wait: the seconds to wait for a client breaking the lock (see _takeBreak())
+	@returns: the new expiry time (inf if leases never expire), or None if the lock is not ours (any more)
+	"""
+	deadline = time.time() + wait
+	breakPath = _takeBreak(dirPath)
+	while breakPath is None:
+		if time.time() >= deadline:
+			return None
+		time.sleep(0.05)
+		breakPath = _takeBreak(dirPath)
+	try:
+		try:
+			fd = os.open(_lockPath(dirPath), os.O_RDWR)
+		except OSError as e:
+			if e.errno == errno.ENOENT:
+				return None
+			raise
+		try:
+			# rewritten in place: the lock file must never be missing, or somebody else could take it
+			data = os.read(fd, 65536)
+			try:
+				record = json.loads(data)
+			except ValueError:
+				return None
+			if user is not None and record.get('user') != user:
+				return None
+			if token is not None and record.get('token') != token:
+				return None
+			if isStale(dirPath, record):
+				return None
+			record['expires'] = _expires()
+			data = json.dumps(record, sort_keys=True)
+			os.lseek(fd, 0, os.SEEK_SET)
+			os.write(fd, data)
+			os.ftruncate(fd, len(data))
+		finally:
+			os.close(fd)
+	finally:
+		os.remove(breakPath)
+	return record['expires'] or float('inf')
+
+class LeaseHeartbeat(threading.Thread):
+	"""
+	Calls renewAll() in the background every third of the lease time, so the leases it
+	renews outlive the session only by one lease time. Errors are printed and retried.
+	"""
+	def __init__(self, renewAll, interval=None):
+		threading.Thread.__init__(self, name='LeaseHeartbeat')
+		self.daemon = True
+		self.renewAll = renewAll
+		if interval is None:
+			interval = max(1.0, getLeaseTime() / 3)
+		self.interval = interval
+		self._stopped = threading.Event()
+
+	def run(self):
+		while not self._stopped.wait(self.interval):
+			try:
+				self.renewAll()
+			except Exception as e:
+				print "lockfile: could not renew leases: " + str(e)
+
+	def stop(self):
+		self._stopped.set()
@@ -6,9 +6,10 @@ import os
 import subprocess as sp
 import sys
 import shutil
-from pymel.core import *
+import maya.mel as mel
 
 from ui_tools import ui, messageSeverity, fileMode
+import copyengine
 
 def objExport(selected, path):
 	'''
@@ -59,7 +60,7 @@ def abcExport(selected, path):
 
 	abcfiles = []
 	
-	loadPlugin("AbcExport")
+	mc.loadPlugin("AbcExport", quiet=True)
 	for geo in selected:
 		chop = geo.rfind('|')
 		parent_geo = geo[:chop]
@@ -69,7 +70,7 @@ def abcExport(selected, path):
 		print abcFilePath
 		command = "AbcExport -j \"-frameRange 1 1 -root "+parent_geo+" -nn -uv -file "+abcFilePath+"\";"
 		print command
-		Mel.eval(command)
+		mel.eval(command)
 		abcfiles.append(abcFilePath)
 	
 	return abcfiles
@@ -194,13 +195,13 @@ def installGeometry(path=''):
 
 	print 'Copying '+srcOBJ+' to '+destOBJ
 	try:
-		shutil.copytree(srcOBJ, destOBJ)
+		print copyengine.copyTree(srcOBJ, destOBJ).summary()
 	except Exception as e:
 		print e
 
 	print 'Copying '+srcBJSON+' to '+destBJSON
 	try:
-		shutil.copytree(src=srcBJSON, dst=destBJSON)
+		print copyengine.copyTree(srcBJSON, destBJSON).summary()
 	except Exception as e:
 		print e
 
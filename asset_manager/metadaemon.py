@@ -0,0 +1,304 @@
+"""
+This module contains the optional metadata daemon of a workstation.
+
+The daemon keeps one warm cache of the parsed metadata files (.nodeInfo and
+.checkoutInfo) for every process of the user on the workstation, so several Maya
+sessions and the asset manager do not each read them from the file server again.
+Clients talk to it over a Unix domain socket, one JSON request and one JSON
+response per line; a file that is read follows its response as raw bytes:
+
+	{"op": "read", "path": ...}				-> {"ok": true, "size": N} and N bytes, or {"ok": true, "missing": true}
+	{"op": "write", "path": ..., "data": ..., "expected": tag}	-> {"ok": true}, or {"ok": false, "conflict": true}
+	{"op": "stats"} / {"op": "ping"} / {"op": "shutdown"}
+
+Reads are still checked against the file's signature (see nodeinfo.NodeInfoCache),
+so changes made from other workstations are seen. Writes from all clients are
+made one at a time, through to the file server, and update the cache. A write
+with an expected tag (see nodeinfo.writeDocument()) is only made if the file still
+holds the contents the client read: checked and written under the same lock, so
+two sessions changing the same .nodeInfo never lose each other's changes.
+
+The socket is RELIC_DAEMON_SOCKET (/tmp/relic-meta-$USER.sock by default). Clients
+only talk to a daemon run by their own user (checked with SO_PEERCRED, or the owner
+of the socket file where the credentials are not available). When no such daemon is
+listening, clients read and write the files directly and try the daemon again after
+RELIC_DAEMON_RETRY seconds (30 by default); RELIC_DAEMON=0 turns the client off.
+A write the daemon did not confirm in RELIC_DAEMON_TIMEOUT seconds (5 by default)
+is not made directly: it raises nodeinfo.UnconfirmedWrite. Start the daemon with
+
+	python metadaemon.py serve
+"""
+
+import os, sys, time, json, errno, struct, socket, threading, SocketServer
+
+import nodeinfo
+
+DEFAULT_ENTRIES = 65536
+
+def getSocketPath():
+	if 'RELIC_DAEMON_SOCKET' in os.environ:
+		return os.environ['RELIC_DAEMON_SOCKET']
+	return os.path.join('/tmp', 'relic-meta-' + os.environ.get('USER', 'unknown') + '.sock')
+
+def getRetry():
+	return float(os.environ.get('RELIC_DAEMON_RETRY', 30))
+
+def getTimeout():
+	return float(os.environ.get('RELIC_DAEMON_TIMEOUT', 5))
+
+def isEnabled():
+	return os.environ.get('RELIC_DAEMON', '1') != '0'
+
+################################################################################
+# Daemon
+################################################################################
+class _Handler(SocketServer.StreamRequestHandler):
+	def handle(self):
+		# a client keeps its connection open for many requests
+		while True:
+			line = self.rfile.readline()
+			if not line:
+				return
+			request = None
+			try:
+				request = json.loads(line)
+				response = self.server.dispatch(request)
+			except Exception as e:
+				response = {'ok': False, 'error': str(e) or e.__class__.__name__}
+			data = response.pop('data', '')
+			self.wfile.write(json.dumps(response, separators=(',', ':')) + '\n' + data)
+			self.wfile.flush()
+			if response.get('ok') and request.get('op') == 'shutdown':
+				# after answering: shutdown() waits for serve_forever() to return
+				threading.Thread(target=self.server.shutdown).start()
+				return
+
+class MetadataDaemon(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+	daemon_threads = True
+
+	def __init__(self, socketPath=None, maxEntries=DEFAULT_ENTRIES):
+		if socketPath is None:
+			socketPath = getSocketPath()
+		self.socketPath = socketPath
+		# the files are kept as they are on disk: clients parse them, the daemon only serves them
+		self.cache = nodeinfo.NodeInfoCache(maxEntries, parse=lambda data, filePath: data)
+		self.writes = 0
+		self.conflicts = 0
+		self.started = time.time()
+		self._writeLock = threading.Lock()
+		_removeStaleSocket(socketPath)
+		SocketServer.UnixStreamServer.__init__(self, socketPath, _Handler)
+		# the daemon reads and writes as its user: nobody else may talk to it
+		os.chmod(socketPath, 0600)
+
+	def dispatch(self, request):
+		op = request.get('op')
+		if op == 'read':
+			return self.read(request['path'])
+		if op == 'write':
+			return self.write(request['path'], request['data'], request.get('expected'))
+		if op == 'stats':
+			stats = self.cache.stats()
+			stats.update(writes=self.writes, conflicts=self.conflicts, uptime=time.time() - self.started, ok=True)
+			return stats
+		if op == 'ping':
+			return {'ok': True, 'pid': os.getpid()}
+		if op == 'shutdown':
+			return {'ok': True}
+		raise Exception("Unknown request " + str(op))
+
+	def read(self, filePath):
+		data = self.cache.get(filePath)
+		if data is None:
+			return {'ok': True, 'missing': True}
+		return {'ok': True, 'size': len(data), 'data': data}
+
+	def write(self, filePath, data, expected=None):
+		data = data.encode('utf-8')
+		with self._writeLock:
+			# read from the file, not the cache: it may have been written without the daemon
+			if expected is not None and nodeinfo.readTag(filePath) != expected:
+				self.conflicts += 1
+				return {'ok': False, 'conflict': True, 'error': filePath + " was changed by someone else meanwhile; try again"}
+			nodeinfo.atomicWrite(filePath, data)
+			self.cache.put(filePath, data, nodeinfo.dataTag(data))
+			self.writes += 1
+		return {'ok': True}
+
+	def server_close(self):
+		SocketServer.UnixStreamServer.server_close(self)
+		try:
+			os.remove(self.socketPath)
+		except OSError:
+			pass
+
+def _removeStaleSocket(socketPath):
+	"""Removes the socket file of a daemon that is gone; raises if one is still listening"""
+	if not os.path.exists(socketPath):
+		return
+	s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		s.connect(socketPath)
+	except socket.error:
+		os.remove(socketPath)
+		return
+	finally:
+		s.close()
+	raise Exception("A metadata daemon is already listening on " + socketPath)
+
+def serve(socketPath=None):
+	"""Runs the daemon until it is asked to shut down"""
+	server = MetadataDaemon(socketPath)
+	print 'metadaemon: listening on ' + server.socketPath
+	try:
+		server.serve_forever()
+	finally:
+		server.server_close()
+
+################################################################################
+# Client
+################################################################################
+# missing from the socket module of Python 2
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17 if sys.platform.startswith('linux') else None)
+
+def _peerUid(s, socketPath):
+	"""@returns: the uid of the process at the other end of the connected Unix socket s, or None if it is not known"""
+	if SO_PEERCRED is not None:
+		try:
+			pid, uid, gid = struct.unpack('3i', s.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, struct.calcsize('3i')))
+			return uid
+		except socket.error:
+			pass
+	# the user who bound the socket
+	try:
+		return os.stat(socketPath).st_uid
+	except OSError:
+		return None
+
+class Client(object):
+	"""
+	Connection of a process to the daemon, one socket per thread.
+	Requests raise IOError if the daemon can not serve them; see nodeinfo.setRemote().
+	"""
+	def __init__(self, socketPath=None):
+		if socketPath is None:
+			socketPath = getSocketPath()
+		self.socketPath = socketPath
+		self._local = threading.local()
+		# no connection attempts before this time, after one failed
+		self._downUntil = 0
+
+	def _connection(self):
+		conn = getattr(self._local, 'conn', None)
+		if conn is not None:
+			return conn
+		if time.time() < self._downUntil:
+			raise IOError(errno.ECONNREFUSED, "No metadata daemon")
+		s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		s.settimeout(getTimeout())
+		try:
+			s.connect(self.socketPath)
+			# anybody can bind the socket in /tmp first: never send metadata to another user's process
+			if _peerUid(s, self.socketPath) != os.getuid():
+				raise socket.error(errno.EACCES, "The metadata daemon on " + self.socketPath + " is not run by this user")
+		except socket.error:
+			s.close()
+			self._downUntil = time.time() + getRetry()
+			raise
+		conn = (s, s.makefile('rb'))
+		self._local.conn = conn
+		return conn
+
+	def _close(self):
+		conn = getattr(self._local, 'conn', None)
+		self._local.conn = None
+		if conn is not None:
+			conn[1].close()
+			conn[0].close()
+
+	def request(self, **request):
+		"""
+		@returns: the response; the raw bytes that follow it, if any, as its 'data'
+		Raises nodeinfo.UnconfirmedWrite if a write was sent but not answered: the daemon may still make it.
+		"""
+		s, f = self._connection()
+		sent = False
+		try:
+			try:
+				s.sendall(json.dumps(request, separators=(',', ':')) + '\n')
+			except socket.error as e:
+				# unless the daemon had closed the connection, it may have read the request
+				sent = e.errno not in (errno.EPIPE, errno.ECONNRESET)
+				raise
+			sent = True
+			line = f.readline()
+			response = json.loads(line) if line else None
+			if response is not None and 'size' in response:
+				response['data'] = f.read(response['size'])
+				if len(response['data']) != response['size']:
+					response = None
+		except (socket.error, ValueError) as e:
+			self._close()
+			if sent:
+				self._unconfirmed(request, e)
+			raise
+		if response is None:
+			self._close()
+			self._unconfirmed(request, None)
+			raise IOError(errno.ECONNRESET, "The metadata daemon went away")
+		if response.get('conflict'):
+			raise nodeinfo.WriteConflict(errno.EAGAIN, "metadaemon: " + response.get('error', 'conflict'))
+		if not response.get('ok'):
+			raise IOError(errno.EIO, "metadaemon: " + response.get('error', 'failed'))
+		return response
+
+	def _unconfirmed(self, request, error):
+		if request.get('op') == 'write':
+			raise nodeinfo.UnconfirmedWrite(errno.ETIMEDOUT, "metadaemon: the write of " + request['path']
+				+ " was not confirmed (" + (str(error) or error.__class__.__name__ if error is not None else "no reply") + ")")
+
+	def read(self, filePath):
+		"""@returns: the parsed document for filePath (see nodeinfo.parseDocument()), or None if it does not exist"""
+		return self.readTagged(filePath)[0]
+
+	def readTagged(self, filePath):
+		"""@returns: (read(filePath), the nodeinfo.dataTag() of the contents it was parsed from)"""
+		response = self.request(op='read', path=os.path.abspath(filePath))
+		if response.get('missing'):
+			return None, None
+		return nodeinfo.parseDocument(response['data'], filePath), nodeinfo.dataTag(response['data'])
+
+	def write(self, filePath, data, expected=None):
+		"""
+		Writes data to filePath through the daemon (see nodeinfo.atomicWrite()).
+		@param expected: only write if filePath still holds the contents with this nodeinfo.dataTag()
+		Raises IOError if the daemon did not get the request, nodeinfo.UnconfirmedWrite if it may still make the write,
+		and nodeinfo.WriteConflict if filePath holds other contents than expected.
+		"""
+		self.request(op='write', path=os.path.abspath(filePath), data=data, expected=expected)
+
+	def isAvailable(self):
+		try:
+			self.request(op='ping')
+			return True
+		except (IOError, ValueError):
+			return False
+
+def getClient():
+	"""@returns: a Client for the daemon of this workstation, or None if RELIC_DAEMON=0"""
+	if not isEnabled():
+		return None
+	return Client()
+
+if __name__ == '__main__':
+	args = sys.argv[1:]
+	if args and args[0] == 'serve' and len(args) <= 2:
+		serve(args[1] if len(args) > 1 else None)
+	elif args == ['stats']:
+		for key, value in sorted(Client().request(op='stats').items()):
+			print '%s: %s' % (key, value)
+	elif args == ['stop']:
+		Client().request(op='shutdown')
+	else:
+		print 'usage: metadaemon.py serve [<socket>] | stats | stop'
+		sys.exit(2)
@@ -0,0 +1,533 @@
+"""
+This module contains the metadata files (.nodeInfo, .checkoutInfo) that describe
+versioned folders: a shared, in-process cache of the parsed files and typed
+NodeInfo/CheckoutInfo objects that are read once and written once per operation.
+
+Metadata is stored as compact JSON and always written through a temporary file,
+fsync and rename, so a crash or a concurrent reader never sees a partial file.
+NodeInfo.commit() only writes if the file still holds what was loaded (see
+writeDocument()), so concurrent sessions do not overwrite each other's changes.
+Files still in the legacy INI (ConfigParser) format are read transparently;
+run this module with "migrate <root>" to convert an existing project.
+"""
+
+import os, time, json, errno, socket, hashlib, threading
+from collections import OrderedDict
+from ConfigParser import ConfigParser
+from StringIO import StringIO
+
+NODE_INFO = '.nodeInfo'
+CHECKOUT_INFO = '.checkoutInfo'
+
+NODE_INFO_FORMAT = 'relic-nodeinfo/1'
+CHECKOUT_INFO_FORMAT = 'relic-checkoutinfo/1'
+
+def getWriteFormat():
+	"""
+	Returns the format new metadata is written in: 'json' (default) or 'ini'.
+	Set RELIC_METADATA_FORMAT=ini while older copies of the tools are still in use.
+	"""
+	return os.environ.get('RELIC_METADATA_FORMAT', 'json')
+
+def parseDocument(data, filePath='<string>'):
+	"""
+	Parses the contents of a metadata file.
+	@returns: a dict for JSON files, a ConfigParser for legacy INI files
+	"""
+	if data.lstrip().startswith('{'):
+		return json.loads(data)
+	cp = ConfigParser()
+	cp.readfp(StringIO(data), filePath)
+	return cp
+
+def dataTag(data):
+	"""@returns: the tag of data, the contents of a metadata file; see writeDocument()"""
+	return hashlib.sha1(data).hexdigest()
+
+def readTag(filePath):
+	"""@returns: the tag of the contents of filePath read now, None if it does not exist"""
+	try:
+		f = open(filePath, 'rb')
+	except IOError:
+		return None
+	try:
+		return dataTag(f.read())
+	finally:
+		f.close()
+
+def atomicWrite(filePath, data):
+	"""
+	Replaces filePath with data so that readers see either the old or the new contents.
+	The temporary file is created in the same directory, so the rename never crosses volumes.
+	"""
+	dirPath = os.path.dirname(filePath) or '.'
+	tmpPath = os.path.join(dirPath, '.%s.tmp.%s.%d' % (os.path.basename(filePath).lstrip('.'), socket.gethostname(), os.getpid()))
+	fd = os.open(tmpPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0664)
+	try:
+		try:
+			os.write(fd, data)
+			os.fsync(fd)
+		finally:
+			os.close(fd)
+		os.rename(tmpPath, filePath)
+	except:
+		if os.path.exists(tmpPath):
+			os.remove(tmpPath)
+		raise
+	# make the rename itself durable
+	try:
+		dirFd = os.open(dirPath, os.O_RDONLY)
+	except OSError:
+		return
+	try:
+		os.fsync(dirFd)
+	except OSError:
+		pass
+	finally:
+		os.close(dirFd)
+
+class NodeInfoCache(object):
+	"""
+	LRU cache of parsed metadata files keyed by path.
+	An entry is only reused while the file's (mtime, size, inode) signature is unchanged,
+	so edits made by other processes or other machines are picked up on the next read.
+	@param parse: called as parse(data, filePath) to make the cached document of a file
+	"""
+	def __init__(self, maxEntries=4096, parse=None):
+		self.maxEntries = maxEntries
+		self.parse = parse or parseDocument
+		self.hits = 0
+		self.misses = 0
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, filePath):
+		"""
+		@returns: the parsed document for filePath (see parseDocument()), or None if the
+			file does not exist. The returned document is shared and must not be modified.
+		"""
+		return self.getTagged(filePath)[0]
+
+	def getTagged(self, filePath):
+		"""@returns: (the parsed document for filePath, the dataTag() of its contents), (None, None) if it does not exist"""
+		try:
+			st = os.stat(filePath)
+		except OSError:
+			self.invalidate(filePath)
+			return None, None
+		with self._lock:
+			entry = self._entries.pop(filePath, None)
+			if entry is not None and entry[0] == _signature(st):
+				self._entries[filePath] = entry
+				self.hits += 1
+				return entry[1], entry[2]
+			self.misses += 1
+		try:
+			f = open(filePath, 'rb')
+		except IOError:
+			return None, None
+		try:
+			# stat the open file so the signature matches the contents we parse
+			sig = _signature(os.fstat(f.fileno()))
+			data = f.read()
+		finally:
+			f.close()
+		doc = self.parse(data, filePath)
+		tag = dataTag(data)
+		self._store(filePath, sig, doc, tag)
+		return doc, tag
+
+	def put(self, filePath, doc, tag):
+		"""Records doc, with the dataTag() tag, as the current contents of filePath (call after writing it)"""
+		try:
+			st = os.stat(filePath)
+		except OSError:
+			self.invalidate(filePath)
+			return
+		self._store(filePath, _signature(st), doc, tag)
+
+	def invalidate(self, filePath):
+		with self._lock:
+			self._entries.pop(filePath, None)
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+			self.hits = 0
+			self.misses = 0
+
+	def stats(self):
+		with self._lock:
+			return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries), 'maxEntries': self.maxEntries}
+
+	def _store(self, filePath, sig, doc, tag):
+		with self._lock:
+			self._entries.pop(filePath, None)
+			self._entries[filePath] = (sig, doc, tag)
+			while len(self._entries) > self.maxEntries:
+				self._entries.popitem(last=False)
+
+def _signature(st):
+	return (st.st_mtime, st.st_size, st.st_ino)
+
+def copyConfig(configParser):
+	"""
+	Returns an independent copy of configParser that can safely be modified.
+	Values are converted to strings, exactly as they would be read back from disk.
+	"""
+	cp = ConfigParser()
+	for section in configParser.sections():
+		cp.add_section(section)
+		for option, value in configParser.items(section, raw=True):
+			if value is not None:
+				value = str(value)
+			cp.set(section, option, value)
+	return cp
+
+_cache = NodeInfoCache()
+
+# serves reads and writes instead of the files and _cache when set (see setRemote())
+_remote = None
+
+class UnconfirmedWrite(IOError):
+	"""
+	Raised by a remote whose write was sent but never confirmed: it may still be made later,
+	so the file is not written directly instead, where the late write could overwrite newer data.
+	"""
+
+class WriteConflict(IOError):
+	"""Raised by a conditional write (see writeDocument()) of a file that was changed since it was read"""
+
+def getCache():
+	return _cache
+
+def setRemote(remote):
+	"""
+	Sends metadata reads and writes through remote (a metadaemon.Client), whose cache is
+	shared with the other processes on the workstation. Whenever remote raises, the file is
+	read or written directly instead, except after an UnconfirmedWrite, which is raised to the
+	caller. None goes back to direct access.
+	"""
+	global _remote
+	_remote = remote
+
+def readDocument(filePath):
+	"""Returns the shared, read-only parsed document for filePath, or None if it does not exist"""
+	return readDocumentTagged(filePath)[0]
+
+def readDocumentTagged(filePath):
+	"""@returns: (readDocument(filePath), the dataTag() of the contents it was parsed from)"""
+	remote = _remote
+	if remote is not None:
+		try:
+			return remote.readTagged(filePath)
+		except Exception:
+			pass
+	return _cache.getTagged(filePath)
+
+def _write(filePath, data, expected):
+	"""@returns: True if the remote wrote data to filePath, False if it has to be written directly"""
+	remote = _remote
+	if remote is not None:
+		try:
+			remote.write(filePath, data, expected)
+			# read through the remote from now on
+			_cache.invalidate(filePath)
+			return True
+		except (UnconfirmedWrite, WriteConflict):
+			# whatever is cached may be older than what is (or will be) on disk
+			_cache.invalidate(filePath)
+			raise
+		except Exception:
+			pass
+	if expected is not None and readTag(filePath) != expected:
+		# checked, then written: without the daemon, only the changes of other processes are seen, not prevented
+		_cache.invalidate(filePath)
+		raise WriteConflict(errno.EAGAIN, filePath + " was changed by someone else meanwhile; try again")
+	return False
+
+def writeDocument(filePath, doc, expected=None):
+	"""
+	Atomically writes the dict doc to filePath as JSON and refreshes the cache entry.
+	@param expected: the dataTag() of the contents doc was read from (see readDocumentTagged()): the write
+		is only made if filePath still holds them, and raises WriteConflict otherwise. Through the metadata
+		daemon the check and the write are one step; writes without it only check.
+	@returns: the dataTag() of what was written
+	"""
+	data = json.dumps(doc, separators=(',', ':'), sort_keys=True)
+	if not _write(filePath, data, expected):
+		atomicWrite(filePath, data)
+		_cache.put(filePath, doc, dataTag(data))
+	return dataTag(data)
+
+def writeConfig(filePath, configParser, expected=None):
+	"""
+	Atomically writes configParser to filePath in the legacy INI format and refreshes the cache entry.
+	@param expected: see writeDocument()
+	@returns: the dataTag() of what was written
+	"""
+	data = StringIO()
+	configParser.write(data)
+	data = data.getvalue()
+	if not _write(filePath, data, expected):
+		atomicWrite(filePath, data)
+		_cache.put(filePath, copyConfig(configParser), dataTag(data))
+	return dataTag(data)
+
+def cacheStats():
+	return _cache.stats()
+
+def timestamp():
+	return time.strftime("%a, %d %b %Y %I:%M:%S %p", time.localtime())
+
+def versionName(version):
+	"""Returns the folder/comment name for version (e.g. 3 -> 'v003')"""
+	return 'v' + ('%03d' % int(version))
+
+def _str(value):
+	if isinstance(value, unicode):
+		return value.encode('utf-8')
+	return value
+
+class NodeInfo(object):
+	"""
+	Typed view of a versioned folder's .nodeInfo file.
+	Load it once with NodeInfo.load(), modify the fields, then write it back once with commit().
+	"""
+	__slots__ = ('dirPath', 'type', 'latestVersion', 'versionsToKeep', 'locked', 'lockToken',
+		'lastCheckoutTime', 'lastCheckoutUser', 'lastCheckinTime', 'lastCheckinUser',
+		'comments', '_extra', '_tag')
+
+	def __init__(self, dirPath, username='', toKeep=0):
+		now = timestamp()
+		self.dirPath = dirPath
+		self.type = ''
+		self.latestVersion = 0
+		self.versionsToKeep = int(toKeep)
+		self.locked = False
+		# the lockfile grant the lock was taken with; empty for locks taken by older tools, which have no lease
+		self.lockToken = ''
+		self.lastCheckoutTime = now
+		self.lastCheckoutUser = username
+		self.lastCheckinTime = now
+		self.lastCheckinUser = username
+		# comments stored by older versions of the tools; new ones go to the comment journal (see commentlog)
+		self.comments = OrderedDict()
+		# options this class does not know about, kept so commit() does not drop them
+		self._extra = {}
+		# the dataTag() of the file this was loaded from or last committed to; None for a new one
+		self._tag = None
+
+	@classmethod
+	def load(cls, dirPath):
+		"""
+		Reads (through the cache) the .nodeInfo file in dirPath
+		@raises: Exception if dirPath is not a versioned folder
+		"""
+		doc, tag = readDocumentTagged(os.path.join(dirPath, NODE_INFO))
+		if doc is None:
+			raise Exception("Not a versioned folder")
+		if isinstance(doc, ConfigParser):
+			ni = cls.fromConfig(dirPath, doc)
+		else:
+			ni = cls.fromDict(dirPath, doc)
+		ni._tag = tag
+		return ni
+
+	@classmethod
+	def fromDict(cls, dirPath, doc):
+		ni = cls(dirPath)
+		ni.type = _str(doc.get('type', ''))
+		ni.latestVersion = int(doc['latestVersion'])
+		ni.versionsToKeep = int(doc.get('versionsToKeep', 0))
+		ni.locked = bool(doc['locked'])
+		ni.lockToken = _str(doc.get('lockToken', ''))
+		ni.lastCheckoutTime = _str(doc['lastCheckoutTime'])
+		ni.lastCheckoutUser = _str(doc['lastCheckoutUser'])
+		ni.lastCheckinTime = _str(doc['lastCheckinTime'])
+		ni.lastCheckinUser = _str(doc['lastCheckinUser'])
+		ni.comments = OrderedDict((_str(v), _str(c)) for v, c in doc.get('comments', []))
+		ni._extra = dict((section, dict(options)) for section, options in doc.get('extra', {}).items())
+		return ni
+
+	@classmethod
+	def fromConfig(cls, dirPath, cp):
+		"""Reads the legacy INI format"""
+		ni = cls(dirPath)
+		if cp.has_option('Node', 'type'):
+			ni.type = cp.get('Node', 'type')
+		ni.latestVersion = cp.getint('Versioning', 'latestversion')
+		if cp.has_option('Versioning', 'versionstokeep'):
+			ni.versionsToKeep = cp.getint('Versioning', 'versionstokeep')
+		ni.locked = cp.getboolean('Versioning', 'locked')
+		if cp.has_option('Versioning', 'locktoken'):
+			ni.lockToken = cp.get('Versioning', 'locktoken')
+		ni.lastCheckoutTime = cp.get('Versioning', 'lastcheckouttime')
+		ni.lastCheckoutUser = cp.get('Versioning', 'lastcheckoutuser')
+		ni.lastCheckinTime = cp.get('Versioning', 'lastcheckintime')
+		ni.lastCheckinUser = cp.get('Versioning', 'lastcheckinuser')
+		if cp.has_section('Comments'):
+			ni.comments = OrderedDict(cp.items('Comments', raw=True))
+		known = {'Node': ('type',), 'Versioning': ('latestversion', 'versionstokeep', 'locked', 'locktoken',
+			'lastcheckouttime', 'lastcheckoutuser', 'lastcheckintime', 'lastcheckinuser')}
+		for section in cp.sections():
+			if section == 'Comments':
+				continue
+			for option, value in cp.items(section, raw=True):
+				if option not in known.get(section, ()):
+					ni._extra.setdefault(section, {})[option] = value
+		return ni
+
+	def toDict(self):
+		return {
+			'format': NODE_INFO_FORMAT,
+			'type': self.type,
+			'latestVersion': self.latestVersion,
+			'versionsToKeep': self.versionsToKeep,
+			'locked': self.locked,
+			'lockToken': self.lockToken,
+			'lastCheckoutTime': self.lastCheckoutTime,
+			'lastCheckoutUser': self.lastCheckoutUser,
+			'lastCheckinTime': self.lastCheckinTime,
+			'lastCheckinUser': self.lastCheckinUser,
+			'comments': [[version, comment] for version, comment in self.comments.items()],
+			'extra': self._extra,
+		}
+
+	def toConfig(self):
+		"""Returns a ConfigParser in the legacy INI format"""
+		cp = ConfigParser()
+		for section, options in sorted(self._extra.items()):
+			cp.add_section(section)
+			for option, value in options.items():
+				cp.set(section, option, value)
+		for section in ('Node', 'Versioning'):
+			if not cp.has_section(section):
+				cp.add_section(section)
+		cp.set('Node', 'type', self.type)
+		cp.set('Versioning', 'latestversion', str(self.latestVersion))
+		cp.set('Versioning', 'versionstokeep', str(self.versionsToKeep))
+		cp.set('Versioning', 'locked', str(self.locked))
+		if self.lockToken:
+			cp.set('Versioning', 'locktoken', self.lockToken)
+		cp.set('Versioning', 'lastcheckouttime', self.lastCheckoutTime)
+		cp.set('Versioning', 'lastcheckoutuser', self.lastCheckoutUser)
+		cp.set('Versioning', 'lastcheckintime', self.lastCheckinTime)
+		cp.set('Versioning', 'lastcheckinuser', self.lastCheckinUser)
+		cp.add_section('Comments')
+		for version, comment in self.comments.items():
+			cp.set('Comments', version, comment)
+		return cp
+
+	def commit(self, format=None):
+		"""
+		Writes all fields back to the .nodeInfo file in one atomic write, unless the file was
+		changed since this was loaded (see writeDocument()): two sessions never lose each other's changes.
+		@raises: WriteConflict if it was; load it again and make the change again
+		"""
+		if format is None:
+			format = getWriteFormat()
+		filePath = os.path.join(self.dirPath, NODE_INFO)
+		if format == 'ini':
+			self._tag = writeConfig(filePath, self.toConfig(), self._tag)
+		else:
+			self._tag = writeDocument(filePath, self.toDict(), self._tag)
+
+	def removeComment(self, version):
+		self.comments.pop(versionName(version), None)
+
+class CheckoutInfo(object):
+	"""
+	Typed view of the .checkoutInfo file stored in a checked out copy
+	"""
+	__slots__ = ('dirPath', 'checkedOutFrom', 'checkoutTime', 'version', 'lockedByMe')
+
+	def __init__(self, dirPath, checkedOutFrom, checkoutTime, version, lockedByMe):
+		self.dirPath = dirPath
+		self.checkedOutFrom = checkedOutFrom
+		self.checkoutTime = checkoutTime
+		self.version = int(version)
+		self.lockedByMe = bool(lockedByMe)
+
+	@classmethod
+	def load(cls, dirPath):
+		"""
+		@raises: Exception if dirPath is not a checked out copy
+		"""
+		doc = readDocument(os.path.join(dirPath, CHECKOUT_INFO))
+		if doc is None:
+			raise Exception("No checkout info available")
+		if isinstance(doc, ConfigParser):
+			return cls(dirPath,
+				doc.get('Checkout', 'checkedoutfrom'),
+				doc.get('Checkout', 'checkouttime'),
+				doc.getint('Checkout', 'version'),
+				doc.getboolean('Checkout', 'lockedbyme'))
+		return cls(dirPath, _str(doc['checkedOutFrom']), _str(doc['checkoutTime']), doc['version'], doc['lockedByMe'])
+
+	def toDict(self):
+		return {
+			'format': CHECKOUT_INFO_FORMAT,
+			'checkedOutFrom': self.checkedOutFrom,
+			'checkoutTime': self.checkoutTime,
+			'version': self.version,
+			'lockedByMe': self.lockedByMe,
+		}
+
+	def toConfig(self):
+		cp = ConfigParser()
+		cp.add_section('Checkout')
+		cp.set('Checkout', 'checkedoutfrom', self.checkedOutFrom)
+		cp.set('Checkout', 'checkouttime', self.checkoutTime)
+		cp.set('Checkout', 'version', str(self.version))
+		cp.set('Checkout', 'lockedbyme', str(self.lockedByMe))
+		return cp
+
+	def commit(self, format=None):
+		if format is None:
+			format = getWriteFormat()
+		filePath = os.path.join(self.dirPath, CHECKOUT_INFO)
+		if format == 'ini':
+			writeConfig(filePath, self.toConfig())
+		else:
+			writeDocument(filePath, self.toDict())
+
+################################################################################
+# Migration
+################################################################################
+def _isLegacy(filePath):
+	return isinstance(readDocument(filePath), ConfigParser)
+
+def migrateTree(root, format='json'):
+	"""
+	Rewrites every .nodeInfo and .checkoutInfo file below root in format ('json' or 'ini').
+	Files already in that format are left alone.
+	@returns: the number of files rewritten
+	"""
+	count = 0
+	for dirPath, dirNames, fileNames in os.walk(root):
+		if NODE_INFO in fileNames:
+			filePath = os.path.join(dirPath, NODE_INFO)
+			if _isLegacy(filePath) != (format == 'ini'):
+				NodeInfo.load(dirPath).commit(format)
+				count += 1
+		if CHECKOUT_INFO in fileNames:
+			filePath = os.path.join(dirPath, CHECKOUT_INFO)
+			if _isLegacy(filePath) != (format == 'ini'):
+				CheckoutInfo.load(dirPath).commit(format)
+				count += 1
+	return count
+
+if __name__ == '__main__':
+	import sys
+	args = sys.argv[1:]
+	if not args or args[0] != 'migrate':
+		print 'usage: nodeinfo.py migrate [--format json|ini] <root> [<root> ...]'
+		sys.exit(2)
+	args = args[1:]
+	format = 'json'
+	if args and args[0] == '--format':
+		format = args[1]
+		args = args[2:]
+	for root in args:
+		print root + ': ' + str(migrateTree(root, format)) + ' files rewritten'
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+"""
+The asset operations of utilities on the command line, for scripts and farm jobs.
+
+	relic.py status <asset> ...
+	relic.py checkout [--no-lock] [--verify] <asset> ...
+	relic.py checkin [-m <comment>] <asset or checkout> ...
+	relic.py discard <asset or checkout> ...
+	relic.py rollback --version <N> <asset> ...
+	relic.py unlock <asset> ...
+	relic.py purge [--keep <N>] <asset> ...
+	relic.py ls [<folder> ...]
+	relic.py renew
+
+An asset is the path of a versioned folder, or a path relative to ASSETS_DIR.
+Several assets are worked on at once (--jobs, 8 by default); the results are
+printed in the order they were given, one line each, or as JSON lines with --json.
+The exit status is 1 if any of them failed. What utilities prints goes to stderr.
+
+Locks taken from the command line are leases (see lockfile); run "renew" every
+few minutes to keep them while the work takes longer.
+
+This never imports Qt, and utilities only once the arguments are parsed.
+"""
+
+import os, sys, json, argparse
+
+# assets worked on at once
+DEFAULT_JOBS = 8
+
+def _resolve(asset):
+	"""@returns: the absolute path of asset (see the module docstring)"""
+	if not os.path.exists(asset) and not os.path.isabs(asset) and 'ASSETS_DIR' in os.environ:
+		inAssets = os.path.join(os.environ['ASSETS_DIR'], asset)
+		if os.path.exists(inAssets):
+			return os.path.abspath(inAssets)
+	return os.path.abspath(asset)
+
+def _workingCopy(amu, asset):
+	"""@returns: the checked out copy asset names: itself, or the current user's checkout of it"""
+	path = _resolve(asset)
+	if amu.isCheckedOutCopyFolder(path):
+		return path
+	toCheckin = amu.findCheckout(path)
+	if toCheckin is None:
+		raise Exception(asset + " is not checked out by " + amu.getUsername())
+	return toCheckin
+
+def _formatLease(lockedBy, leaseRemaining):
+	if not lockedBy:
+		return 'not locked'
+	if leaseRemaining is None:
+		return 'locked by ' + lockedBy
+	return 'locked by %s (%d min left)' % (lockedBy, int((leaseRemaining + 59) // 60))
+
+################################################################################
+# Commands: each returns (result dict, human readable line) for one asset
+################################################################################
+def status(amu, args, asset):
+	info = amu.getVersionedFolderInfoMany([_resolve(asset)])[0]
+	if info is None:
+		raise Exception(asset + " is not a versioned folder")
+	result = info._asdict()
+	return result, '%s  %s  last checkin by %s, %s: %s' % (amu.versionName(info.latestVersion),
+		_formatLease(info.lockedBy, info.leaseRemaining), info.lastCheckinUser, info.lastCheckinTime, info.latestComment)
+
+def checkout(amu, args, asset):
+	dest = amu.checkout(_resolve(asset), not args.no_lock, verify=args.verify or None)
+	return {'checkout': dest}, dest
+
+def checkin(amu, args, asset):
+	dest = amu.checkin(_workingCopy(amu, asset), args.comment)
+	version = amu.getLatestVersion(dest)
+	return {'path': dest, 'version': version}, 'checked in as ' + amu.versionName(version)
+
+def discard(amu, args, asset):
+	toDiscard = _workingCopy(amu, asset)
+	amu.discard(toDiscard)
+	return {'discarded': toDiscard}, 'discarded ' + toDiscard
+
+def rollback(amu, args, asset):
+	dest = amu.rollback(_resolve(asset), args.version)
+	return {'checkout': dest, 'version': args.version}, amu.versionName(args.version) + ' checked out to ' + dest
+
+def unlock(amu, args, asset):
+	amu.unlock(_resolve(asset))
+	return {'unlocked': True}, 'unlocked'
+
+def purge(amu, args, asset):
+	archived = amu.purgeVersions(_resolve(asset), args.keep)
+	return {'archived': archived}, 'archived ' + (', '.join(amu.versionName(v) for v in archived) or 'nothing')
+
+def ls(amu, args, folder):
+	path = _resolve(folder)
+	listing = amu.walker.listDir(path)
+	if listing is None:
+		raise Exception(folder + " is not a folder")
+	children = sorted(e.path for e in listing.dirs())
+	folders = []
+	lines = []
+	for child, info in zip(children, amu.getVersionedFolderInfoMany(children)):
+		if info is None:
+			folders.append({'path': child, 'versioned': False})
+			lines.append(os.path.basename(child) + '/')
+		else:
+			entry = info._asdict()
+			entry['versioned'] = True
+			folders.append(entry)
+			lines.append('%-30s %s  %s' % (os.path.basename(child), amu.versionName(info.latestVersion),
+				_formatLease(info.lockedBy, info.leaseRemaining)))
+	return {'folders': folders}, '\n'.join([path + ':'] + ['  ' + line for line in lines])
+
+COMMANDS = {
+	'status': status,
+	'checkout': checkout,
+	'checkin': checkin,
+	'discard': discard,
+	'rollback': rollback,
+	'unlock': unlock,
+	'purge': purge,
+	'ls': ls,
+}
+
+def _parser():
+	common = argparse.ArgumentParser(add_help=False)
+	common.add_argument('--json', action='store_true', help='print one JSON object per line')
+	common.add_argument('-j', '--jobs', type=int, default=DEFAULT_JOBS, help='assets worked on at once')
+	parser = argparse.ArgumentParser(prog='relic', description='Asset operations without the user interfaces.')
+	commands = parser.add_subparsers(dest='command')
+	commands.add_parser('status', parents=[common], help='lock, latest version and last checkin').add_argument('assets', nargs='+')
+	p = commands.add_parser('checkout', parents=[common], help='check out the latest version')
+	p.add_argument('--no-lock', action='store_true', help='check out without locking')
+	p.add_argument('--verify', action='store_true', help="check the copy against the version's manifest")
+	p.add_argument('assets', nargs='+')
+	p = commands.add_parser('checkin', parents=[common], help='check in as the new latest version')
+	p.add_argument('-m', '--comment', help='comment of the new version')
+	p.add_argument('assets', nargs='+')
+	commands.add_parser('discard', parents=[common], help='throw away a checkout').add_argument('assets', nargs='+')
+	p = commands.add_parser('rollback', parents=[common], help='replace the checkout with a checkout of an older version')
+	p.add_argument('--version', type=int, required=True)
+	p.add_argument('assets', nargs='+')
+	commands.add_parser('unlock', parents=[common], help="break somebody's lock").add_argument('assets', nargs='+')
+	p = commands.add_parser('purge', parents=[common], help='archive old versions')
+	p.add_argument('--keep', type=int, help="versions to keep before the latest (the asset's own setting by default)")
+	p.add_argument('assets', nargs='+')
+	commands.add_parser('ls', parents=[common], help='the folders in a folder').add_argument('assets', nargs='*')
+	commands.add_parser('renew', parents=[common], help='renew the leases of your locked checkouts')
+	return parser
+
+def main(argv=None):
+	args = _parser().parse_args(argv)
+	out = sys.stdout
+	# the asset operations print progress; keep stdout for the results
+	sys.stdout = sys.stderr
+	try:
+		import utilities as amu
+		amu.connectMetadataDaemon()
+		if args.command == 'renew':
+			renewed = amu.renewLeases()
+			if args.json:
+				out.write(json.dumps({'ok': True, 'renewed': renewed}) + '\n')
+			else:
+				for dirPath in renewed:
+					out.write(dirPath + ': renewed\n')
+			return 0
+		command = COMMANDS[args.command]
+		assets = args.assets
+		if args.command == 'ls' and not assets:
+			assets = [os.environ.get('ASSETS_DIR', '.')]
+
+		def run(asset):
+			try:
+				result, line = command(amu, args, asset)
+			except Exception as e:
+				return asset, False, {'error': str(e)}, str(e)
+			return asset, True, result, line
+
+		if len(assets) > 1 and args.jobs > 1:
+			from multiprocessing.pool import ThreadPool
+			pool = ThreadPool(min(args.jobs, len(assets)))
+			results = pool.imap(run, assets)
+		else:
+			pool = None
+			results = (run(asset) for asset in assets)
+		failed = 0
+		for asset, ok, result, line in results:
+			if not ok:
+				failed += 1
+			if args.json:
+				result.update(asset=asset, ok=ok)
+				out.write(json.dumps(result, sort_keys=True) + '\n')
+			elif ok:
+				out.write(asset + ': ' + line + '\n')
+			else:
+				sys.stderr.write(asset + ': error: ' + line + '\n')
+			out.flush()
+		if pool is not None:
+			pool.close()
+		return 1 if failed else 0
+	finally:
+		sys.stdout = out
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,262 @@
+"""
+This module contains an incremental rescanner that keeps the local asset index
+(see assetindex) in step with the production tree.
+
+A snapshot of every directory's mtime and every versioned folder's .nodeInfo
+signature is saved after each scan. The next scan only stats what it already
+knows about: a directory is re-listed only if its mtime changed, and a
+.nodeInfo file is only re-read if its signature changed. Changes made outside
+the tools (manual copies, other machines) are found without a full walk.
+"""
+
+import os, json, hashlib, threading
+
+import assetindex, walker
+from nodeinfo import NodeInfo, NODE_INFO
+
+SNAPSHOT_VERSION = 1
+
+def _signature(path):
+	"""Returns the (mtime, size, inode) signature of path, or None if it does not exist"""
+	try:
+		st = os.stat(path)
+	except OSError:
+		return None
+	return [st.st_mtime, st.st_size, st.st_ino]
+
+def _mtime(path):
+	try:
+		return os.stat(path).st_mtime
+	except OSError:
+		return None
+
+def _isDescendant(path, parent):
+	return path.startswith(parent + os.sep)
+
+class Scanner(object):
+	"""
+	Scans root, updating index with what changed since the saved snapshot.
+	"""
+	def __init__(self, root, index=None, snapshotPath=None):
+		self.root = os.path.normpath(os.path.abspath(root))
+		if index is None:
+			index = assetindex.getIndex()
+		self.index = index
+		if snapshotPath is None:
+			key = hashlib.md5(self.root).hexdigest()[:12]
+			snapshotPath = os.path.join(os.path.dirname(index.dbPath), 'scan-' + key + '.json')
+		self.snapshotPath = snapshotPath
+		# path -> mtime for plain directories
+		self.dirs = {}
+		# path -> [.nodeInfo signature, stable directory mtime] for versioned folders
+		self.nodes = {}
+		# one scan at a time; a refresh waits for a cancelled scan to stop
+		self._lock = threading.Lock()
+		self._progress = None
+		self._cancelled = None
+		self._load()
+
+	def _load(self):
+		try:
+			f = open(self.snapshotPath, 'r')
+		except IOError:
+			return
+		try:
+			snapshot = json.load(f)
+		except ValueError:
+			return
+		finally:
+			f.close()
+		if snapshot.get('version') != SNAPSHOT_VERSION or snapshot.get('root') != self.root:
+			return
+		self.dirs = dict((str(k), v) for k, v in snapshot['dirs'].items())
+		self.nodes = dict((str(k), v) for k, v in snapshot['nodes'].items())
+
+	def _save(self):
+		snapshot = {'version': SNAPSHOT_VERSION, 'root': self.root, 'dirs': self.dirs, 'nodes': self.nodes}
+		tmpPath = self.snapshotPath + '.tmp'
+		f = open(tmpPath, 'w')
+		try:
+			json.dump(snapshot, f)
+		finally:
+			f.close()
+		os.rename(tmpPath, self.snapshotPath)
+
+	def hasSnapshot(self):
+		return bool(self.dirs)
+
+	def scan(self, full=False, progress=None, cancelled=None):
+		"""
+		Brings the index up to date with root.
+		@param full: ignore the snapshot and re-read every folder
+		@param progress: called as progress(done, total) while scanning; total is 0 during
+			a full scan, where it is not known in advance
+		@param cancelled: called now and then; the scan stops early once it returns True.
+			What was scanned so far is kept, the rest is picked up by the next scan.
+		@returns: the number of folders that were added, removed or re-read
+		"""
+		with self._lock:
+			self._progress = progress
+			self._cancelled = cancelled
+			try:
+				if full or not self.hasSnapshot():
+					return self._fullScan()
+				return self._incrementalScan()
+			finally:
+				self._progress = None
+				self._cancelled = None
+
+	def _report(self, done, total):
+		"""Reports progress, returns True if the scan should stop"""
+		if self._progress is not None:
+			self._progress(done, total)
+		return self._cancelled is not None and self._cancelled()
+
+	def _incrementalScan(self):
+		touched = 0
+		done = 0
+		total = len(self.dirs) + len(self.nodes)
+		changedDirs = []
+		for path, mtime in sorted(self.dirs.items()):
+			done += 1
+			if self._report(done, total):
+				self._save()
+				return touched
+			if path not in self.dirs:
+				# removed while handling an earlier directory
+				continue
+			current = _mtime(path)
+			if current is None:
+				touched += self._forget(path)
+			elif current != mtime:
+				changedDirs.append((path, current))
+		# new mtimes are only recorded once the directory is re-listed, so a cancelled scan redoes it
+		for path, current in changedDirs:
+			if path in self.dirs:
+				self.dirs[path] = current
+				touched += self._relist(path)
+
+		for path, saved in self.nodes.items():
+			done += 1
+			if self._report(done, total):
+				break
+			if path not in self.nodes:
+				continue
+			current = self._nodeSignature(path)
+			if current is None:
+				touched += self._forget(path)
+			elif current != saved:
+				touched += self._readNode(path, current)
+
+		self._save()
+		return touched
+
+	def _nodeSignature(self, path):
+		sig = _signature(os.path.join(path, NODE_INFO))
+		if sig is None:
+			return None
+		return [sig, _mtime(os.path.join(path, 'stable'))]
+
+	def _readNode(self, path, signature=None):
+		if signature is None:
+			signature = self._nodeSignature(path)
+		try:
+			nodeInfo = NodeInfo.load(path)
+		except Exception as e:
+			print "scanner: skipping " + path + ": " + str(e)
+			return 0
+		self.nodes[path] = signature
+		self.index.update(path, nodeInfo)
+		return 1
+
+	def _forget(self, path):
+		"""Drops path and everything below it"""
+		count = 0
+		for table in (self.dirs, self.nodes):
+			for known in table.keys():
+				if known == path or _isDescendant(known, path):
+					del table[known]
+					count += 1
+		self.index.remove(path)
+		return count
+
+	def _relist(self, path):
+		"""Picks up folders added to or removed from the directory path"""
+		touched = 0
+		listing = walker.listDir(path)
+		if listing is None:
+			return self._forget(path)
+		if listing.isVersioned() and path != self.root:
+			# a plain folder became a versioned folder
+			self._forget(path)
+			return self._addTree(path)
+		current = set()
+		for entry in listing.dirs():
+			child = entry.path
+			current.add(child)
+			if child not in self.dirs and child not in self.nodes:
+				touched += self._addTree(child)
+		for known in self.dirs.keys() + self.nodes.keys():
+			if os.path.dirname(known) == path and known not in current and (known in self.dirs or known in self.nodes):
+				touched += self._forget(known)
+		return touched
+
+	def _addTree(self, top):
+		"""Scans a directory that is not in the snapshot yet"""
+		touched = 0
+		for dirPath, nodeInfo in self._walk(top):
+			if nodeInfo is None:
+				self.index.addFolder(dirPath)
+			else:
+				self.index.update(dirPath, nodeInfo)
+			touched += 1
+		return touched
+
+	def _walk(self, top):
+		"""Walks top, recording what it finds in the snapshot, and yields (path, NodeInfo or None)"""
+		for listing in walker.walk(top):
+			dirPath = listing.path
+			if listing.isVersioned() and dirPath != self.root:
+				signature = self._nodeSignature(dirPath)
+				try:
+					nodeInfo = NodeInfo.load(dirPath)
+				except Exception as e:
+					print "scanner: skipping " + dirPath + ": " + str(e)
+					continue
+				self.nodes[dirPath] = signature
+				yield dirPath, nodeInfo
+			else:
+				self.dirs[dirPath] = _mtime(dirPath)
+				yield dirPath, None
+
+	def _fullScan(self):
+		self.dirs = {}
+		self.nodes = {}
+		folders = []
+		for folder in self._walk(self.root):
+			folders.append(folder)
+			if self._report(len(folders), 0):
+				# nothing was written yet; go back to the saved snapshot
+				self.dirs = {}
+				self.nodes = {}
+				self._load()
+				return 0
+		self.index.rebuild(self.root, folders)
+		self._save()
+		return len(folders)
+
+_scanners = {}
+
+def getScanner(root, index=None):
+	"""Returns the shared Scanner for root"""
+	root = os.path.normpath(os.path.abspath(root))
+	if root not in _scanners:
+		_scanners[root] = Scanner(root, index)
+	return _scanners[root]
+
+if __name__ == '__main__':
+	import sys
+	full = '--full' in sys.argv[1:]
+	roots = [a for a in sys.argv[1:] if not a.startswith('--')] or [os.environ['PRODUCTION_DIR']]
+	for root in roots:
+		print root + ': ' + str(getScanner(root).scan(full=full)) + ' folders touched'
@@ -0,0 +1,283 @@
+"""
+This module contains the deferred deletion of folders (purged versions, discarded checkouts).
+
+A folder is "deleted" by renaming it into the .trash folder of its volume, which
+is instant however large it is, and a .info file next to it records where it came
+from. A version in the trash still links to its blobs, so it can be restored until
+it is reaped. reap() deletes what has been in the trash for longer than
+RELIC_TRASH_DAYS days (7 by default), unlinking at most RELIC_REAP_RATE files a
+second (0 for no limit) so it does not starve the file server; run it from cron:
+
+	python trash.py reap [--all]
+	python trash.py list
+	python trash.py restore <entry>
+
+The trash of a path is RELIC_TRASH_DIR, PRODUCTION_DIR/.trash or USER_DIR/.trash,
+whichever is on the same volume, or else .trash at the top of the path's volume.
+Where no trash folder can be made, the folder is deleted right away. Trash folders
+at the top of a volume are recorded in the registry (RELIC_TRASH_REGISTRY, or
+USER_DIR/.trashdirs), so list and reap find them too.
+
+A version's manifest names the blobs it was using, and they are collected when
+it is reaped. A folder without one (a hard linked checkout, a legacy version) may
+have been holding any blob, so after such folders are reaped the whole blob store
+is collected.
+"""
+
+import os, sys, time, json, errno, socket, shutil, stat
+from collections import namedtuple
+
+import nodeinfo, blobstore
+
+TRASH_DIR = '.trash'
+INFO_EXTENSION = '.info'
+REGISTRY = '.trashdirs'
+
+# name: the entry's folder in trashDir; info: what was trashed, from where, by whom and when
+TrashEntry = namedtuple('TrashEntry', ['name', 'trashDir', 'originalPath', 'trashedAt', 'user', 'blobStore'])
+
+def getRetention():
+	"""@returns: the seconds a folder stays in the trash before it is reaped"""
+	return float(os.environ.get('RELIC_TRASH_DAYS', 7)) * 24 * 3600
+
+def getReapRate():
+	"""@returns: the files reap() unlinks per second at most, 0 for no limit"""
+	return int(os.environ.get('RELIC_REAP_RATE', 500))
+
+def _candidateDirs():
+	dirs = []
+	if 'RELIC_TRASH_DIR' in os.environ:
+		dirs.append(os.environ['RELIC_TRASH_DIR'])
+	for var in ('PRODUCTION_DIR', 'USER_DIR'):
+		if var in os.environ:
+			dirs.append(os.path.join(os.environ[var], TRASH_DIR))
+	return dirs
+
+def getRegistryPath():
+	"""@returns: the file listing the trash folders outside _candidateDirs(), or None if there is none"""
+	if 'RELIC_TRASH_REGISTRY' in os.environ:
+		return os.environ['RELIC_TRASH_REGISTRY']
+	if 'USER_DIR' in os.environ:
+		return os.path.join(os.environ['USER_DIR'], REGISTRY)
+	return None
+
+def registeredDirs():
+	"""@returns: the trash folders recorded by register()"""
+	registryPath = getRegistryPath()
+	if registryPath is None:
+		return []
+	try:
+		f = open(registryPath, 'rb')
+	except IOError:
+		return []
+	try:
+		lines = f.read().splitlines()
+	finally:
+		f.close()
+	dirs = []
+	for line in lines:
+		if line and line not in dirs:
+			dirs.append(line)
+	return dirs
+
+def register(trashDir):
+	"""Records trashDir in the registry, unless it is already there or one of _candidateDirs()"""
+	if trashDir in _candidateDirs() or trashDir in registeredDirs():
+		return
+	registryPath = getRegistryPath()
+	if registryPath is None:
+		print "trash: no registry (USER_DIR is not set), " + trashDir + " will not be reaped"
+		return
+	# one short line appended in one write, so concurrent registrations do not interleave
+	fd = os.open(registryPath, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+	try:
+		os.write(fd, trashDir + '\n')
+	finally:
+		os.close(fd)
+
+def getTrashDirs():
+	"""@returns: every trash folder list and reap look in"""
+	dirs = _candidateDirs()
+	return dirs + [trashDir for trashDir in registeredDirs() if trashDir not in dirs]
+
+def _mountPoint(path):
+	path = os.path.abspath(path)
+	dev = os.lstat(path).st_dev
+	while path != os.path.dirname(path):
+		parent = os.path.dirname(path)
+		if os.lstat(parent).st_dev != dev:
+			break
+		path = parent
+	return path
+
+def getTrashDir(path):
+	"""@returns: the trash folder on path's volume (it may not exist yet)"""
+	dev = os.lstat(path).st_dev
+	for trashDir in _candidateDirs():
+		try:
+			if os.stat(os.path.dirname(trashDir.rstrip('/'))).st_dev == dev:
+				return trashDir
+		except OSError:
+			continue
+	return os.path.join(_mountPoint(path), TRASH_DIR)
+
+def _storeDir():
+	try:
+		return blobstore.getStoreDir()
+	except KeyError:
+		return None
+
+def moveToTrash(path):
+	"""
+	Deletes the folder path by renaming it into its volume's trash.
+	@returns: the name of its trash entry, or None if it had to be deleted right away
+	"""
+	path = os.path.abspath(path)
+	trashDir = getTrashDir(path)
+	try:
+		if not os.path.isdir(trashDir):
+			os.makedirs(trashDir)
+	except OSError as e:
+		if e.errno != errno.EEXIST:
+			print "trash: can not create " + trashDir + " (" + str(e) + "), deleting " + path
+			shutil.rmtree(path)
+			return None
+	register(trashDir)
+	name = '%s-%s-%d-%s' % (time.strftime('%Y%m%d%H%M%S'), socket.gethostname(), os.getpid(), os.path.basename(path))
+	while os.path.lexists(os.path.join(trashDir, name)):
+		name += '_'
+	# also for folders without a manifest: their files may be hard links to blobs
+	store = _storeDir()
+	info = {'originalPath': path, 'trashedAt': time.time(), 'user': os.environ.get('USER'), 'blobStore': store}
+	infoPath = os.path.join(trashDir, name + INFO_EXTENSION)
+	nodeinfo.atomicWrite(infoPath, json.dumps(info, sort_keys=True))
+	try:
+		os.rename(path, os.path.join(trashDir, name))
+	except OSError:
+		os.remove(infoPath)
+		raise
+	return name
+
+def _readEntry(trashDir, name):
+	try:
+		f = open(os.path.join(trashDir, name + INFO_EXTENSION), 'rb')
+	except IOError:
+		return None
+	try:
+		info = json.load(f)
+	finally:
+		f.close()
+	return TrashEntry(name, trashDir, info['originalPath'], info['trashedAt'], info.get('user'), info.get('blobStore'))
+
+def listTrash(trashDirs=None):
+	"""@returns: the TrashEntries in trashDirs (getTrashDirs() by default), oldest first"""
+	if trashDirs is None:
+		trashDirs = getTrashDirs()
+	entries = []
+	for trashDir in trashDirs:
+		try:
+			names = os.listdir(trashDir)
+		except OSError:
+			continue
+		for name in names:
+			if name.endswith(INFO_EXTENSION) and not name.startswith('.'):
+				entry = _readEntry(trashDir, name[:-len(INFO_EXTENSION)])
+				if entry is not None:
+					entries.append(entry)
+	return sorted(entries, key=lambda entry: entry.trashedAt)
+
+def findEntry(name, trashDirs=None):
+	for entry in listTrash(trashDirs):
+		if entry.name == name:
+			return entry
+	return None
+
+def restore(entry, dest=None):
+	"""
+	Moves a trashed folder back to where it was deleted from (or to dest).
+	@returns: the path it was restored to
+	"""
+	if dest is None:
+		dest = entry.originalPath
+	if os.path.lexists(dest):
+		raise Exception(dest + " already exists.")
+	os.rename(os.path.join(entry.trashDir, entry.name), dest)
+	os.remove(os.path.join(entry.trashDir, entry.name + INFO_EXTENSION))
+	return dest
+
+def _throttledRmtree(path, rate):
+	"""Deletes the folder path like shutil.rmtree, unlinking at most rate files a second"""
+	start = time.time()
+	count = 0
+	for dirPath, dirNames, fileNames in os.walk(path, topdown=False):
+		for name in fileNames + [d for d in dirNames if os.path.islink(os.path.join(dirPath, d))]:
+			filePath = os.path.join(dirPath, name)
+			try:
+				os.remove(filePath)
+			except OSError as e:
+				if e.errno == errno.ENOENT:
+					continue
+				# read-only folders (hard linked checkouts) are made writable to empty them
+				os.chmod(dirPath, stat.S_IMODE(os.lstat(dirPath).st_mode) | stat.S_IWUSR | stat.S_IXUSR)
+				os.remove(filePath)
+			count += 1
+			if rate:
+				ahead = float(count) / rate - (time.time() - start)
+				if ahead > 0:
+					time.sleep(ahead)
+		os.rmdir(dirPath)
+
+def reap(olderThan=None, trashDirs=None, rate=None):
+	"""
+	Deletes the trash entries trashed more than olderThan seconds ago (getRetention() by
+	default), and the blobs only the trashed folders were using.
+	@returns: the number of entries deleted
+	"""
+	if olderThan is None:
+		olderThan = getRetention()
+	if rate is None:
+		rate = getReapRate()
+	count = 0
+	# blob stores to collect in full, for the entries that had no manifest
+	sweep = set()
+	for entry in listTrash(trashDirs):
+		if time.time() - entry.trashedAt < olderThan:
+			continue
+		entryPath = os.path.join(entry.trashDir, entry.name)
+		digests = []
+		manifest = blobstore.readManifest(entryPath)
+		if manifest is not None:
+			digests = [f['sha256'] for f in manifest['files'].values()]
+		store = entry.blobStore or _storeDir()
+		if os.path.isdir(entryPath) and not os.path.islink(entryPath):
+			_throttledRmtree(entryPath, rate)
+		elif os.path.lexists(entryPath):
+			os.remove(entryPath)
+		os.remove(os.path.join(entry.trashDir, entry.name + INFO_EXTENSION))
+		if store is not None:
+			if manifest is not None:
+				blobstore.BlobStore(store).collect(digests)
+			else:
+				sweep.add(store)
+		count += 1
+	for store in sweep:
+		blobstore.BlobStore(store).collect()
+	return count
+
+if __name__ == '__main__':
+	args = sys.argv[1:]
+	if args and args[0] == 'reap':
+		print '%d trash entries reaped' % reap(0 if '--all' in args[1:] else None)
+	elif args == ['list']:
+		for entry in listTrash():
+			print '%s  %s  %s  %s' % (time.strftime('%Y-%m-%d %H:%M', time.localtime(entry.trashedAt)),
+				entry.user, entry.name, entry.originalPath)
+	elif len(args) == 2 and args[0] == 'restore':
+		entry = findEntry(args[1])
+		if entry is None:
+			print 'no trash entry ' + args[1]
+			sys.exit(1)
+		print 'restored ' + restore(entry)
+	else:
+		print 'usage: trash.py reap [--all] | list | restore <entry>'
+		sys.exit(2)
@@ -0,0 +1,106 @@
+"""
+This module contains the background threads that read the file system for the
+asset manager's trees, so the window stays responsive while they run.
+Results are sent to the GUI thread in batches through Qt signals:
+
+	batch(PyQt_PyObject)	a list of results to add to the tree
+	progress(int, int)		(done, total); total is 0 while it is not known
+	failed(QString)			the error that stopped the worker
+"""
+
+from PyQt4.QtCore import QThread, SIGNAL
+import os, time
+
+import utilities, walker
+
+# results sent to the GUI thread at a time
+BATCH_SIZE = 50
+
+class TreeWorker(QThread):
+	"""
+	Runs the work() of a subclass in a thread. work() sends results with
+	emitBatch() and returns early once cancel() has been called.
+	"""
+	def __init__(self, parent=None):
+		QThread.__init__(self, parent)
+		self._cancelled = False
+		self._lastStep = None
+
+	def cancel(self):
+		self._cancelled = True
+
+	def isCancelled(self):
+		return self._cancelled
+
+	def emitBatch(self, batch):
+		if batch and not self._cancelled:
+			self.emit(SIGNAL('batch(PyQt_PyObject)'), batch)
+
+	def emitProgress(self, done, total):
+		# only send the changes a progress bar can show
+		if total:
+			step = done * 100 // total
+		else:
+			step = done // BATCH_SIZE
+		if step != self._lastStep:
+			self._lastStep = step
+			self.emit(SIGNAL('progress(int, int)'), done, total)
+
+	def run(self):
+		try:
+			self.work()
+		except Exception as e:
+			if not self._cancelled:
+				self.emit(SIGNAL('failed(QString)'), str(e))
+
+class ProjectTreeWorker(TreeWorker):
+	"""
+	Brings the local asset index up to date with root and sends the
+	assetindex.IndexEntry of each folder directly below root.
+	"""
+	def __init__(self, root, rescan=False, parent=None):
+		TreeWorker.__init__(self, parent)
+		self.root = root
+		self.rescan = rescan
+
+	def work(self):
+		index = utilities.getAssetIndex()
+		if self.rescan or not index.isIndexed(self.root):
+			utilities.rescanProject(self.root, progress=self.emitProgress, cancelled=self.isCancelled)
+		if self._cancelled:
+			return
+		entries = index.children(self.root)
+		for i in range(0, len(entries), BATCH_SIZE):
+			self.emitBatch(entries[i:i + BATCH_SIZE])
+
+class LocalTreeWorker(TreeWorker):
+	"""
+	Reads the user's checked out folders, sending (path, checkout time or None if
+	it is not a checked out folder, modification time) for each of them.
+	"""
+	def __init__(self, checkoutDir, parent=None):
+		TreeWorker.__init__(self, parent)
+		self.checkoutDir = checkoutDir
+
+	def work(self):
+		listing = walker.listDir(self.checkoutDir)
+		files = [e.path for e in listing.match('*')] if listing is not None else []
+		batch = []
+		for i, f in enumerate(files):
+			if self._cancelled:
+				return
+			try:
+				modified = time.strftime("%a, %d %b %Y %I:%M:%S %p", time.localtime(os.path.getmtime(f)))
+			except OSError:
+				# removed since it was listed
+				continue
+			try:
+				checkoutTime = utilities.getFilesCheckoutTime(f)
+			except Exception:
+				checkoutTime = None
+			batch.append((f, checkoutTime, modified))
+			if len(batch) == BATCH_SIZE:
+				self.emitBatch(batch)
+				batch = []
+			self.emitProgress(i + 1, len(files))
+		self.emitBatch(batch)
@@ -3,8 +3,24 @@ This module contains functionality to manage the animation project.
 @author: Morgan Strong, Brian Kingery
 """
 
-import os, time, shutil, glob, pwd, tempfile, smtplib, re
-from ConfigParser import ConfigParser
+import os, time, threading, socket
+from collections import namedtuple
+# the rest (assetindex, scanner, blobstore, versioncache, journal, trash, archive, metadaemon) is imported
+# where it is first used: an interface that only browses the project does not load sqlite3, ctypes or tarfile
+import nodeinfo, commentlog, walker, lockfile
+from nodeinfo import NodeInfo, CheckoutInfo, versionName
+
+def connectMetadataDaemon():
+	"""
+	Reads and writes metadata through the workstation's metadata daemon from now on, while one
+	is running (see metadaemon). Called once at startup by the asset manager, relic.py and Maya;
+	until then, and in anything else importing this module, the files are read directly.
+	@returns: the metadaemon.Client, or None if it is turned off (RELIC_DAEMON=0)
+	"""
+	import metadaemon
+	client = metadaemon.getClient()
+	nodeinfo.setRemote(client)
+	return client
 
 def getProjectName():
 	return os.environ['PROJECT_NAME']
@@ -34,8 +50,51 @@ def _writeConfigFile(filePath, configParser):
        @precondition: filePath is a valid path
        @precondition: confgParser is an instance of ConfigParser()
        """
-       configFile = open(filePath, 'wb')
-       configParser.write(configFile)
+       nodeinfo.writeConfig(filePath, configParser)
+
+def getNodeInfoCacheStats():
+	return nodeinfo.cacheStats()
+
+def getAssetIndex(root=None, rescan=False):
+	"""
+	Returns the local index of versioned folders (see assetindex)
+	@param root: if given, root is scanned first unless it is already indexed
+	@param rescan: rescan root even if it is indexed, to pick up what other workstations
+		changed since (only changed folders are re-read); if that fails, the last scan is used
+	"""
+	import assetindex
+	index = assetindex.getIndex()
+	if root is not None and not index.isIndexed(root):
+		rescanProject(root)
+	elif root is not None and rescan:
+		try:
+			rescanProject(root)
+		except Exception as e:
+			print "asset index: could not rescan "+root+", it may be out of date: "+str(e)
+	return index
+
+def rescanProject(root=None, full=False, progress=None, cancelled=None):
+	"""
+	Updates the local asset index with whatever changed below root (PRODUCTION_DIR by default)
+	since the last scan. Only changed folders are re-read unless full is True.
+	@param progress, cancelled: see scanner.Scanner.scan()
+	@returns: the number of folders that were added, removed or re-read
+	"""
+	import scanner
+	if root is None:
+		root = getProductionDir()
+	return scanner.getScanner(root).scan(full=full, progress=progress, cancelled=cancelled)
+
+def _updateIndex(nodeInfo):
+	"""
+	Records a committed NodeInfo in the local asset index.
+	The index is only a cache of the .nodeInfo files, so a failure here must not fail the operation.
+	"""
+	import assetindex
+	try:
+		assetindex.getIndex().update(nodeInfo.dirPath, nodeInfo)
+	except Exception as e:
+		print "asset index: could not update "+nodeInfo.dirPath+": "+str(e)
 
 
 def createNodeInfoFile(dirPath, toKeep):
@@ -46,25 +105,10 @@ def createNodeInfoFile(dirPath, toKeep):
 	@postcondition: All sections/tags are created and set except "Type".
 		"Type" must be set by concrete nodes.
 	"""
-	username = getUsername()
-	timestamp = time.strftime("%a, %d %b %Y %I:%M:%S %p", time.localtime())
-	
-	nodeInfo = ConfigParser()
-	nodeInfo.add_section('Node')
-	nodeInfo.set('Node', 'Type', '')
-	
-	nodeInfo.add_section('Versioning')
-	nodeInfo.set('Versioning', 'LatestVersion', '0')
-	nodeInfo.set('Versioning', 'VersionsToKeep', str(toKeep))
-	nodeInfo.set('Versioning', 'Locked', 'False')
-	nodeInfo.set('Versioning', 'LastCheckoutTime', timestamp)
-	nodeInfo.set('Versioning', 'LastCheckoutUser', username)
-	nodeInfo.set('Versioning', 'LastCheckinTime', timestamp)
-	nodeInfo.set('Versioning', 'LastCheckinUser', username)
-	nodeInfo.add_section('Comments')
-	nodeInfo.set('Comments', 'v000', 'New')
-
-	_writeConfigFile(os.path.join(dirPath, ".nodeInfo"), nodeInfo)
+	nodeInfo = NodeInfo(dirPath, getUsername(), toKeep)
+	commentlog.append(dirPath, 0, 'New')
+	nodeInfo.commit()
+	_updateIndex(nodeInfo)
 	
 def addVersionedFolder(parent, name, toKeep):
 	new_dir = os.path.join(parent, name)
@@ -86,6 +130,83 @@ def createNewAssetFolders(parent, name):
 	addVersionedFolder(new_dir, 'model', 5)
 	return new_dir
 
+def isEmptyFolder(dirPath):
+	"""@returns: True if dirPath has nothing in it but hidden files"""
+	listing = walker.listDir(dirPath)
+	return listing is None or not listing.match('*')
+
+def _isProjectFolder(dirPath):
+	"""@returns: True if dirPath is a folder below PRODUCTION_DIR (not PRODUCTION_DIR itself)"""
+	production = os.path.normpath(os.path.abspath(getProductionDir()))
+	return os.path.normpath(os.path.abspath(dirPath)).startswith(production + os.sep) and os.path.isdir(dirPath)
+
+def _checkedOutBelow(dirPath):
+	"""@returns: the versioned folders at or below dirPath that are checked out, read from the file server"""
+	if isVersionedFolder(dirPath):
+		return [dirPath] if isCheckedOut(dirPath) else []
+	return [listing.path for listing in walker.walk(dirPath)
+		if listing.path != dirPath and listing.isVersioned() and isCheckedOut(listing.path)]
+
+def canRemove(dirPath):
+	"""
+	@returns: True if the project folder dirPath may be removed (or renamed): as far as the
+		asset index knows, none of the versioned folders at or below it is checked out
+	"""
+	if not _isProjectFolder(dirPath):
+		return False
+	index = getAssetIndex()
+	entries = index.descendants(dirPath, versionedOnly=True)
+	own = index.get(dirPath)
+	if own is not None:
+		entries.append(own)
+	return not any(e.versioned and e.lockedBy for e in entries)
+
+def canRename(dirPath):
+	"""@returns: True if the project folder dirPath may be renamed; a checkout would lose the folder it came from (see canRemove())"""
+	return canRemove(dirPath)
+
+def _checkMovable(dirPath, action):
+	if not _isProjectFolder(dirPath):
+		raise Exception("Can not " + action + " " + dirPath + ": it is not a project folder")
+	checkedOut = _checkedOutBelow(dirPath)
+	if checkedOut:
+		raise Exception("Can not " + action + " " + dirPath + ": checked out: " + ', '.join(checkedOut))
+
+def removeFolder(dirPath):
+	"""
+	Removes the project folder dirPath into the trash, where it can be restored until it is reaped (see trash)
+	@raises: Exception if it is not a project folder, or a versioned folder at or below it is checked out
+	"""
+	import trash
+	_checkMovable(dirPath, 'remove')
+	trash.moveToTrash(dirPath)
+	getAssetIndex().remove(dirPath)
+
+def renameFolder(dirPath, name):
+	"""
+	Renames the project folder dirPath to name, in the same parent folder
+	@raises: Exception if name is taken or not a folder name, or as removeFolder()
+	@returns: the new path
+	"""
+	if not name or name != os.path.basename(name) or name.startswith('.'):
+		raise Exception("Invalid folder name: " + name)
+	_checkMovable(dirPath, 'rename')
+	newPath = os.path.join(os.path.dirname(os.path.abspath(dirPath)), name)
+	if os.path.lexists(newPath):
+		raise Exception("Can not rename " + dirPath + ": " + name + " already exists")
+	os.rename(dirPath, newPath)
+	index = getAssetIndex()
+	index.remove(dirPath)
+	if isVersionedFolder(newPath):
+		_updateIndex(NodeInfo.load(newPath))
+		return newPath
+	for listing in walker.walk(newPath):
+		if listing.isVersioned():
+			_updateIndex(NodeInfo.load(listing.path))
+		else:
+			index.addFolder(listing.path)
+	return newPath
+
 def isVersionedFolder(dirPath):
 	if os.path.exists(os.path.join(dirPath, ".nodeInfo")):
 		return True
@@ -99,7 +220,50 @@ def isCheckedOutCopyFolder(dirPath):
 		return False
 
 def isInstalled(dirPath):
-	return bool(glob.glob(os.path.join(dirPath, 'stable', '*stable*')))
+	return bool(walker.stableInstalls(dirPath))
+
+VersionedFolderInfo = namedtuple('VersionedFolderInfo', ['path', 'lockedBy', 'lastCheckinUser',
+	'lastCheckinTime', 'latestComment', 'installed', 'installPath', 'latestVersion', 'leaseRemaining'])
+
+# folders read at once by getVersionedFolderInfoMany()
+INFO_THREADS = 8
+_infoPool = None
+_infoPoolLock = threading.Lock()
+
+def _getInfoPool():
+	global _infoPool
+	with _infoPoolLock:
+		if _infoPool is None:
+			from multiprocessing.pool import ThreadPool
+			_infoPool = ThreadPool(INFO_THREADS)
+		return _infoPool
+
+def _readVersionedFolderInfo(dirPath):
+	ni = NodeInfo.load(dirPath)
+	lease = _lease(dirPath, ni)
+	lockedBy, leaseRemaining = lease if lease is not None else ('', None)
+	installed = walker.stableInstalls(dirPath)
+	installPath = installed[0] if installed else ''
+	return VersionedFolderInfo(dirPath, lockedBy, ni.lastCheckinUser, ni.lastCheckinTime,
+		commentlog.latestComment(ni), bool(installed), installPath, ni.latestVersion, leaseRemaining)
+
+def _tryReadVersionedFolderInfo(dirPath):
+	try:
+		return _readVersionedFolderInfo(dirPath)
+	except Exception:
+		return None
+
+def getVersionedFolderInfoMany(dirPaths):
+	"""
+	Reads the metadata of many versioned folders at once, overlapping the file server
+	round trips on a pool of INFO_THREADS threads.
+	@returns: a list of VersionedFolderInfo in the order of dirPaths,
+		with None for folders that could not be read (not versioned, removed, ...)
+	"""
+	dirPaths = list(dirPaths)
+	if len(dirPaths) < 2:
+		return [_tryReadVersionedFolderInfo(d) for d in dirPaths]
+	return _getInfoPool().map(_tryReadVersionedFolderInfo, dirPaths)
 
 def getVersionedFolderInfo(dirPath):
 	"""
@@ -110,48 +274,24 @@ def getVersionedFolderInfo(dirPath):
 	[3] latest comment on checkin
 	[4] if it is isInstalled
 	[5] filepath to install directory
+	See getVersionedFolderInfoMany() for reading many folders.
 	"""
-	if not isVersionedFolder(dirPath):
-		raise Exception("Not a versioned folder")
-	
-	nodeInfo = []
-	cp = ConfigParser()
-	cp.read(os.path.join(dirPath, ".nodeInfo"))
-	if cp.getboolean("Versioning", "locked"):
-		nodeInfo.append(cp.get("Versioning", "lastcheckoutuser"))
-	else:
-		nodeInfo.append("")
-	nodeInfo.append(cp.get("Versioning", "lastcheckinuser"))
-	nodeInfo.append(cp.get("Versioning", "lastcheckintime"))
-	versionNum = int(cp.get("Versioning", "latestversion"))
-	latestVersion = "v"+("%03d" % versionNum) 
-	if cp.has_section("Comments"):
-		nodeInfo.append(cp.get("Comments", latestVersion))
-	else:
-		nodeInfo.append('')
-	if isInstalled(dirPath):
-		nodeInfo.append("Yes")
-		nodeInfo.append(glob.glob(os.path.join(dirPath, 'stable', '*stable*'))[0])
-	else:
-		nodeInfo.append("No")
-		nodeInfo.append("")
-	return nodeInfo
+	info = _readVersionedFolderInfo(dirPath)
+	return [info.lockedBy, info.lastCheckinUser, info.lastCheckinTime, info.latestComment,
+		"Yes" if info.installed else "No", info.installPath]
 
 def getLatestVersion(dirPath):
-	if not isVersionedFolder(dirPath):
-		raise Exception("Not a versioned folder")
-	cp = ConfigParser()
-	cp.read(os.path.join(dirPath, ".nodeInfo"))
-	return int(cp.get("Versioning", "latestversion"))
+	return NodeInfo.load(dirPath).latestVersion
 
 def getVersionComment(dirPath, version):
-	if not isVersionedFolder(dirPath):
-		raise Exception("Not a versioned folder")
-	
-	nodeInfo = []
-	cp = ConfigParser()
-	cp.read(os.path.join(dirPath, ".nodeInfo")) 
-	return cp.get("Comments",version)
+	return commentlog.getComment(NodeInfo.load(dirPath), version)
+
+def getVersionComments(dirPath):
+	"""
+	Returns a dict of 'vNNN' -> comment for every version of dirPath with a comment,
+	read from the comment journal in one pass
+	"""
+	return commentlog.allComments(NodeInfo.load(dirPath))
 
 def tempSetVersion(chkInDest, version):
     """
@@ -159,11 +299,11 @@ def tempSetVersion(chkInDest, version):
     Returns the version number that we override
     @precondition 'chkInDest' is a valid versioned folder
     """
-    nodeInfo = ConfigParser()
-    nodeInfo.read(os.path.join(chkInDest, ".nodeInfo"))
-    latestVersion = nodeInfo.get("Versioning", "latestversion")
-    nodeInfo.set("Versioning", "latestversion", str(version))
-    _writeConfigFile(os.path.join(chkInDest, ".nodeInfo"), nodeInfo)
+    nodeInfo = NodeInfo.load(chkInDest)
+    latestVersion = nodeInfo.latestVersion
+    nodeInfo.latestVersion = int(version)
+    nodeInfo.commit()
+    _updateIndex(nodeInfo)
     return latestVersion
 
 def setVersion(dirPath, version):	
@@ -175,32 +315,30 @@ def setVersion(dirPath, version):
 
     @postcondition: the folder will be checked in and unlocked
     """
+    import trash
 
-    chkoutInfo = ConfigParser()
-    chkoutInfo.read(os.path.join(dirPath, ".checkoutInfo"))
-    chkInDest = chkoutInfo.get("Checkout", "checkedoutfrom")
-    lockedbyme = chkoutInfo.getboolean("Checkout", "lockedbyme")
+    chkoutInfo = CheckoutInfo.load(dirPath)
+    chkInDest = chkoutInfo.checkedOutFrom
     
-    nodeInfo = ConfigParser()
-    nodeInfo.read(os.path.join(chkInDest, ".nodeInfo"))
-    newVersionPath = os.path.join(chkInDest, "src", "v"+("%03d" % version))
+    nodeInfo = NodeInfo.load(chkInDest)
 
-    if lockedbyme == False:
+    if chkoutInfo.lockedByMe == False:
         print "Cannot overwrite locked folder."
         raise Exception("Can not overwrite locked folder.")
         
     # Set version
-    timestamp = time.strftime("%a, %d %b %Y %I:%M:%S %p", time.localtime())
-    nodeInfo.set("Versioning", "lastcheckintime", timestamp)
-    nodeInfo.set("Versioning", "lastcheckinuser", getUsername())
-    nodeInfo.set("Versioning", "latestversion", str(version))
-    nodeInfo.set("Versioning", "locked", "False")
-    _writeConfigFile(os.path.join(chkInDest, ".nodeInfo"), nodeInfo)
+    nodeInfo.lastCheckinTime = nodeinfo.timestamp()
+    nodeInfo.lastCheckinUser = getUsername()
+    nodeInfo.latestVersion = int(version)
+    nodeInfo.locked = False
+    nodeInfo.lockToken = ''
     
     # Clean up
-    purgeAfter(os.path.join(chkInDest, "src"), version)
-    shutil.rmtree(dirPath)
-    #os.remove(os.path.join(newVersionPath, ".checkoutInfo"))
+    purgeAfter(os.path.join(chkInDest, "src"), version, nodeInfo)
+    nodeInfo.commit()
+    lockfile.release(chkInDest, getUsername())
+    _updateIndex(nodeInfo)
+    trash.moveToTrash(dirPath)
 
 #################################################################################
 # Checkout
@@ -211,264 +349,499 @@ def _createCheckoutInfoFile(dirPath, coPath, version, timestamp, lock):
 	@precondition: dirPath is a valid path
 	@postcondition: dirPath/.checkoutInfo contains complete [Checkout] section
 	"""
-	chkoutInfo = ConfigParser()
-	chkoutInfo.add_section("Checkout")
-	chkoutInfo.set("Checkout", "checkedoutfrom", coPath)
-	chkoutInfo.set("Checkout", "checkouttime", timestamp)
-	chkoutInfo.set("Checkout", "version", version)
-	chkoutInfo.set("Checkout", "lockedbyme", str(lock))
-	
-	_writeConfigFile(os.path.join(dirPath, ".checkoutInfo"), chkoutInfo)
+	CheckoutInfo(dirPath, coPath, timestamp, version, lock).commit()
+
+def _loadNodeInfo(dirPath):
+	"""Returns the NodeInfo for dirPath, or None if it is not a versioned folder"""
+	try:
+		return NodeInfo.load(dirPath)
+	except Exception:
+		return None
+
+def _lease(dirPath, nodeInfo):
+	"""
+	The lock on dirPath, evaluated now: an expired lease does not lock anything.
+	@returns: (user, seconds left on the lease or None if it does not expire), or None if dirPath is not locked
+	"""
+	held = lockfile.owner(dirPath)
+	if held is not None and not lockfile.isStale(dirPath, held):
+		return held.get('user') or nodeInfo.lastCheckoutUser, lockfile.remaining(held)
+	if nodeInfo.locked and not nodeInfo.lockToken:
+		# locked by older tools, without a lease
+		return nodeInfo.lastCheckoutUser, None
+	return None
 
 def isCheckedOut(dirPath):
-	nodeInfo = os.path.join(dirPath, ".nodeInfo")
-	if not os.path.exists(nodeInfo):
+	nodeInfo = _loadNodeInfo(dirPath)
+	if nodeInfo is None:
 		return False
-	cp = ConfigParser()
-	cp.read(nodeInfo)
-	return cp.getboolean("Versioning", "locked")
+	return _lease(dirPath, nodeInfo) is not None
 
 def checkedOutByMe(dirPath):
-	nodeInfo = os.path.join(dirPath, ".nodeInfo")
-	if not os.path.exists(nodeInfo):
+	nodeInfo = _loadNodeInfo(dirPath)
+	if nodeInfo is None:
 		return False
-	cp = ConfigParser()
-	cp.read(nodeInfo)
-	return cp.get("Versioning", "lastcheckoutuser") == getUsername()
+	return nodeInfo.lastCheckoutUser == getUsername()
 
 def getFilesCheckoutTime(filePath):
-	checkoutInfo = os.path.join(filePath, ".checkoutInfo")
-	#print checkoutInfo
-	if not os.path.exists(checkoutInfo):
-		raise Exception("No checkout info available")
-	cp = ConfigParser()
-	cp.read(checkoutInfo)
-	return cp.get("Checkout", "checkouttime")
+	return CheckoutInfo.load(filePath).checkoutTime
 
 def canCheckout(coPath):
-	result = True
-	if not os.path.exists(os.path.join(coPath, ".nodeInfo")):
-		result = False
-	nodeInfo = ConfigParser()
-	nodeInfo.read(os.path.join(coPath, ".nodeInfo"))
-	if nodeInfo.get("Versioning", "locked") == "True":
-		result = False
-	return result
+	nodeInfo = _loadNodeInfo(coPath)
+	if nodeInfo is None:
+		return False
+	return _lease(coPath, nodeInfo) is None
 
-def getCheckoutDest(coPath):
-	nodeInfo = ConfigParser()
-	nodeInfo.read(os.path.join(coPath, ".nodeInfo"))
-	version = nodeInfo.get("Versioning", "latestversion")
-	return os.path.join(getUserCheckoutDir(), os.path.basename(os.path.dirname(coPath))+"_"+os.path.basename(coPath)+"_"+("%03d" % int(version)))
+def getCheckoutDest(coPath, nodeInfo=None):
+	"""
+	@param nodeInfo: the already loaded NodeInfo for coPath, if the caller has one
+	"""
+	if nodeInfo is None:
+		nodeInfo = NodeInfo.load(coPath)
+	return os.path.join(getUserCheckoutDir(), os.path.basename(os.path.dirname(coPath))+"_"+os.path.basename(coPath)+"_"+("%03d" % nodeInfo.latestVersion))
 
-def lockedBy(logname):
+def lockedBy(logname, dirPath=None):
     """
     Returns a tuple containing the logname and the real name
+    If the versioned folder dirPath is given, the tuple has a third item: the seconds left
+    on the lease of its lock (0 if it is not locked, None if the lock does not expire).
 
     Raises a generic exception if real name cannot be determined.
     """
+    import pwd
 
     try: # Throws KeyError exception when the name cannot be found
         p = pwd.getpwnam( str(logname) )
     except KeyError as ke: # Re-throws KeyError as generic exception
         raise Exception( str(ke) )
 
+    if dirPath is not None:
+        lease = _lease(dirPath, NodeInfo.load(dirPath))
+        return p.pw_name, p.pw_gecos, (lease[1] if lease is not None else 0)
     return p.pw_name, p.pw_gecos # Return lockedBy tuple
 
-def checkout(coPath, lock):
+def _formatLease(seconds):
+	if seconds is None:
+		return 'does not expire'
+	return 'expires in %d min' % int((seconds + 59) // 60)
+
+def getVerifyCheckouts():
+	"""@returns: True if checkouts are checked against their version's manifest (RELIC_VERIFY_CHECKOUT=1)"""
+	return os.environ.get('RELIC_VERIFY_CHECKOUT', '0') == '1'
+
+def checkout(coPath, lock, verify=None, version=None):
 	"""
 	Copies the 'latest version' from the src folder into the local directory
 	@precondition: coPath is a path to a versioned folder
 	@precondition: lock is a boolean value
+	@param verify: check the copy against the version's manifest; getVerifyCheckouts() if not given
+	@param version: the version to copy instead of the latest one (to roll back to it, see rollback())
 	
 	@postcondition: A copy of the 'latest version' will be placed in the local directory
 		with the name of the versioned folder
-	@postdondition: If lock == True coPath will be locked until it is released by checkin
+	@postdondition: If lock == True coPath will be locked until it is released by checkin,
+		or until its lease expires (see renewLeases())
 	"""
-	#if not os.path.exists(os.path.join(coPath, ".nodeInfo")):
-	if not isVersionedFolder(coPath):
-		raise Exception("Not a versioned folder.")
-	
-	nodeInfo = ConfigParser()
-	nodeInfo.read(os.path.join(coPath, ".nodeInfo"))
-	if nodeInfo.get("Versioning", "locked") == "False":
-		version = nodeInfo.getint("Versioning", "latestversion")
-		toCopy = os.path.join(coPath, "src", "v"+("%03d" % version))
-		dest = getCheckoutDest(coPath)
+	token = None
+	if lock:
+		# taken before anything is copied: of any number of artists racing, exactly one gets it
+		token = lockfile.acquire(coPath, getUsername())
+		if token is None:
+			_raiseLocked(coPath, NodeInfo.load(coPath))
+	try:
+		return _checkout(coPath, token, verify, version)
+	except:
+		if token is not None:
+			lockfile.release(coPath, token=token)
+		raise
+
+def _raiseLocked(coPath, nodeInfo):
+	held = lockfile.owner(coPath)
+	if held is not None and held.get('user') and held.get('token') != nodeInfo.lockToken:
+		whoLocked = held['user']
+		whenLocked = time.strftime("%a, %d %b %Y %I:%M:%S %p", time.localtime(held['time']))
+	else:
+		whoLocked = nodeInfo.lastCheckoutUser
+		whenLocked = nodeInfo.lastCheckoutTime
+	lease = _lease(coPath, nodeInfo)
+	logname, realname = lockedBy(whoLocked)
+	whoLocked = 'User Name: ' + logname + '\nReal Name: ' + realname + '\n'
+	raise Exception("Can not checkout. Folder is locked by:\n\n"+ whoLocked+"\nat "+ whenLocked
+		+ ("\n\nThe lock " + _formatLease(lease[1]) + "." if lease is not None else ""))
+
+def _checkout(coPath, token, verify, version):
+	"""@param token: the lockfile grant of a locking checkout, None for one that does not lock"""
+	import shutil, blobstore, versioncache
+	nodeInfo = NodeInfo.load(coPath)
+	if token is None:
+		locked = _lease(coPath, nodeInfo) is not None
+	else:
+		# we hold the lock file: a lock with a lease can only be one that expired and was broken for us
+		locked = nodeInfo.locked and not nodeInfo.lockToken
+	if not locked:
+		if version is None:
+			version = nodeInfo.latestVersion
+		version = int(version)
+		toCopy = os.path.join(coPath, "src", versionName(version))
+		dest = getCheckoutDest(coPath, nodeInfo)
 		
 		if(os.path.exists(toCopy)):
+			if verify is None:
+				verify = getVerifyCheckouts()
+			try:
+				# copied from the file server into the workstation's cache once, and checked out from there
+				source = versioncache.fetch(coPath, version, toCopy)
+			except Exception as e:
+				print "asset_mgr_utils, checkout: version cache unavailable: " + str(e)
+				source = None
 			try:
-				shutil.copytree(toCopy, dest) # Make the copy
+				# Make the copy (see fileclone for the checkout modes); only a checkout that does not lock may hard link
+				stats = blobstore.materialize(source or toCopy, dest, verify=verify, writable=token is not None)
+				print "checkout: " + stats.summary()
+			except blobstore.IntegrityError as e:
+				print "asset_mgr_utils, checkout: " + str(e)
+				shutil.rmtree(dest, ignore_errors=True)
+				if source is not None:
+					# do not serve the bad copy again
+					versioncache.remove(source)
+				raise Exception("The checked in files are corrupt: " + str(e))
 			except Exception:
 				print "asset_mgr_utils, checkout: Could not copy files."
+				shutil.rmtree(dest, ignore_errors=True)
 				raise Exception("Could not copy files.")
-			timestamp = time.strftime("%a, %d %b %Y %I:%M:%S %p", time.localtime())
-			nodeInfo.set("Versioning", "lastcheckoutuser", getUsername())
-			nodeInfo.set("Versioning", "lastcheckouttime", timestamp)
-			nodeInfo.set("Versioning", "locked", str(lock))
+			timestamp = nodeinfo.timestamp()
+			nodeInfo.lastCheckoutUser = getUsername()
+			nodeInfo.lastCheckoutTime = timestamp
+			nodeInfo.locked = token is not None
+			nodeInfo.lockToken = token or ''
 			
-			_writeConfigFile(os.path.join(coPath, ".nodeInfo"), nodeInfo)
-			_createCheckoutInfoFile(dest, coPath, version, timestamp, lock)
+			nodeInfo.commit()
+			_updateIndex(nodeInfo)
+			_createCheckoutInfoFile(dest, coPath, version, timestamp, token is not None)
 		else:
 			raise Exception("Version doesn't exist "+toCopy)
 	else:
-		whoLocked = nodeInfo.get("Versioning", "lastcheckoutuser")
-		whenLocked = nodeInfo.get("Versioning", "lastcheckouttime")
-		logname, realname = lockedBy(whoLocked)
-		whoLocked = 'User Name: ' + logname + '\nReal Name: ' + realname + '\n'
-		raise Exception("Can not checkout. Folder is locked by:\n\n"+ whoLocked+"\nat "+ whenLocked)
+		_raiseLocked(coPath, nodeInfo)
 	return dest
 
+def findCheckout(dirPath):
+	"""@returns: the current user's checked out copy of the versioned folder dirPath, or None"""
+	dirPath = os.path.abspath(dirPath)
+	listing = walker.listDir(getUserCheckoutDir())
+	for e in (listing.entries if listing is not None else []):
+		try:
+			if CheckoutInfo.load(e.path).checkedOutFrom == dirPath:
+				return e.path
+		except Exception:
+			continue
+	return None
+
+def rollback(coPath, version):
+	"""
+	Replaces the current user's checkout of coPath, if any, with a locked checkout of version,
+	unpacking it from the archive first if it has been archived. Checking it in makes it the latest version.
+	@returns: the checked out copy
+	"""
+	if int(version) in getArchivedVersions(coPath):
+		rehydrateVersion(coPath, version)
+	current = findCheckout(coPath)
+	if current is not None:
+		discard(current)
+	return checkout(coPath, True, version=version)
+
 def unlock(ulPath):
+	import trash
 	
-	nodeInfo = ConfigParser()
-	nodeInfo.read(os.path.join(ulPath, ".nodeInfo"))
-	nodeInfo.set("Versioning", "locked", "False")
+	nodeInfo = NodeInfo.load(ulPath)
+	nodeInfo.locked = False
+	nodeInfo.lockToken = ''
 
-	toCopy = getCheckoutDest(ulPath)
-	dirname = os.path.basename(toCopy) 
+	toCopy = getCheckoutDest(ulPath, nodeInfo)
 	parentPath = os.path.join(os.path.dirname(toCopy), ".unlocked")
 	if not (os.path.exists(parentPath)):
 		os.mkdir(parentPath)
 
-	os.system('mv -f '+toCopy+' '+parentPath+'/')
-	_writeConfigFile(os.path.join(ulPath, ".nodeInfo"), nodeInfo)
+	if os.path.exists(toCopy):
+		unlocked = os.path.join(parentPath, os.path.basename(toCopy))
+		if os.path.exists(unlocked):
+			# replaced, like mv -f did
+			trash.moveToTrash(unlocked)
+		os.rename(toCopy, unlocked)
+	nodeInfo.commit()
+	lockfile.release(ulPath)
+	_updateIndex(nodeInfo)
 	return 0;
 
 def isLocked(ulPath):
-	nodeInfo = ConfigParser()
-	nodeInfo.read(os.path.join(ulPath, ".nodeInfo"))
-	if nodeInfo.get("Versioning", "locked") == "False":
-		return False;
-	
-	return True;
+	"""
+	@returns: False if ulPath is not locked; otherwise the seconds left on the lease of
+		its lock, or True for a lock that does not expire (taken by older tools)
+	"""
+	lease = _lease(ulPath, NodeInfo.load(ulPath))
+	if lease is None:
+		return False
+	if lease[1] is None:
+		return True
+	# an expired lease is not returned at all, so this is never 0
+	return max(lease[1], 1e-3)
+
+def renewLeases(user=None):
+	"""
+	Renews the lease of every versioned folder locked by a checkout of user (the current user by default).
+	@returns: the versioned folders whose leases were renewed
+	"""
+	if user is None:
+		user = getUsername()
+	checkoutDir = getUserCheckoutDir()
+	listing = walker.listDir(checkoutDir)
+	renewed = []
+	for e in (listing.entries if listing is not None else []):
+		try:
+			chkoutInfo = CheckoutInfo.load(e.path)
+		except Exception:
+			continue
+		if chkoutInfo.lockedByMe and lockfile.renew(chkoutInfo.checkedOutFrom, user) is not None:
+			renewed.append(chkoutInfo.checkedOutFrom)
+	return renewed
+
+_heartbeat = None
+_heartbeatLock = threading.Lock()
+
+def startLeaseHeartbeat():
+	"""
+	Keeps the leases of the current user's checkouts alive from this process (see renewLeases()),
+	until it exits; the leases then expire after lockfile.getLeaseTime() seconds.
+	"""
+	global _heartbeat
+	with _heartbeatLock:
+		if _heartbeat is None or not _heartbeat.is_alive():
+			renewLeases()
+			_heartbeat = lockfile.LeaseHeartbeat(renewLeases)
+			_heartbeat.start()
+		return _heartbeat
 
 ################################################################################
 # Checkin
 ################################################################################
-def canCheckin(toCheckin):
+def canCheckin(toCheckin, chkoutInfo=None, nodeInfo=None):
 	"""
+	@param chkoutInfo, nodeInfo: the already loaded CheckoutInfo/NodeInfo, if the caller has them
 	@returns: True if destination is not locked by another user
 		AND this checkin will not overwrite a newer version
 	"""
-	chkoutInfo = ConfigParser()
-	chkoutInfo.read(os.path.join(toCheckin, ".checkoutInfo"))
-	chkInDest = chkoutInfo.get("Checkout", "checkedoutfrom")
-	version = chkoutInfo.getint("Checkout", "version")
-	lockedbyme = chkoutInfo.getboolean("Checkout", "lockedbyme")
-	
-	nodeInfo = ConfigParser()
-	nodeInfo.read(os.path.join(chkInDest, ".nodeInfo"))
-	locked = nodeInfo.getboolean("Versioning", "locked")
-	latestVersion = nodeInfo.getint("Versioning", "latestversion")
+	if chkoutInfo is None:
+		chkoutInfo = CheckoutInfo.load(toCheckin)
+	if nodeInfo is None:
+		nodeInfo = NodeInfo.load(chkoutInfo.checkedOutFrom)
 	
 	result = True
-	if lockedbyme == False:
-		if locked == True:
+	if chkoutInfo.lockedByMe == False:
+		if nodeInfo.locked == True:
+			result = False
+		if chkoutInfo.version < nodeInfo.latestVersion:
 			result = False
-		if version < latestVersion:
+	else:
+		# the lease may have expired, and the folder been checked out or in by someone else since
+		lease = _lease(chkoutInfo.checkedOutFrom, nodeInfo)
+		if lease is not None and lease[0] != getUsername():
+			result = False
+		if not nodeInfo.locked or nodeInfo.lastCheckoutUser != getUsername():
 			result = False
 	
 	return result
 
+def _commentLine(comment, user=None):
+	timestamp = nodeinfo.timestamp()
+	if user is None:
+		user = getUsername()
+	return user + ': ' + timestamp + ': ' + '"' + comment + '"' 
+
 def setComment(toCheckin, comment):
-	chkoutInfo = ConfigParser()
-	chkoutInfo.read(os.path.join(toCheckin, ".checkoutInfo"))
-	chkInDest = chkoutInfo.get("Checkout", "checkedoutfrom")
+	"""
+	Records the comment for the version toCheckin will become.
+	The comment is appended to the comment journal; .nodeInfo is not rewritten.
+	"""
+	chkInDest = CheckoutInfo.load(toCheckin).checkedOutFrom
 
-	nodeInfo = ConfigParser()
-	nodeInfo.read(os.path.join(chkInDest, ".nodeInfo"))
-	newVersion = nodeInfo.getint("Versioning", "latestversion") + 1
-	timestamp = time.strftime("%a, %d %b %Y %I:%M:%S %p", time.localtime())
-	commentLine = getUsername() + ': ' + timestamp + ': ' + '"' + comment + '"' 
-	nodeInfo.set("Comments", 'v' + "%03d" % (newVersion,), commentLine)	
-	_writeConfigFile(os.path.join(chkInDest, ".nodeInfo"), nodeInfo)
+	nodeInfo = NodeInfo.load(chkInDest)
+	commentlog.append(chkInDest, nodeInfo.latestVersion + 1, _commentLine(comment))
 
-def purge(dirPath, nodeInfo, upto):
+def purgeVersions(dirPath, keep=None):
 	"""
-	purges all folders in dirPath with a version less than upto
+	Archives the versions of the versioned folder dirPath older than its latest version minus keep
+	(see archive.py), deletes the archives past the archive retention and their comments.
+	Checkins do not wait for this: the checkin job runs it once the new version is committed,
+	and "relic.py purge" runs it for folders checked in otherwise.
+	@param keep: its versionsToKeep if not given; 0 keeps all versions
+	@returns: the versions archived
 	"""
-	files = glob.glob(os.path.join(dirPath, '*'))
-	for f in files:
-		version = int(os.path.basename(f).split('v')[1])
+	import archive
+	nodeInfo = NodeInfo.load(dirPath)
+	if keep is None:
+		keep = nodeInfo.versionsToKeep
+	if keep <= 0:
+		return []
+	upto = nodeInfo.latestVersion - keep
+	archived = []
+	for version, f in walker.versionFolders(os.path.join(dirPath, "src")):
 		if version < upto:
-			shutil.rmtree(f)
-			nodeInfo.remove_option("Comments", 'v' + "%03d" % (version,))
+			archive.archiveVersion(dirPath, f)
+			archived.append(version)
+	expired = archive.expire(dirPath, nodeInfo.latestVersion)
+	if expired:
+		# read again: it may have been checked out or in while the versions were archived
+		nodeInfo = NodeInfo.load(dirPath)
+		for version in expired:
+			nodeInfo.removeComment(version)
+		nodeInfo.commit()
+		_updateIndex(nodeInfo)
+	return archived
+
+def getArchivedVersions(dirPath):
+	"""@returns: the numbers of the archived versions of the versioned folder dirPath"""
+	import archive
+	return [version for version, archivePath in archive.archivedVersions(dirPath)]
+
+def rehydrateVersion(dirPath, version):
+	"""
+	Makes an archived version of dirPath a version folder again, so it can be checked out
+	@returns: the version folder
+	"""
+	import archive
+	return archive.rehydrate(dirPath, int(version))
 
-def purgeAfter(dirPath, after):
+def purgeAfter(dirPath, after, nodeInfo=None):
     """
-    purges all folders in dirPath with a version higher than after
+    purges all folders in dirPath with a version higher than after (into the trash, see trash.py),
+    and removes their comments from nodeInfo, if given (the caller commits it)
     """
-    files = glob.glob(os.path.join(dirPath, '*'))
-    for f in files:
-        if int(os.path.basename(f).split('v')[1]) > after:
-            shutil.rmtree(f)
+    import trash
+    for version, f in walker.versionFolders(dirPath):
+        if version > after:
+            trash.moveToTrash(f)
+            if nodeInfo is not None:
+                nodeInfo.removeComment(version)
 
 def discard(toDiscard):
 	"""
 	Discards a local checked out folder without creating a new version.
 	"""
+	import trash
 	print toDiscard
-	chkoutInfo = ConfigParser()
-	chkoutInfo.read(os.path.join(toDiscard, ".checkoutInfo"))
-	chkInDest = chkoutInfo.get("Checkout", "checkedoutfrom")
-
-	nodeInfo = ConfigParser()
-	nodeInfo.read(os.path.join(chkInDest, ".nodeInfo"))
+	chkoutInfo = CheckoutInfo.load(toDiscard)
+	chkInDest = chkoutInfo.checkedOutFrom
 
-	nodeInfo.set("Versioning", "locked", "False")
-	_writeConfigFile(os.path.join(chkInDest, ".nodeInfo"), nodeInfo)
+	if chkoutInfo.lockedByMe:
+		nodeInfo = NodeInfo.load(chkInDest)
+		nodeInfo.locked = False
+		nodeInfo.lockToken = ''
+		nodeInfo.commit()
+		lockfile.release(chkInDest, getUsername())
+		_updateIndex(nodeInfo)
 
-	shutil.rmtree(toDiscard)
-	if(os.path.exists(toDiscard)):
-		os.rmdir(toDiscard)
+	trash.moveToTrash(toDiscard)
 
 def getCheckinDest(toCheckin):
-	chkoutInfo = ConfigParser()
-	chkoutInfo.read(os.path.join(toCheckin, ".checkoutInfo"))
-	return chkoutInfo.get("Checkout", "checkedoutfrom")
+	return CheckoutInfo.load(toCheckin).checkedOutFrom
+
+def _printCheckinReport(stats):
+	print "checkin: %d files (%d bytes), %d hashed, %d written (%d bytes) in %.2f s" % (
+		stats.files, stats.bytes, stats.hashedFiles, stats.newFiles, stats.newBytes, stats.seconds)
+	for relPath, written in stats.transferred:
+		print "  %s (%d bytes)" % (relPath, written)
+	if stats.unlinkedFiles:
+		print "checkin: %d files are not shared with other versions (see blobstore)" % stats.unlinkedFiles
+
+def _commitCheckin(nodeInfo, version, comment, user):
+	"""Makes version, already published in src, the latest version of nodeInfo and unlocks it"""
+	chkInDest = nodeInfo.dirPath
+	if comment is not None:
+		commentlog.append(chkInDest, version, _commentLine(comment, user))
+	nodeInfo.lastCheckinTime = nodeinfo.timestamp()
+	nodeInfo.lastCheckinUser = user
+	nodeInfo.latestVersion = version
+	nodeInfo.locked = False
+	nodeInfo.lockToken = ''
+	
+	nodeInfo.commit()
+	lockfile.release(chkInDest, user)
+	_updateIndex(nodeInfo)
+
+def _removeWorkingCopy(toCheckin, chkInDest):
+	"""Removes the checked in folder toCheckin, unless it has been checked out again since"""
+	import shutil
+	try:
+		if CheckoutInfo.load(toCheckin).checkedOutFrom != chkInDest:
+			return
+	except Exception:
+		if not os.path.exists(toCheckin):
+			return
+	shutil.rmtree(toCheckin)
 
-def checkin(toCheckin):
+def checkin(toCheckin, comment=None, progress=None):
 	"""
 	Checks a folder back in as the newest version
+	Reads and writes the versioned folder's metadata exactly once.
+	The new version is stored in a hidden staging folder and published with a single
+	rename, and every step is recorded in the intent journal, so a checkin that is
+	interrupted can be finished or rolled back by journal.recover().
 	@precondition: toCheckin is a valid path
 	@precondition: canCheckin() == True OR all conflicts have been resolved
+	@param comment: if given, recorded as the new version's comment (see setComment())
+	@param progress: called as progress(bytes done, bytes total) while the files are stored
 	"""
+	import shutil, blobstore, journal
 	print toCheckin
-	chkoutInfo = ConfigParser()
-	chkoutInfo.read(os.path.join(toCheckin, ".checkoutInfo"))
-	chkInDest = chkoutInfo.get("Checkout", "checkedoutfrom")
-	lockedbyme = chkoutInfo.getboolean("Checkout", "lockedbyme")
+	toCheckin = os.path.abspath(toCheckin)
+	chkoutInfo = CheckoutInfo.load(toCheckin)
+	chkInDest = chkoutInfo.checkedOutFrom
 	
-	nodeInfo = ConfigParser()
-	nodeInfo.read(os.path.join(chkInDest, ".nodeInfo"))
-	locked = nodeInfo.getboolean("Versioning", "locked")
-	toKeep = nodeInfo.getint("Versioning", "Versionstokeep")
-	newVersion = nodeInfo.getint("Versioning", "latestversion") + 1
-	newVersionPath = os.path.join(chkInDest, "src", "v"+("%03d" % newVersion))
+	pending = journal.read(chkInDest)
+	if pending is not None:
+		if journal.recover(chkInDest) is None:
+			raise Exception("Another checkin of this folder is in progress.")
+		if not os.path.exists(toCheckin):
+			print "An interrupted checkin of this folder has been finished."
+			return chkInDest
+		# the recovered operation may have changed it
+		chkoutInfo = CheckoutInfo.load(toCheckin)
 	
-	if not canCheckin(toCheckin):
+	nodeInfo = NodeInfo.load(chkInDest)
+	newVersion = nodeInfo.latestVersion + 1
+	newVersionPath = os.path.join(chkInDest, "src", versionName(newVersion))
+	
+	if not canCheckin(toCheckin, chkoutInfo, nodeInfo):
 		print "Can not overwrite locked folder."
 		raise Exception("Can not overwrite locked folder.")
 	
-	# Checkin
-	shutil.copytree(toCheckin, newVersionPath)
-	
-	timestamp = time.strftime("%a, %d %b %Y %I:%M:%S %p", time.localtime())
-	nodeInfo.set("Versioning", "lastcheckintime", timestamp)
-	nodeInfo.set("Versioning", "lastcheckinuser", getUsername())
-	nodeInfo.set("Versioning", "latestversion", str(newVersion))
-	nodeInfo.set("Versioning", "locked", "False")
-	_writeConfigFile(os.path.join(chkInDest, ".nodeInfo"), nodeInfo)
-	
-	#print glob.glob(os.path.join(chkInDest, "src", "*"))
-	if toKeep > 0:
-		purge(os.path.join(chkInDest, "src"), nodeInfo, newVersion - toKeep)
-		_writeConfigFile(os.path.join(chkInDest, ".nodeInfo"), nodeInfo)
+	# Checkin: only files changed since the checked out version are read, and only new ones written
+	baseVersionPath = os.path.join(chkInDest, "src", versionName(chkoutInfo.version))
+	staging = os.path.join(chkInDest, "src", ".staging.%s.%s.%d" % (versionName(newVersion), socket.gethostname(), os.getpid()))
+	intent = journal.begin(chkInDest, 'checkin', version=newVersion, staging=staging, toCheckin=toCheckin,
+		comment=comment, user=getUsername())
+	try:
+		try:
+			stats = blobstore.storeTree(toCheckin, staging, base=baseVersionPath, progress=progress)
+			if os.path.exists(newVersionPath):
+				raise Exception(versionName(newVersion) + " has been checked in by someone else.")
+			os.rename(staging, newVersionPath)
+		except Exception:
+			# nothing is published: leave the folder locked, without a half written version
+			shutil.rmtree(staging, ignore_errors=True)
+			journal.clear(chkInDest)
+			raise
+		journal.advance(chkInDest, intent, journal.PUBLISHED)
+		_printCheckinReport(stats)
+		
+		_commitCheckin(nodeInfo, newVersion, comment, getUsername())
+		journal.advance(chkInDest, intent, journal.COMMITTED)
 
-	# Clean up
-	shutil.rmtree(toCheckin)
-	os.remove(os.path.join(newVersionPath, ".checkoutInfo"))
+		# Clean up
+		_removeWorkingCopy(toCheckin, chkInDest)
+		journal.clear(chkInDest)
+	finally:
+		# an intent left behind by a failure is now recovered by the next checkin (see journal.isStale())
+		journal.end(intent)
 
 	return chkInDest
 
@@ -482,35 +855,17 @@ if it is empty, it returns it
 otherwise creates the next version folder and returns it
 '''
 def set_version(filepath, prefix=''):
-    searchpath = os.path.join(filepath, '*')
-    files = glob.glob(searchpath)
-    versions = [f for f in files if os.path.isdir(f)]
-    versions.sort()
-    length = len(versions)
+    versions = walker.versionFolders(filepath, prefix)
     # print versions
-    if length > 0:
-        latest = versions[-1]
-        index = 0
-        v = os.path.basename(latest)
-        # make sure it is a versioned folder
-        match = False
-        while index < length:
-            latest = versions[-1-index]
-            v = os.path.basename(latest)
-            index += 1
-            if re.match(prefix+'v[0-9]+', v):
-                match = True
-                break
-        if match:
-            # if it's empty use it
-            if not os.listdir(latest):
-                return latest
-        else:
-            v = prefix+'v000'
+    if len(versions) > 0:
+        latest_int, latest = versions[-1]
+        # if it's empty use it
+        if not walker.listDir(latest).entries:
+            return latest
     else:
-        v = prefix+'v000'
+        latest_int = 0
     
-    latest_int = int(v[-3:])+1
+    latest_int = latest_int+1
     latest = os.path.join(filepath,prefix+'v'+'%03d'%latest_int)
 
     os.mkdir(latest)
@@ -0,0 +1,216 @@
+"""
+This module contains the workstation's cache of recently checked out versions.
+
+A checkout of a version with a manifest copies it from the file server into the
+cache once, then makes the checkout from the cached copy, so discarding and
+checking out again, or rolling back and forth, does not read the version's files
+from the file server again (only .nodeInfo and the manifest are read to find the
+entry). An entry is keyed by (versioned folder, version, hash of the manifest),
+so a version that is replaced or re-published is never served stale.
+
+The cache lives in RELIC_CACHE_DIR (/var/tmp/relic-cache-$USER by default, which
+should be a local disk) and holds at most RELIC_CACHE_BYTES bytes (20 GB by
+default, 0 turns it off); the least recently used entries are evicted first.
+Entry names are predictable, so the cache is only used while its folder belongs
+to the user and nobody else can write to it: anybody could create it first in
+/var/tmp and plant altered versions.
+Warm it for the assets you are about to work on with
+
+	python versioncache.py prefetch <versioned folder> ...
+"""
+
+import os, sys, stat, time, errno, shutil, hashlib, socket
+
+import blobstore
+from nodeinfo import NodeInfo, versionName
+
+DEFAULT_MAX_BYTES = 20 << 30
+
+def getCacheDir():
+	if 'RELIC_CACHE_DIR' in os.environ:
+		return os.environ['RELIC_CACHE_DIR']
+	return os.path.join('/var/tmp', 'relic-cache-' + os.environ.get('USER', 'unknown'))
+
+def getMaxBytes():
+	return int(os.environ.get('RELIC_CACHE_BYTES', DEFAULT_MAX_BYTES))
+
+def isEnabled():
+	return getMaxBytes() > 0
+
+def _ownCacheDir(create=False):
+	"""
+	@param create: create the cache folder if it does not exist yet
+	@returns: getCacheDir(), or None if it does not exist or is not safe to use (see the module docstring)
+	"""
+	cacheDir = getCacheDir()
+	if create and not os.path.lexists(cacheDir):
+		try:
+			os.makedirs(cacheDir, 0700)
+		except OSError as e:
+			if e.errno != errno.EEXIST:
+				raise
+	try:
+		st = os.lstat(cacheDir)
+	except OSError:
+		return None
+	if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+		print "versioncache: not using " + cacheDir + ": it must be a folder of this user that only it can write to"
+		return None
+	return cacheDir
+
+def _manifestHash(versionDir):
+	"""@returns: the SHA-256 of versionDir's manifest, or None if it has none"""
+	try:
+		f = open(os.path.join(versionDir, blobstore.MANIFEST), 'rb')
+	except IOError:
+		return None
+	try:
+		return hashlib.sha256(f.read()).hexdigest()
+	finally:
+		f.close()
+
+def entryName(dirPath, version, manifestHash):
+	return '%s-%s-%s' % (hashlib.sha1(os.path.abspath(dirPath)).hexdigest()[:16], versionName(version), manifestHash[:16])
+
+def _entrySize(entryDir):
+	manifest = blobstore.readManifest(entryDir)
+	if manifest is None:
+		return 0
+	return sum(entry['size'] for entry in manifest['files'].values())
+
+def entries():
+	"""@returns: (last used, bytes, path) of each cache entry, least recently used first"""
+	cacheDir = _ownCacheDir()
+	if cacheDir is None:
+		return []
+	try:
+		names = os.listdir(cacheDir)
+	except OSError:
+		return []
+	result = []
+	for name in names:
+		if name.startswith('.'):
+			continue
+		entryDir = os.path.join(cacheDir, name)
+		try:
+			lastUsed = os.stat(entryDir).st_mtime
+		except OSError:
+			continue
+		result.append((lastUsed, _entrySize(entryDir), entryDir))
+	result.sort()
+	return result
+
+def remove(entryDir):
+	"""Removes the cache entry entryDir"""
+	# renamed out of the way first, so no checkout can start from a half deleted entry
+	doomed = os.path.join(os.path.dirname(entryDir), '.evicted.%s.%s.%d' % (os.path.basename(entryDir), socket.gethostname(), os.getpid()))
+	try:
+		os.rename(entryDir, doomed)
+	except OSError:
+		return
+	shutil.rmtree(doomed, ignore_errors=True)
+
+def evict(needed=0, maxBytes=None):
+	"""
+	Removes the least recently used entries until needed more bytes fit in maxBytes.
+	@returns: the number of entries removed
+	"""
+	if maxBytes is None:
+		maxBytes = getMaxBytes()
+	cached = entries()
+	total = sum(size for lastUsed, size, entryDir in cached)
+	removed = 0
+	for lastUsed, size, entryDir in cached:
+		if total + needed <= maxBytes:
+			break
+		remove(entryDir)
+		total -= size
+		removed += 1
+	return removed
+
+def lookup(dirPath, version, versionDir=None):
+	"""@returns: the valid cache entry of version of dirPath, or None"""
+	if versionDir is None:
+		versionDir = os.path.join(dirPath, 'src', versionName(version))
+	manifestHash = _manifestHash(versionDir)
+	if manifestHash is None:
+		return None
+	cacheDir = _ownCacheDir()
+	if cacheDir is None:
+		return None
+	entryDir = os.path.join(cacheDir, entryName(dirPath, version, manifestHash))
+	if not os.path.isdir(entryDir):
+		return None
+	# most recently used
+	os.utime(entryDir, None)
+	return entryDir
+
+def fetch(dirPath, version, versionDir=None):
+	"""
+	Makes sure version of the versioned folder dirPath is in the cache, copying it from
+	the file server if it is not.
+	@returns: the cache entry, or None if the version can not be cached (no manifest,
+		larger than the cache, the cache is turned off or its folder is not safe to use)
+	"""
+	if not isEnabled():
+		return None
+	if versionDir is None:
+		versionDir = os.path.join(dirPath, 'src', versionName(version))
+	entryDir = lookup(dirPath, version, versionDir)
+	if entryDir is not None:
+		return entryDir
+	manifestHash = _manifestHash(versionDir)
+	if manifestHash is None:
+		return None
+	size = _entrySize(versionDir)
+	if size > getMaxBytes():
+		return None
+	cacheDir = _ownCacheDir(create=True)
+	if cacheDir is None:
+		return None
+	evict(size)
+	entryDir = os.path.join(cacheDir, entryName(dirPath, version, manifestHash))
+	staging = os.path.join(cacheDir, '.incoming.%s.%s.%d' % (os.path.basename(entryDir), socket.gethostname(), os.getpid()))
+	try:
+		# a plain copy: the cache must not share inodes with the file server
+		blobstore.materialize(versionDir, staging, 'copy')
+		# copy the manifest exactly, so the entry can be checked out (and verified) like the version
+		shutil.copy2(os.path.join(versionDir, blobstore.MANIFEST), os.path.join(staging, blobstore.MANIFEST))
+		os.rename(staging, entryDir)
+	except OSError as e:
+		shutil.rmtree(staging, ignore_errors=True)
+		if e.errno in (errno.ENOTEMPTY, errno.EEXIST) and os.path.isdir(entryDir):
+			# cached by another checkout meanwhile
+			return entryDir
+		raise
+	except:
+		shutil.rmtree(staging, ignore_errors=True)
+		raise
+	return entryDir
+
+def prefetch(dirPaths, version=None):
+	"""
+	Warms the cache with the latest version (or version) of each versioned folder in dirPaths.
+	@returns: (versioned folder, cache entry or None) of each
+	"""
+	fetched = []
+	for dirPath in dirPaths:
+		v = version
+		if v is None:
+			v = NodeInfo.load(dirPath).latestVersion
+		fetched.append((dirPath, fetch(dirPath, v)))
+	return fetched
+
+if __name__ == '__main__':
+	args = sys.argv[1:]
+	if args and args[0] == 'prefetch' and len(args) > 1:
+		for dirPath, entryDir in prefetch(args[1:]):
+			print dirPath + ': ' + (entryDir or 'not cacheable')
+	elif args == ['list']:
+		for lastUsed, size, entryDir in entries():
+			print '%s %12d %s' % (time.strftime('%Y-%m-%d %H:%M', time.localtime(lastUsed)), size, entryDir)
+	elif args == ['clear']:
+		print '%d entries removed' % evict(maxBytes=0)
+	else:
+		print 'usage: versioncache.py prefetch <versioned folder> ... | list | clear'
+		sys.exit(2)
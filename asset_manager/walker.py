@@ -0,0 +1,126 @@
+"""
+This module contains the directory listing and walking shared by the asset operations.
+
+A directory is read once and what the asset operations need is taken from that
+one listing: whether it is a versioned folder or a checked out copy, its version
+folders and its stable installs. Listings use os.scandir (or the scandir package
+on older Pythons), whose entries carry the file type returned by readdir, so
+telling folders from files needs no stat per entry. Without scandir, os.listdir
+is used and entries are only stat'ed when asked whether they are a directory.
+"""
+
+import os, re, stat, fnmatch
+
+from nodeinfo import NODE_INFO, CHECKOUT_INFO
+
+try:
+	from os import scandir as _scandir
+except ImportError:
+	try:
+		from scandir import scandir as _scandir
+	except ImportError:
+		_scandir = None
+
+def hasScandir():
+	return _scandir is not None
+
+class _ListdirEntry(object):
+	"""The part of os.DirEntry used here, for when scandir is not available"""
+	__slots__ = ('name', 'path', '_isDir')
+
+	def __init__(self, dirPath, name):
+		self.name = name
+		self.path = os.path.join(dirPath, name)
+		self._isDir = None
+
+	def is_dir(self):
+		if self._isDir is None:
+			try:
+				self._isDir = stat.S_ISDIR(os.stat(self.path).st_mode)
+			except OSError:
+				self._isDir = False
+		return self._isDir
+
+class Listing(object):
+	"""
+	The entries of one directory, read with a single listing.
+	Hidden entries (.nodeInfo, .checkoutInfo, ...) are only used to classify the directory.
+	"""
+	__slots__ = ('path', 'entries', 'names')
+
+	def __init__(self, path, entries):
+		self.path = path
+		self.entries = entries
+		self.names = set(e.name for e in entries)
+
+	def isVersioned(self):
+		return NODE_INFO in self.names
+
+	def isCheckout(self):
+		return CHECKOUT_INFO in self.names
+
+	def dirs(self):
+		"""@returns: the entries of the directories in this one that are not hidden"""
+		return [e for e in self.entries if not e.name.startswith('.') and e.is_dir()]
+
+	def match(self, pattern):
+		"""@returns: the entries whose name matches the glob pattern, as glob.glob would (hidden names only match a pattern starting with '.')"""
+		if not pattern.startswith('.'):
+			return [e for e in self.entries if not e.name.startswith('.') and fnmatch.fnmatch(e.name, pattern)]
+		return [e for e in self.entries if fnmatch.fnmatch(e.name, pattern)]
+
+	def versions(self, prefix=''):
+		"""
+		@returns: (version number, path) of each version folder (prefix + 'vNNN') in this
+			directory, sorted by version number
+		"""
+		pattern = re.compile(re.escape(prefix) + r'v([0-9]+)$')
+		versions = []
+		for e in self.entries:
+			m = pattern.match(e.name)
+			if m and e.is_dir():
+				versions.append((int(m.group(1)), e.path))
+		versions.sort()
+		return versions
+
+def listDir(path):
+	"""@returns: a Listing of path, or None if path is not a readable directory"""
+	try:
+		if _scandir is not None:
+			# scandir is lazy, so errors show up while iterating
+			entries = list(_scandir(path))
+		else:
+			entries = [_ListdirEntry(path, name) for name in os.listdir(path)]
+	except OSError:
+		return None
+	return Listing(path, entries)
+
+def versionFolders(dirPath, prefix=''):
+	"""@returns: (version number, path) of each version folder in dirPath (see Listing.versions), [] if it does not exist"""
+	listing = listDir(dirPath)
+	if listing is None:
+		return []
+	return listing.versions(prefix)
+
+def stableInstalls(dirPath):
+	"""@returns: the paths of the installed stable files of the versioned folder dirPath"""
+	listing = listDir(os.path.join(dirPath, 'stable'))
+	if listing is None:
+		return []
+	return sorted(e.path for e in listing.match('*stable*'))
+
+def walk(top):
+	"""
+	Yields a Listing of top and of every directory below it, parents before children.
+	Hidden directories are skipped, and versioned folders below top are listed but not
+	descended into.
+	"""
+	pending = [top]
+	while pending:
+		listing = listDir(pending.pop())
+		if listing is None:
+			continue
+		yield listing
+		if listing.path != top and listing.isVersioned():
+			continue
+		pending.extend(sorted((e.path for e in listing.dirs()), reverse=True))
@@ -20,7 +20,8 @@
 #### must be the name of the file where your python script is 
 #### stored. (Careful, it's not an absolute path!)
 ####
-from pymel.core import *
+import maya.cmds as cmds
+import maya.mel as mel
 import os
 import sys
 import json
@@ -41,7 +42,7 @@ def BYU_load_shelf():
     BYU_delete_shelf()
 
     gShelfTopLevel = mel.eval('global string $gShelfTopLevel; string $temp=$gShelfTopLevel')
-    shelfLayout(PROJ, cellWidth=33, cellHeight=33, p=gShelfTopLevel)
+    cmds.shelfLayout(PROJ, cellWidth=33, cellHeight=33, p=gShelfTopLevel)
 
     #### Okay, for some reason, deleting the shelf from a shelf button crashes Maya.
     #### I'm saving this for another day, or for someone more adventurous.
@@ -56,12 +57,32 @@ def BYU_load_shelf():
         icon = os.path.join(ICON_DIR, button['icon'])
         annotation = button['annotation']
         python_file = button['python_file'][:-3]
-        shelfButton(command="import %s; %s.go()"%(python_file, python_file),
+        cmds.shelfButton(command="import %s; %s.go()"%(python_file, python_file),
                     annotation=annotation, image=icon)
 
 def BYU_delete_shelf():
-    if shelfLayout(PROJ, exists=True):
-        deleteUI(PROJ)
+    if cmds.shelfLayout(PROJ, exists=True):
+        cmds.deleteUI(PROJ)
+
+def BYU_start_lease_heartbeat():
+    #### Keeps the locks on this artist's checkouts alive while Maya runs;
+    #### if Maya crashes they expire on their own.
+    try:
+        import utilities
+    except ImportError:
+        return
+    utilities.startLeaseHeartbeat()
+
+def BYU_connect_metadata_daemon():
+    #### Shares the metadata cache of the workstation's metadata daemon
+    #### with the asset manager and the other Maya sessions.
+    try:
+        import utilities
+    except ImportError:
+        return
+    utilities.connectMetadataDaemon()
 
 BYU_load_shelf()
+BYU_connect_metadata_daemon()
+BYU_start_lease_heartbeat()
 
@@ -2,21 +2,23 @@ from PyQt4.QtCore import *
 from PyQt4.QtGui import *
 
 import maya.cmds as cmds
-import maya.OpenMayaUI as omu
-from pymel.core import *
+import maya.mel as mel
 import utilities as amu #asset manager utilities
 import os
-import sip
 
 WINDOW_WIDTH = 250
 WINDOW_HEIGHT = 120
 
 def maya_main_window():
+	import maya.OpenMayaUI as omu
+	import sip
 	ptr = omu.MQtUtil.mainWindow()
 	return sip.wrapinstance(long(ptr), QObject)		
 
 class FbxExportDialog(QDialog):
-	def __init__(self, parent=maya_main_window()):
+	def __init__(self, parent=None):
+		if parent is None:
+			parent = maya_main_window()
 		QDialog.__init__(self, parent)
 		self.saveFile()
 		self.setWindowTitle('Select Export Type')
@@ -78,12 +80,12 @@ class FbxExportDialog(QDialog):
 	def export_obj(self, objType, isEnviron):
 		self.saveFile()
 
-		loadPlugin("fbxmaya")
+		cmds.loadPlugin("fbxmaya", quiet=True)
 		exportFilePath = self.build_export_filepath(objType, isEnviron)
 		print exportFilePath
 		command = self.build_export_command(exportFilePath)
 		print command
-		Mel.eval(command)
+		mel.eval(command)
 		
 		self.close_dialog()
 	
@@ -1,5 +1,6 @@
 import maya.cmds as cmds
 import utilities as amu #asset manager utilities
+import checkinjobs
 import os
 
 def saveFile():
@@ -47,17 +48,51 @@ def checkin():
                     comment = cmds.promptDialog(query=True, text=True);
                 else:
                     return
-                amu.setComment(toCheckin, comment)
                 dest = amu.getCheckinDest(toCheckin)
 
                 saveFile()
                 cmds.file(force=True, new=True) #open new file
-                dest = amu.checkin(toCheckin) #checkin
+                job = checkinjobs.submit(toCheckin, comment) #checkin in the background
+                print 'checkin started: ' + job.id
         else:
                 showFailDialog()
 
+def reportJobs():
+        """Tells the artist about the background checkins that finished since the last report"""
+        for job in checkinjobs.finishedJobs():
+                name = os.path.basename(job.toCheckin)
+                if job.state == checkinjobs.FAILED:
+                        cmds.confirmDialog( title         = 'Checkin Failed'
+                                          , message       = 'Checkin of ' + name + ' was unsuccessful:\r\n' + job.error
+                                                          + '\r\nIt is still checked out.'
+                                          , button        = ['Ok']
+                                          , defaultButton = 'Ok'
+                                          , cancelButton  = 'Ok'
+                                          , dismissString = 'Ok')
+                else:
+                        print 'checkin of ' + name + ' finished'
+                checkinjobs.forget(job.id)
+
+def showStatus():
+        """Shows the background checkins still running, then reports the finished ones"""
+        lines = []
+        for job in checkinjobs.activeJobs():
+                line = os.path.basename(job.toCheckin) + ': ' + job.state
+                if job.total:
+                        line += ' (%d%%)' % (job.done * 100 / job.total)
+                lines.append(line)
+        if lines:
+                cmds.confirmDialog( title         = 'Checkins'
+                                  , message       = '\r\n'.join(lines)
+                                  , button        = ['Ok']
+                                  , defaultButton = 'Ok'
+                                  , cancelButton  = 'Ok'
+                                  , dismissString = 'Ok')
+        reportJobs()
+
 def go():
         try:
+                reportJobs()
                 checkin()
         except Exception as ex:
                 msg = "RuntimeException:" + str(ex)
@@ -2,9 +2,7 @@ from PyQt4.QtCore import *
 from PyQt4.QtGui import *
 
 import maya.cmds as cmd
-import maya.OpenMayaUI as omu
-import sip
-import os, glob
+import os
 import shutil
 import utilities as amu
 
@@ -12,6 +10,8 @@ CHECKOUT_WINDOW_WIDTH = 340
 CHECKOUT_WINDOW_HEIGHT = 575
 
 def maya_main_window():
+	import maya.OpenMayaUI as omu
+	import sip
 	ptr = omu.MQtUtil.mainWindow()
 	return sip.wrapinstance(long(ptr), QObject)
 
@@ -33,9 +33,11 @@ class CheckoutContext:
 		self.tree = QListWidget()
 		#self.tree.setColumnCount(1)
 		self.tree.setSizePolicy(QSizePolicy.Preferred, QSizePolicy.Expanding)
-		folders = glob.glob(os.path.join(self.folder, '*'))
-		for f in folders:
-			bname = os.path.basename(f)
+		# list the assets from the local index rather than the file server, rescanned for what
+		# other workstations created or checked in since (only changed folders are re-read)
+		index = amu.getAssetIndex(self.folder, rescan=True)
+		for entry in index.children(self.folder):
+			bname = entry.name
 			item = QListWidgetItem(bname)
 			item.setText(bname)
 			self.tree.addItem(item)
@@ -75,7 +77,10 @@ class CheckoutContext:
 
 
 class CheckoutDialog(QDialog):
-	def __init__(self, parent=maya_main_window()):
+	def __init__(self, parent=None):
+		# the main window is looked up when the dialog opens, not when this module is imported
+		if parent is None:
+			parent = maya_main_window()
 		#Setup the different checkout contexts
 		self.contexts = [
 			CheckoutContext(self, 'Model', os.environ['ASSETS_DIR'], 'model')
@@ -231,6 +236,7 @@ class CheckoutDialog(QDialog):
 		
 		try:
 			destpath = amu.checkout(toCheckout, True)
+			amu.startLeaseHeartbeat()
 		except Exception as e:
 			print str(e)
 			if not amu.checkedOutByMe(toCheckout):
@@ -272,15 +278,21 @@ class CheckoutDialog(QDialog):
 		
 	def show_node_info(self):
 		filePath = self.get_asset_path()
-		node_info = amu.getVersionedFolderInfo(filePath)
-		checkout_str = node_info[0]
+		node_info = amu.getVersionedFolderInfoMany([filePath])[0]
+		if node_info is None:
+			self.asset_info_label.hide()
+			self.unlock_button.setEnabled(False)
+			return
+		checkout_str = node_info.lockedBy
 		self.unlock_button.setEnabled(checkout_str != '')
 		if (checkout_str == ''):
 			checkout_str = '<font color="#6EFF81">Not checked out.</font>'
 		else:
-			checkout_str = '<font color="#FF6E6E">Checked out by '+node_info[0]+'.</font>'
-		#checkin_str = '<br/>Last checked in by '+node_info[1]+' on '+node_info[2]
-		checkin_str = '<br/>Last checkin: ' + node_info[3]
+			checkout_str = '<font color="#FF6E6E">Checked out by '+node_info.lockedBy+'.</font>'
+			if node_info.leaseRemaining is not None:
+				checkout_str += '<br/>Lock expires in %d min unless renewed.' % int((node_info.leaseRemaining + 59) // 60)
+		#checkin_str = '<br/>Last checked in by '+node_info.lastCheckinUser+' on '+node_info.lastCheckinTime
+		checkin_str = '<br/>Last checkin: ' + node_info.latestComment
 		self.asset_info_label.setText(checkout_str+checkin_str)
 		
 def go():
@@ -2,22 +2,24 @@ from PyQt4.QtCore import *
 from PyQt4.QtGui import *
 
 import maya.cmds as cmd
-import maya.OpenMayaUI as omu
-import sip
 import os, glob, shutil
 import utilities as amu
 
 CHECKOUT_WINDOW_WIDTH = 300
 CHECKOUT_WINDOW_HEIGHT = 400
+ARCHIVED_SUFFIX = ' (archived)'
 
 def maya_main_window():
+    import maya.OpenMayaUI as omu
+    import sip
     ptr = omu.MQtUtil.mainWindow()
     return sip.wrapinstance(long(ptr), QObject)
 
 class RollbackDialog(QDialog):
-    ORIGINAL_FILE_NAME = cmd.file(query=True, sceneName=True)
-    def __init__(self, parent=maya_main_window()):
+    def __init__(self, parent=None):
     #def setup(self, parent):
+        if parent is None:
+            parent = maya_main_window()
         self.ORIGINAL_FILE_NAME = cmd.file(query=True, sceneName=True)
         QDialog.__init__(self, parent)
         self.setWindowTitle('Rollback')
@@ -82,13 +84,20 @@ class RollbackDialog(QDialog):
             item = QListWidgetItem(os.path.basename(s)) 
             item.setText(os.path.basename(s))
             self.selection_list.addItem(item)
+        for version in self.archived:
+            self.selection_list.addItem(QListWidgetItem(amu.versionName(version) + ARCHIVED_SUFFIX))
         self.selection_list.sortItems(0)
 
     def refresh(self):
         filePath = os.path.join(amu.getUserCheckoutDir(), os.path.basename(os.path.dirname(self.ORIGINAL_FILE_NAME)))
         checkInDest = amu.getCheckinDest(filePath)
+        # read every version's comment once instead of once per selection
+        self.comments = amu.getVersionComments(checkInDest)
         versionFolders = os.path.join(checkInDest, "src")
         selections = glob.glob(os.path.join(versionFolders, '*'))
+        # versions past the versions to keep are archived; listed unless they were unpacked again
+        present = set(os.path.basename(s) for s in selections)
+        self.archived = [v for v in amu.getArchivedVersions(checkInDest) if amu.versionName(v) not in present]
         self.update_selection(selections)
 
     def get_checkout_mode(self):
@@ -137,9 +146,12 @@ class RollbackDialog(QDialog):
         dialogResult = self.verify_checkout_dialog()
         if(dialogResult == 'Yes'):
             #checkout
-            version = str(self.current_item.text())[1:]
+            version = str(self.current_item.text()).split()[0][1:]
             filePath = os.path.join(amu.getUserCheckoutDir(), os.path.basename(os.path.dirname(self.ORIGINAL_FILE_NAME)))
             toCheckout = amu.getCheckinDest(filePath)
+            if int(version) in self.archived:
+                # unpack it back into src so it can be checked out
+                amu.rehydrateVersion(toCheckout, version)
             
             latestVersion = amu.tempSetVersion(toCheckout, version)
             amu.discard(filePath)
@@ -175,10 +187,8 @@ class RollbackDialog(QDialog):
             self.close_dialog()
 
     def show_version_info(self):
-        asset_version = str(self.current_item.text())
-        filePath = os.path.join(amu.getUserCheckoutDir(), os.path.basename(os.path.dirname(self.ORIGINAL_FILE_NAME)))
-        checkInDest = amu.getCheckinDest(filePath)
-        comment = amu.getVersionComment(checkInDest,asset_version)
+        asset_version = str(self.current_item.text()).split()[0]
+        comment = self.comments.get(asset_version, '')
         self.version_info_label.setText(comment)
             
 def go():
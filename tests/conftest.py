@@ -0,0 +1,67 @@
+"""
+Fixtures of the asset manager tests: a project in a temporary folder.
+Run the tests with python -m pytest from the top of the repository.
+"""
+
+import os, sys, pwd
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'asset_manager'))
+# the tests must not use the workstation's metadata daemon (relic.py and checkin jobs connect to it)
+os.environ['RELIC_DAEMON'] = '0'
+
+@pytest.fixture
+def project(tmpdir, monkeypatch):
+	"""
+	Points PRODUCTION_DIR, USER_DIR and the local caches into tmpdir.
+	@returns: the project's assets folder
+	"""
+	root = str(tmpdir)
+	assetsDir = os.path.join(root, 'production', 'assets')
+	env = {
+		'PRODUCTION_DIR': os.path.join(root, 'production'),
+		'ASSETS_DIR': assetsDir,
+		'USER_DIR': os.path.join(root, 'user'),
+		'USER': pwd.getpwuid(os.getuid()).pw_name,
+		'PROJECT_NAME': 'relic',
+		'JOB': root,
+		'RELIC_INDEX_DB': os.path.join(root, 'index.db'),
+		'RELIC_CACHE_DIR': os.path.join(root, 'cache'),
+		'RELIC_JOB_DIR': os.path.join(root, 'jobs'),
+		'RELIC_REAP_RATE': '0',
+	}
+	for var, value in env.items():
+		monkeypatch.setenv(var, value)
+	for var in ('RELIC_BLOB_DIR', 'RELIC_TRASH_DIR', 'RELIC_TRASH_REGISTRY', 'RELIC_TRASH_DAYS', 'RELIC_LEASE_TTL',
+			'RELIC_LOCK_GRACE', 'RELIC_RECOVER_AFTER', 'RELIC_CHECKOUT_MODE', 'RELIC_CACHE_BYTES', 'RELIC_VERIFY_CHECKOUT',
+			'RELIC_ARCHIVE_KEEP', 'RELIC_ARCHIVE_COMPRESSION', 'RELIC_METADATA_FORMAT'):
+		monkeypatch.delenv(var, raising=False)
+	os.makedirs(assetsDir)
+	os.makedirs(os.path.join(root, 'user', 'checkout'))
+	return assetsDir
+
+@pytest.fixture
+def asset(project):
+	"""@returns: a versioned folder whose first version holds a scene and a texture"""
+	import utilities
+	model = os.path.join(utilities.createNewAssetFolders(project, 'pillar'), 'model')
+	writeFile(os.path.join(model, 'src', 'v000', 'pillar_model.mb'), 'scene 0')
+	writeFile(os.path.join(model, 'src', 'v000', 'tex', 'stone.exr'), 'texture')
+	return model
+
+def writeFile(filePath, data):
+	if not os.path.isdir(os.path.dirname(filePath)):
+		os.makedirs(os.path.dirname(filePath))
+	f = open(filePath, 'wb')
+	try:
+		f.write(data)
+	finally:
+		f.close()
+
+def readFile(filePath):
+	f = open(filePath, 'rb')
+	try:
+		return f.read()
+	finally:
+		f.close()
@@ -0,0 +1,24 @@
+"""Tests that the asset index picks up what other workstations changed (user-003)"""
+
+import utilities
+
+def _names(index, folder):
+	return sorted(entry.name for entry in index.children(folder))
+
+def test_rescan_finds_assets_created_elsewhere(project, monkeypatch):
+	utilities.createNewAssetFolders(project, 'pillar')
+	assert _names(utilities.getAssetIndex(project), project) == ['pillar']
+	# created from another workstation: this one's index is not updated
+	with monkeypatch.context() as patch:
+		patch.setattr(utilities, '_updateIndex', lambda nodeInfo: None)
+		utilities.createNewAssetFolders(project, 'column')
+	assert _names(utilities.getAssetIndex(project), project) == ['pillar']
+	assert _names(utilities.getAssetIndex(project, rescan=True), project) == ['column', 'pillar']
+
+def test_failed_rescan_serves_the_last_scan(project, monkeypatch):
+	utilities.createNewAssetFolders(project, 'pillar')
+	utilities.getAssetIndex(project)
+	def failing(root):
+		raise OSError(5, 'Input/output error')
+	monkeypatch.setattr(utilities, 'rescanProject', failing)
+	assert _names(utilities.getAssetIndex(project, rescan=True), project) == ['pillar']
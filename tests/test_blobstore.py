@@ -0,0 +1,133 @@
+"""Tests of the blob store: deduplication, reference counts and delta checkins (user-012, user-013)"""
+
+import os, time, errno, shutil
+
+import blobstore, fileclone
+from conftest import writeFile, readFile
+
+def _tree(root, files):
+	for relPath, data in files.items():
+		writeFile(os.path.join(root, relPath), data)
+	return root
+
+def test_identical_files_share_one_blob(tmpdir):
+	store = blobstore.BlobStore(str(tmpdir.join('blobs')))
+	src = _tree(str(tmpdir.join('src')), {'a.exr': 'same', 'b/c.exr': 'same', 'd.mb': 'other'})
+	version = str(tmpdir.join('v001'))
+	stats = blobstore.storeTree(src, version, store)
+	assert (stats.files, stats.newFiles) == (3, 2)
+	assert len(store._allDigests()) == 2
+	manifest = blobstore.readManifest(version)
+	digest = manifest['files']['a.exr']['sha256']
+	assert manifest['files']['b/c.exr']['sha256'] == digest
+	# the store's copy and the two links of the version
+	assert os.stat(store.blobPath(digest)).st_nlink == 3
+	assert readFile(os.path.join(version, 'b', 'c.exr')) == 'same'
+
+def test_delta_checkin_hashes_only_changed_files(tmpdir):
+	store = blobstore.BlobStore(str(tmpdir.join('blobs')))
+	src = _tree(str(tmpdir.join('src')), {'scene.mb': 'scene 1', 'tex/a.exr': 'a' * 1000, 'tex/b.exr': 'b' * 1000})
+	v1 = str(tmpdir.join('v001'))
+	blobstore.storeTree(src, v1, store)
+
+	checkout = str(tmpdir.join('checkout'))
+	blobstore.materialize(v1, checkout, 'copy')
+	# a new size, so the change is seen whatever the mtime resolution
+	writeFile(os.path.join(checkout, 'scene.mb'), 'scene 2 changed')
+	v2 = str(tmpdir.join('v002'))
+	stats = blobstore.storeTree(checkout, v2, store, base=v1)
+
+	assert stats.hashedFiles == 1
+	assert [relPath for relPath, written in stats.transferred] == ['scene.mb']
+	m1 = blobstore.readManifest(v1)['files']
+	m2 = blobstore.readManifest(v2)['files']
+	assert m2['tex/a.exr']['sha256'] == m1['tex/a.exr']['sha256']
+	assert m2['scene.mb']['sha256'] == blobstore.hashFile(os.path.join(checkout, 'scene.mb'))
+
+def test_delta_checkin_rehashes_same_size_file_with_new_mtime(tmpdir):
+	store = blobstore.BlobStore(str(tmpdir.join('blobs')))
+	src = _tree(str(tmpdir.join('src')), {'scene.mb': 'aaaa'})
+	v1 = str(tmpdir.join('v001'))
+	blobstore.storeTree(src, v1, store)
+	checkout = str(tmpdir.join('checkout'))
+	blobstore.materialize(v1, checkout, 'copy')
+	writeFile(os.path.join(checkout, 'scene.mb'), 'bbbb')
+	later = time.time() + 10
+	os.utime(os.path.join(checkout, 'scene.mb'), (later, later))
+	v2 = str(tmpdir.join('v002'))
+	stats = blobstore.storeTree(checkout, v2, store, base=v1)
+	assert stats.hashedFiles == 1
+	assert readFile(os.path.join(v2, 'scene.mb')) == 'bbbb'
+
+def test_remove_version_collects_only_unshared_blobs(tmpdir):
+	store = blobstore.BlobStore(str(tmpdir.join('blobs')))
+	src = _tree(str(tmpdir.join('src')), {'shared.exr': 'shared', 'scene.mb': 'one'})
+	v1 = str(tmpdir.join('v001'))
+	blobstore.storeTree(src, v1, store)
+	writeFile(os.path.join(src, 'scene.mb'), 'two')
+	v2 = str(tmpdir.join('v002'))
+	blobstore.storeTree(src, v2, store, base=v1)
+	assert len(store._allDigests()) == 3
+
+	count, freed = blobstore.removeVersion(v1, store)
+	assert (count, freed) == (1, len('one'))
+	assert sorted(store._allDigests()) == sorted(f['sha256'] for f in blobstore.readManifest(v2)['files'].values())
+
+def test_collect_keeps_blobs_linked_by_a_checkout(tmpdir):
+	store = blobstore.BlobStore(str(tmpdir.join('blobs')))
+	src = _tree(str(tmpdir.join('src')), {'tex.exr': 'texture'})
+	v1 = str(tmpdir.join('v001'))
+	blobstore.storeTree(src, v1, store)
+	checkout = str(tmpdir.join('checkout'))
+	blobstore.materialize(v1, checkout, 'hardlink', writable=False)
+
+	assert blobstore.removeVersion(v1, store) == (0, 0)
+	assert store.collect() == (0, 0)
+	os.remove(os.path.join(checkout, 'tex.exr'))
+	assert store.collect() == (1, len('texture'))
+
+def test_writable_checkout_does_not_share_blob_inodes(tmpdir):
+	store = blobstore.BlobStore(str(tmpdir.join('blobs')))
+	src = _tree(str(tmpdir.join('src')), {'tex.exr': 'texture'})
+	v1 = str(tmpdir.join('v001'))
+	blobstore.storeTree(src, v1, store)
+	checkout = str(tmpdir.join('checkout'))
+	blobstore.materialize(v1, checkout, 'hardlink')
+	assert os.stat(os.path.join(checkout, 'tex.exr')).st_nlink == 1
+	writeFile(os.path.join(checkout, 'tex.exr'), 'edited')
+	assert readFile(os.path.join(v1, 'tex.exr')) == 'texture'
+
+def _linkRefused(digest, dest):
+	# fs.protected_hardlinks=1 and the blob stored by another user
+	raise OSError(errno.EPERM, os.strerror(errno.EPERM))
+
+def test_blob_that_can_not_be_linked_is_copied_and_reported(tmpdir, monkeypatch, capsys):
+	store = blobstore.BlobStore(str(tmpdir.join('blobs')))
+	src = _tree(str(tmpdir.join('src')), {'a.exr': 'same', 'b.exr': 'same', 'd.mb': 'other'})
+	v1 = str(tmpdir.join('v001'))
+	blobstore.storeTree(src, v1, store)
+	monkeypatch.setattr(store, 'link', _linkRefused)
+	def reflinkUnsupported(src, dst):
+		raise IOError(errno.EOPNOTSUPP, os.strerror(errno.EOPNOTSUPP))
+	monkeypatch.setattr(fileclone, 'reflinkFile', reflinkUnsupported)
+	v2 = str(tmpdir.join('v002'))
+	stats = blobstore.storeTree(src, v2, store)
+	assert (stats.files, stats.newFiles, stats.unlinkedFiles) == (3, 0, 3)
+	assert 'could not be linked to the store' in capsys.readouterr()[0]
+	assert readFile(os.path.join(v2, 'b.exr')) == 'same'
+	assert os.stat(os.path.join(v2, 'b.exr')).st_nlink == 1
+	assert blobstore.readManifest(v2)['files'] == blobstore.readManifest(v1)['files']
+
+def test_blob_that_can_not_be_linked_is_reflinked_where_possible(tmpdir, monkeypatch):
+	store = blobstore.BlobStore(str(tmpdir.join('blobs')))
+	src = _tree(str(tmpdir.join('src')), {'a.exr': 'same'})
+	monkeypatch.setattr(store, 'link', _linkRefused)
+	reflinked = []
+	def reflinkFile(src, dst):
+		reflinked.append(src)
+		shutil.copy2(src, dst)
+	monkeypatch.setattr(fileclone, 'reflinkFile', reflinkFile)
+	stats = blobstore.storeTree(src, str(tmpdir.join('v001')), store)
+	digest = blobstore.readManifest(str(tmpdir.join('v001')))['files']['a.exr']['sha256']
+	assert reflinked == [store.blobPath(digest)]
+	assert stats.unlinkedFiles == 1
@@ -0,0 +1,100 @@
+"""Tests of checkin and of archiving old versions outside of it (user-017)"""
+
+import os
+
+import pytest
+
+import utilities, archive, blobstore, lockfile, walker
+from nodeinfo import NodeInfo
+from conftest import writeFile, readFile
+
+def _checkinNewVersion(asset, data):
+	checkout = utilities.checkout(asset, True)
+	writeFile(os.path.join(checkout, 'pillar_model.mb'), data)
+	return utilities.checkin(checkout, 'saved ' + data)
+
+def _versions(asset):
+	return [version for version, f in walker.versionFolders(os.path.join(asset, 'src'))]
+
+def test_checkin_does_not_archive(asset, monkeypatch):
+	def failing(dirPath, versionDir):
+		raise IOError(28, 'No space left on device')
+	monkeypatch.setattr(archive, 'archiveVersion', failing)
+	nodeInfo = NodeInfo.load(asset)
+	nodeInfo.versionsToKeep = 1
+	nodeInfo.commit()
+	for i in range(3):
+		_checkinNewVersion(asset, 'scene %d' % (i + 1))
+	assert _versions(asset) == [0, 1, 2, 3]
+	nodeInfo = NodeInfo.load(asset)
+	assert (nodeInfo.latestVersion, nodeInfo.locked) == (3, False)
+	assert not lockfile.isHeld(asset)
+
+def test_purge_versions_archives_and_can_be_rolled_back(asset):
+	for i in range(3):
+		_checkinNewVersion(asset, 'scene %d' % (i + 1))
+	assert utilities.purgeVersions(asset, keep=1) == [0, 1]
+	assert _versions(asset) == [2, 3]
+	assert utilities.getArchivedVersions(asset) == [0, 1]
+
+	checkout = utilities.rollback(asset, 1)
+	assert readFile(os.path.join(checkout, 'pillar_model.mb')) == 'scene 1'
+
+def test_purge_versions_keeps_a_lock_taken_while_archiving(asset, monkeypatch):
+	for i in range(3):
+		_checkinNewVersion(asset, 'scene %d' % (i + 1))
+	archiveVersion = archive.archiveVersion
+	checkouts = []
+	def archiveAndCheckout(dirPath, versionDir):
+		archiveVersion(dirPath, versionDir)
+		if not checkouts:
+			checkouts.append(utilities.checkout(asset, True))
+	monkeypatch.setattr(archive, 'archiveVersion', archiveAndCheckout)
+	monkeypatch.setenv('RELIC_ARCHIVE_KEEP', '1')
+	utilities.purgeVersions(asset, keep=1)
+	assert NodeInfo.load(asset).locked
+	assert utilities.canCheckin(checkouts[0])
+
+def test_failed_publish_keeps_the_folder_locked(asset, monkeypatch):
+	import blobstore
+	checkout = utilities.checkout(asset, True)
+	def failing(*args, **kwargs):
+		raise IOError(28, 'No space left on device')
+	monkeypatch.setattr(blobstore, 'storeTree', failing)
+	with pytest.raises(IOError):
+		utilities.checkin(checkout)
+	assert _versions(asset) == [0]
+	assert NodeInfo.load(asset).locked
+	assert lockfile.isHeld(asset)
+
+def _archiveOldVersions(asset):
+	for i in range(3):
+		_checkinNewVersion(asset, 'scene %d' % (i + 1))
+	utilities.purgeVersions(asset, keep=1)
+
+def test_interrupted_rehydrate_leaves_no_version_folder(asset, monkeypatch):
+	_archiveOldVersions(asset)
+	storeTree = blobstore.storeTree
+	def interrupted(src, versionDir, **kwargs):
+		storeTree(src, versionDir, **kwargs)
+		raise KeyboardInterrupt()
+	with monkeypatch.context() as patch:
+		patch.setattr(blobstore, 'storeTree', interrupted)
+		with pytest.raises(KeyboardInterrupt):
+			archive.rehydrate(asset, 1)
+	assert _versions(asset) == [2, 3]
+	assert sorted(os.listdir(os.path.join(asset, 'src'))) == ['v002', 'v003']
+	versionDir = archive.rehydrate(asset, 1)
+	assert readFile(os.path.join(versionDir, 'pillar_model.mb')) == 'scene 1'
+
+def test_rehydrate_keeps_the_version_rehydrated_meanwhile(asset, monkeypatch):
+	_archiveOldVersions(asset)
+	storeTree = blobstore.storeTree
+	def rehydratedMeanwhile(src, versionDir, **kwargs):
+		storeTree(src, versionDir, **kwargs)
+		storeTree(src, os.path.join(asset, 'src', 'v001'), **kwargs)
+		writeFile(os.path.join(asset, 'src', 'v001', 'theirs'), 'theirs')
+	monkeypatch.setattr(blobstore, 'storeTree', rehydratedMeanwhile)
+	versionDir = archive.rehydrate(asset, 1)
+	assert os.path.exists(os.path.join(versionDir, 'theirs'))
+	assert sorted(os.listdir(os.path.join(asset, 'src'))) == ['v001', 'v002', 'v003']
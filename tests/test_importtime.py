@@ -0,0 +1,37 @@
+"""Tests that the asset manager starts fast: import time budgets and what is imported lazily (user-025)"""
+
+import os, sys, json, subprocess
+
+import importtime
+
+def _importedBy(modules):
+	"""@returns: the names in sys.modules of a fresh interpreter once it imported modules"""
+	code = 'import sys, json\n' + ''.join('import %s\n' % m for m in modules) + 'print json.dumps(sorted(sys.modules))'
+	output = subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(importtime.__file__))
+	return set(json.loads(output))
+
+def test_modules_are_within_their_import_budget():
+	results = importtime.check(runs=3)
+	assert [module for module, ms, budget in results] == [module for module, budget in importtime.BUDGETS]
+	measured = [(module, ms, budget) for module, ms, budget in results if not isinstance(ms, str)]
+	assert measured
+	assert [(module, ms, budget) for module, ms, budget in measured if ms > budget] == []
+
+def test_command_line_does_not_import_heavy_modules():
+	imported = _importedBy(['relic', 'utilities'])
+	heavy = ['PyQt4', 'sqlite3', 'tarfile', 'zlib', 'bz2',
+		'assetindex', 'scanner', 'blobstore', 'versioncache', 'journal', 'trash', 'archive', 'fileclone']
+	if 'scandir' not in imported:
+		# the scandir backport, where os.scandir is missing, loads ctypes itself
+		heavy.append('ctypes')
+	assert sorted(imported.intersection(heavy)) == []
+
+def test_relic_imports_utilities_only_once_it_runs():
+	imported = _importedBy(['relic'])
+	assert 'utilities' not in imported
+	assert 'PyQt4' not in imported
+
+def test_importing_utilities_does_not_connect_to_the_daemon():
+	code = 'import os\nos.environ["RELIC_DAEMON"] = "1"\nimport sys, utilities, nodeinfo\nprint nodeinfo._remote is None, "metadaemon" in sys.modules'
+	output = subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(importtime.__file__))
+	assert output.split() == ['True', 'False']
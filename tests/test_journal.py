@@ -0,0 +1,127 @@
+"""Tests of the checkin intent journal: recovery at each step, and when an intent is stale (user-018)"""
+
+import os, socket, subprocess, sys, time
+
+import pytest
+
+import utilities, journal, blobstore, lockfile
+from nodeinfo import NodeInfo
+from conftest import writeFile, readFile
+
+class Crash(BaseException):
+	"""The process dying: not caught by the except Exception clauses of checkin"""
+
+def _checkout(asset, data='scene 1'):
+	checkout = utilities.checkout(asset, True)
+	writeFile(os.path.join(checkout, 'pillar_model.mb'), data)
+	return checkout
+
+def _crashIn(patch, module, name, after=False):
+	function = getattr(module, name)
+	def crashing(*args, **kwargs):
+		if after:
+			function(*args, **kwargs)
+		raise Crash()
+	patch.setattr(module, name, crashing)
+
+def test_crash_while_staging_rolls_back(asset, monkeypatch):
+	checkout = _checkout(asset)
+	with monkeypatch.context() as patch:
+		_crashIn(patch, blobstore, 'storeTree', after=True)
+		with pytest.raises(Crash):
+			utilities.checkin(checkout)
+	intent = journal.read(asset)
+	assert intent['step'] == journal.STAGE and os.path.isdir(intent['staging'])
+
+	assert journal.recover(asset) == 'rolled back the checkin of v001'
+	assert not os.path.exists(intent['staging'])
+	assert sorted(os.listdir(os.path.join(asset, 'src'))) == ['v000']
+	# locked by and checked out to the artist, as before the checkin
+	assert NodeInfo.load(asset).locked and lockfile.isHeld(asset)
+	assert readFile(os.path.join(checkout, 'pillar_model.mb')) == 'scene 1'
+	utilities.checkin(checkout)
+	assert NodeInfo.load(asset).latestVersion == 1
+
+def test_crash_after_the_rename_rolls_forward(asset, monkeypatch):
+	checkout = _checkout(asset)
+	advance = journal.advance
+	def crashBeforePublished(dirPath, intent, step):
+		if step == journal.PUBLISHED:
+			raise Crash()
+		advance(dirPath, intent, step)
+	with monkeypatch.context() as patch:
+		patch.setattr(journal, 'advance', crashBeforePublished)
+		with pytest.raises(Crash):
+			utilities.checkin(checkout, 'renamed')
+	assert journal.read(asset)['step'] == journal.STAGE
+
+	assert journal.recover(asset) == 'finished the checkin of v001'
+	nodeInfo = NodeInfo.load(asset)
+	assert (nodeInfo.latestVersion, nodeInfo.locked) == (1, False)
+	assert not lockfile.isHeld(asset)
+	assert not os.path.exists(checkout)
+	assert utilities.getVersionComment(asset, 1).endswith('"renamed"')
+	assert journal.read(asset) is None
+
+def test_crash_after_publishing_rolls_forward(asset, monkeypatch):
+	checkout = _checkout(asset, 'published')
+	with monkeypatch.context() as patch:
+		_crashIn(patch, utilities, '_commitCheckin')
+		with pytest.raises(Crash):
+			utilities.checkin(checkout)
+	assert journal.read(asset)['step'] == journal.PUBLISHED
+
+	assert journal.recover(asset) == 'finished the checkin of v001'
+	assert NodeInfo.load(asset).latestVersion == 1
+	assert readFile(os.path.join(asset, 'src', 'v001', 'pillar_model.mb')) == 'published'
+
+def test_failed_commit_is_finished_by_the_next_checkin_of_the_same_process(asset, monkeypatch):
+	checkout = _checkout(asset)
+	def failing(*args):
+		raise IOError(13, 'Permission denied')
+	with monkeypatch.context() as patch:
+		patch.setattr(utilities, '_commitCheckin', failing)
+		with pytest.raises(IOError):
+			utilities.checkin(checkout)
+
+	# the intent has this process's pid, but the process is not running it any more
+	assert journal.isStale(journal.read(asset))
+	utilities.checkin(checkout)
+	assert NodeInfo.load(asset).latestVersion == 1
+	assert journal.read(asset) is None
+
+def test_running_checkin_is_not_stale(asset, monkeypatch):
+	checkout = _checkout(asset)
+	storeTree = blobstore.storeTree
+	seen = []
+	def checking(*args, **kwargs):
+		seen.append(journal.isStale(journal.read(asset)))
+		return storeTree(*args, **kwargs)
+	monkeypatch.setattr(blobstore, 'storeTree', checking)
+	utilities.checkin(checkout)
+	assert seen == [False]
+
+def _intent(pid, pidStart, started=None):
+	return {'host': socket.gethostname(), 'pid': pid, 'pidStart': pidStart,
+		'started': time.time() if started is None else started}
+
+def test_intent_of_a_live_process_is_not_stale():
+	process = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'])
+	try:
+		assert not journal.isStale(_intent(process.pid, journal._processStart(process.pid), started=0))
+		# the pid was reused by another process since the intent was recorded
+		assert journal.isStale(_intent(process.pid, journal._processStart(process.pid) - 1))
+	finally:
+		process.kill()
+		process.wait()
+	assert journal.isStale(_intent(process.pid, None))
+
+def test_intent_with_this_pid_from_an_earlier_process_is_stale():
+	assert journal.isStale(_intent(os.getpid(), journal._processStart(os.getpid()) - 1))
+
+def test_intent_of_another_host_is_stale_after_a_while(monkeypatch):
+	intent = {'host': 'elsewhere', 'pid': 1, 'pidStart': None, 'started': time.time()}
+	assert not journal.isStale(intent)
+	monkeypatch.setenv('RELIC_RECOVER_AFTER', '0')
+	time.sleep(0.01)
+	assert journal.isStale(intent)
@@ -0,0 +1,179 @@
+"""Tests of the leases on checkout locks: expiry, renewal and the heartbeat (user-022)"""
+
+import os, json, time, threading
+
+import utilities, lockfile
+from nodeinfo import NodeInfo
+from conftest import writeFile
+
+def _setExpiry(dirPath, expires):
+	lockPath = os.path.join(dirPath, lockfile.LOCK_FILE)
+	record = lockfile.owner(dirPath)
+	record['expires'] = expires
+	f = open(lockPath, 'wb')
+	f.write(json.dumps(record))
+	f.close()
+	return record
+
+def _expire(dirPath):
+	"""Moves the lease on dirPath into the past, as if it had not been renewed in time"""
+	return _setExpiry(dirPath, time.time() - 1)
+
+def test_lease_expires_after_the_lease_time(tmpdir, monkeypatch):
+	dirPath = str(tmpdir)
+	monkeypatch.setenv('RELIC_LEASE_TTL', '0.5')
+	token = lockfile.acquire(dirPath, 'anna')
+	held = lockfile.owner(dirPath)
+	assert 0 < lockfile.remaining(held) <= 0.5
+	assert not lockfile.isStale(dirPath, held)
+	time.sleep(0.6)
+	assert lockfile.remaining(held) == 0
+	assert lockfile.isStale(dirPath, held)
+	assert lockfile.acquire(dirPath, 'ben') is not None
+	# taken by somebody else: the first holder can not renew it any more
+	assert lockfile.renew(dirPath, 'anna', token) is None
+	assert lockfile.owner(dirPath)['user'] == 'ben'
+
+def test_renew_extends_the_lease_of_the_holder_only(tmpdir, monkeypatch):
+	dirPath = str(tmpdir)
+	monkeypatch.setenv('RELIC_LEASE_TTL', '60')
+	token = lockfile.acquire(dirPath, 'anna')
+	_setExpiry(dirPath, time.time() + 5)
+	assert lockfile.renew(dirPath, 'ben') is None
+	assert lockfile.renew(dirPath, 'anna', 'not the grant') is None
+	expires = lockfile.renew(dirPath, 'anna', token)
+	assert expires > time.time() + 50
+	held = lockfile.owner(dirPath)
+	assert (held['expires'], held['token']) == (expires, token)
+	assert lockfile.acquire(dirPath, 'ben') is None
+
+def test_expired_lease_is_not_renewed(tmpdir):
+	dirPath = str(tmpdir)
+	token = lockfile.acquire(dirPath, 'anna')
+	_expire(dirPath)
+	# even if nobody took it yet: a breaker may have read it already
+	assert lockfile.renew(dirPath, 'anna', token) is None
+	assert lockfile.acquire(dirPath, 'ben') is not None
+
+def test_break_does_not_remove_a_lease_renewed_since(tmpdir):
+	dirPath = str(tmpdir)
+	token = lockfile.acquire(dirPath, 'anna')
+	# the breaker reads the lease about to expire, then the owner renews it, with the same token
+	stale = _setExpiry(dirPath, time.time() - 1)
+	_setExpiry(dirPath, time.time() + 60)
+	assert not lockfile._breakStale(dirPath, stale)
+	assert lockfile.owner(dirPath)['token'] == token
+	assert lockfile.acquire(dirPath, 'ben') is None
+
+def test_renew_waits_for_a_breaker(tmpdir):
+	dirPath = str(tmpdir)
+	token = lockfile.acquire(dirPath, 'anna')
+	breakPath = lockfile._takeBreak(dirPath)
+	assert lockfile._takeBreak(dirPath) is None
+	assert lockfile.renew(dirPath, 'anna', token, wait=0.1) is None
+	timer = threading.Timer(0.2, os.remove, [breakPath])
+	timer.start()
+	assert lockfile.renew(dirPath, 'anna', token) is not None
+	timer.join()
+	assert not os.path.exists(breakPath)
+
+def test_renew_and_break_never_grant_the_lock_twice(tmpdir):
+	dirPath = str(tmpdir)
+	for i in range(20):
+		token = lockfile.acquire(dirPath, 'anna')
+		# expires while the owner renews it and ben breaks it
+		expires = _setExpiry(dirPath, time.time() + 0.01)['expires']
+		start = threading.Event()
+		results = {}
+		def renew():
+			start.wait()
+			results['renewed'] = lockfile.renew(dirPath, 'anna', token)
+		def acquire():
+			start.wait()
+			while time.time() < expires:
+				pass
+			results['acquired'] = lockfile.acquire(dirPath, 'ben')
+		threads = [threading.Thread(target=renew), threading.Thread(target=acquire)]
+		for thread in threads:
+			thread.start()
+		start.set()
+		for thread in threads:
+			thread.join()
+		# neither may win, if each finds the other changing the lock; never both
+		assert results['renewed'] is None or results['acquired'] is None
+		held = lockfile.owner(dirPath)
+		if results['renewed'] is not None:
+			assert held['token'] == token
+		if results['acquired'] is not None:
+			assert held['token'] == results['acquired']
+		lockfile.release(dirPath)
+
+def test_leases_never_expire_with_a_lease_time_of_0(tmpdir, monkeypatch):
+	dirPath = str(tmpdir)
+	monkeypatch.setenv('RELIC_LEASE_TTL', '0')
+	token = lockfile.acquire(dirPath, 'anna')
+	held = lockfile.owner(dirPath)
+	assert held['expires'] is None
+	assert lockfile.remaining(held) is None
+	assert lockfile.renew(dirPath, 'anna', token) == float('inf')
+
+def test_an_expired_lease_no_longer_locks_the_asset(asset, monkeypatch):
+	checkout = utilities.checkout(asset, True)
+	assert 0 < utilities.isLocked(asset) <= lockfile.getLeaseTime()
+	assert utilities.isCheckedOut(asset)
+	with monkeypatch.context() as patch:
+		patch.setenv('USER', 'ben')
+		assert not utilities.canCheckout(asset)
+	assert utilities.canCheckin(checkout)
+
+	_expire(asset)
+	assert utilities.isLocked(asset) is False
+	with monkeypatch.context() as patch:
+		patch.setenv('USER', 'ben')
+		patch.setenv('USER_DIR', os.path.join(os.environ['USER_DIR'], 'ben'))
+		os.makedirs(utilities.getUserCheckoutDir())
+		assert utilities.canCheckout(asset)
+		utilities.checkout(asset, True)
+		assert NodeInfo.load(asset).lastCheckoutUser == 'ben'
+	# the lease was lost to ben: our checkout can not be checked in over his
+	assert not utilities.canCheckin(checkout)
+	assert utilities.renewLeases() == []
+
+def test_renew_leases_renews_the_checkouts_of_the_user(asset):
+	checkout = utilities.checkout(asset, True)
+	writeFile(os.path.join(checkout, 'pillar_model.mb'), 'scene 1')
+	_setExpiry(asset, time.time() + 5)
+	assert utilities.renewLeases() == [asset]
+	assert utilities.isLocked(asset) > lockfile.getLeaseTime() - 60
+	assert utilities.canCheckin(checkout)
+
+def test_heartbeat_renews_until_stopped():
+	calls = []
+	renewed = threading.Event()
+	def renewAll():
+		calls.append(time.time())
+		if len(calls) == 2:
+			renewed.set()
+	heartbeat = lockfile.LeaseHeartbeat(renewAll, interval=0.05)
+	heartbeat.start()
+	assert renewed.wait(5)
+	heartbeat.stop()
+	heartbeat.join(5)
+	assert not heartbeat.is_alive()
+	stoppedAt = len(calls)
+	time.sleep(0.2)
+	assert len(calls) == stoppedAt
+
+def test_heartbeat_survives_a_failing_renewal():
+	calls = []
+	renewed = threading.Event()
+	def renewAll():
+		calls.append(None)
+		if len(calls) == 1:
+			raise IOError(5, 'Input/output error')
+		renewed.set()
+	heartbeat = lockfile.LeaseHeartbeat(renewAll, interval=0.05)
+	heartbeat.start()
+	assert renewed.wait(5)
+	heartbeat.stop()
+	heartbeat.join(5)
@@ -0,0 +1,136 @@
+"""Tests of the checkout lock: atomic acquisition and breaking stale locks (user-021)"""
+
+import os, json, time, threading, multiprocessing
+
+import lockfile
+from nodeinfo import NodeInfo
+
+def _folder(tmpdir, locked=False):
+	dirPath = str(tmpdir.join('model'))
+	os.makedirs(dirPath)
+	nodeInfo = NodeInfo(dirPath)
+	nodeInfo.locked = locked
+	nodeInfo.commit()
+	return dirPath
+
+def _setRecord(dirPath, **fields):
+	record = lockfile.owner(dirPath)
+	record.update(fields)
+	f = open(os.path.join(dirPath, lockfile.LOCK_FILE), 'wb')
+	f.write(json.dumps(record))
+	f.close()
+
+def _race(acquire, count):
+	"""Runs acquire() on count threads started together; @returns: their results"""
+	start = threading.Event()
+	results = []
+	def run():
+		start.wait()
+		results.append(acquire())
+	threads = [threading.Thread(target=run) for i in range(count)]
+	for thread in threads:
+		thread.start()
+	start.set()
+	for thread in threads:
+		thread.join()
+	return results
+
+def test_only_one_acquire_wins(tmpdir):
+	dirPath = _folder(tmpdir)
+	token = lockfile.acquire(dirPath, 'anna')
+	assert token is not None
+	assert lockfile.acquire(dirPath, 'anna') is None
+	assert lockfile.acquire(dirPath, 'ben') is None
+	held = lockfile.owner(dirPath)
+	assert (held['user'], held['token'], held['pid']) == ('anna', token, os.getpid())
+
+def test_racing_threads_get_one_grant(tmpdir):
+	dirPath = _folder(tmpdir)
+	results = _race(lambda: lockfile.acquire(dirPath, 'anna'), 16)
+	assert len([token for token in results if token is not None]) == 1
+
+def _acquireAt(dirPath, user, when, queue):
+	while time.time() < when:
+		pass
+	queue.put(lockfile.acquire(dirPath, user))
+
+def test_racing_processes_get_one_grant(tmpdir):
+	dirPath = _folder(tmpdir)
+	queue = multiprocessing.Queue()
+	when = time.time() + 0.5
+	processes = [multiprocessing.Process(target=_acquireAt, args=(dirPath, 'user%d' % i, when, queue)) for i in range(8)]
+	for process in processes:
+		process.start()
+	results = [queue.get(timeout=10) for process in processes]
+	for process in processes:
+		process.join()
+	granted = [token for token in results if token is not None]
+	assert len(granted) == 1
+	assert lockfile.owner(dirPath)['token'] == granted[0]
+
+def test_release_checks_the_holder(tmpdir):
+	dirPath = _folder(tmpdir)
+	token = lockfile.acquire(dirPath, 'anna')
+	lockfile.release(dirPath, user='ben')
+	lockfile.release(dirPath, token='not the grant')
+	assert lockfile.isHeld(dirPath)
+	lockfile.release(dirPath, token=token)
+	assert lockfile.owner(dirPath) is None
+
+def test_lock_left_by_older_tools_is_broken_after_the_grace(tmpdir, monkeypatch):
+	dirPath = _folder(tmpdir)
+	lockfile.acquire(dirPath, 'anna')
+	# no lease, and .nodeInfo is not marked locked: released by older tools, or a checkout that died
+	_setRecord(dirPath, expires=None)
+	assert not lockfile.isStale(dirPath, lockfile.owner(dirPath))
+	assert lockfile.acquire(dirPath, 'ben') is None
+	_setRecord(dirPath, time=time.time() - 3600)
+	assert lockfile.isStale(dirPath, lockfile.owner(dirPath))
+	assert lockfile.acquire(dirPath, 'ben') is not None
+	assert lockfile.owner(dirPath)['user'] == 'ben'
+
+def test_old_lock_of_a_folder_marked_locked_is_kept(tmpdir):
+	dirPath = _folder(tmpdir, locked=True)
+	lockfile.acquire(dirPath, 'anna')
+	_setRecord(dirPath, expires=None, time=time.time() - 3600)
+	assert not lockfile.isStale(dirPath, lockfile.owner(dirPath))
+	assert lockfile.acquire(dirPath, 'ben') is None
+
+def test_unwritten_lock_file_is_held(tmpdir):
+	dirPath = _folder(tmpdir)
+	open(os.path.join(dirPath, lockfile.LOCK_FILE), 'wb').close()
+	assert lockfile.isHeld(dirPath)
+	assert lockfile.acquire(dirPath, 'anna') is None
+
+def test_racing_breakers_get_one_grant(tmpdir):
+	dirPath = _folder(tmpdir)
+	lockfile.acquire(dirPath, 'anna')
+	_setRecord(dirPath, expires=time.time() - 1)
+	results = _race(lambda: lockfile.acquire(dirPath, 'ben'), 16)
+	granted = [token for token in results if token is not None]
+	assert len(granted) == 1
+	assert lockfile.owner(dirPath)['token'] == granted[0]
+	assert not os.path.exists(os.path.join(dirPath, lockfile.LOCK_FILE + '.break'))
+
+def test_break_does_not_remove_a_lock_granted_since(tmpdir):
+	dirPath = _folder(tmpdir)
+	lockfile.acquire(dirPath, 'anna')
+	_setRecord(dirPath, expires=time.time() - 1)
+	stale = lockfile.owner(dirPath)
+	# broken and granted again by another client after this one read the stale record
+	os.remove(os.path.join(dirPath, lockfile.LOCK_FILE))
+	token = lockfile.acquire(dirPath, 'ben')
+	assert not lockfile._breakStale(dirPath, stale)
+	assert lockfile.owner(dirPath)['token'] == token
+
+def test_break_file_of_a_dead_breaker_goes_after_the_grace(tmpdir):
+	dirPath = _folder(tmpdir)
+	lockfile.acquire(dirPath, 'anna')
+	_setRecord(dirPath, expires=time.time() - 1)
+	breakPath = os.path.join(dirPath, lockfile.LOCK_FILE + '.break')
+	open(breakPath, 'wb').close()
+	assert lockfile.acquire(dirPath, 'ben') is None
+	os.utime(breakPath, (time.time() - 3600, time.time() - 3600))
+	# the first attempt removes the break file, the next one breaks the lock
+	assert lockfile.acquire(dirPath, 'ben') is None
+	assert lockfile.acquire(dirPath, 'ben') is not None
@@ -0,0 +1,146 @@
+"""Tests of the metadata daemon client: conditional writes, falling back to direct writes, and only trusting our own daemon (user-023)"""
+
+import os, json, socket, threading
+
+import pytest
+
+import nodeinfo, metadaemon
+from nodeinfo import NodeInfo
+
+@pytest.fixture
+def daemon(tmpdir):
+	server = metadaemon.MetadataDaemon(str(tmpdir.join('meta.sock')))
+	thread = threading.Thread(target=server.serve_forever)
+	thread.start()
+	yield server
+	server.shutdown()
+	thread.join()
+	server.server_close()
+
+@pytest.fixture
+def silentDaemon(tmpdir):
+	"""A daemon that reads requests and never answers them"""
+	socketPath = str(tmpdir.join('silent.sock'))
+	listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	listener.bind(socketPath)
+	listener.listen(1)
+	requests = []
+	def serve():
+		conn, address = listener.accept()
+		requests.append(conn.makefile('rb').readline())
+		stop.wait()
+		conn.close()
+	stop = threading.Event()
+	thread = threading.Thread(target=serve)
+	thread.start()
+	yield socketPath, requests
+	stop.set()
+	thread.join()
+	listener.close()
+
+def _useRemote(monkeypatch, client):
+	monkeypatch.setattr(nodeinfo, '_remote', client)
+
+def test_reads_and_writes_go_through_the_daemon(daemon, tmpdir, monkeypatch):
+	client = metadaemon.Client(daemon.socketPath)
+	_useRemote(monkeypatch, client)
+	filePath = str(tmpdir.join(nodeinfo.NODE_INFO))
+	nodeinfo.writeDocument(filePath, {'latestVersion': 3})
+	assert daemon.writes == 1
+	assert json.load(open(filePath)) == {'latestVersion': 3}
+	assert nodeinfo.readDocument(filePath) == {'latestVersion': 3}
+	assert client.isAvailable()
+
+def test_write_is_made_directly_without_a_daemon(tmpdir, monkeypatch):
+	client = metadaemon.Client(str(tmpdir.join('missing.sock')))
+	_useRemote(monkeypatch, client)
+	filePath = str(tmpdir.join(nodeinfo.NODE_INFO))
+	nodeinfo.writeDocument(filePath, {'latestVersion': 3})
+	assert json.load(open(filePath)) == {'latestVersion': 3}
+	assert not client.isAvailable()
+
+def test_unconfirmed_write_is_not_made_directly(silentDaemon, tmpdir, monkeypatch):
+	socketPath, requests = silentDaemon
+	monkeypatch.setenv('RELIC_DAEMON_TIMEOUT', '0.2')
+	_useRemote(monkeypatch, metadaemon.Client(socketPath))
+	filePath = str(tmpdir.join(nodeinfo.NODE_INFO))
+	# the daemon may still write it after we gave up: writing it too could overwrite newer data later
+	with pytest.raises(nodeinfo.UnconfirmedWrite):
+		nodeinfo.writeDocument(filePath, {'latestVersion': 3})
+	assert json.loads(requests[0])['op'] == 'write'
+	assert not os.path.exists(filePath)
+
+def test_daemon_of_another_user_is_not_used(daemon, tmpdir, monkeypatch):
+	monkeypatch.setattr(metadaemon, '_peerUid', lambda s, socketPath: os.getuid() + 1)
+	client = metadaemon.Client(daemon.socketPath)
+	_useRemote(monkeypatch, client)
+	assert not client.isAvailable()
+	filePath = str(tmpdir.join(nodeinfo.NODE_INFO))
+	nodeinfo.writeDocument(filePath, {'latestVersion': 3})
+	assert daemon.writes == 0
+	assert json.load(open(filePath)) == {'latestVersion': 3}
+
+def test_peer_is_the_daemon_process(daemon):
+	s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	s.connect(daemon.socketPath)
+	try:
+		assert metadaemon._peerUid(s, daemon.socketPath) == os.getuid()
+	finally:
+		s.close()
+
+def _newNode(tmpdir):
+	dirPath = str(tmpdir.join('model'))
+	os.makedirs(dirPath)
+	NodeInfo(dirPath).commit()
+	return dirPath
+
+def test_commit_of_a_changed_node_conflicts(daemon, tmpdir, monkeypatch):
+	_useRemote(monkeypatch, metadaemon.Client(daemon.socketPath))
+	dirPath = _newNode(tmpdir)
+	first = NodeInfo.load(dirPath)
+	second = NodeInfo.load(dirPath)
+	first.latestVersion = 1
+	first.commit()
+	second.versionsToKeep = 5
+	with pytest.raises(nodeinfo.WriteConflict):
+		second.commit()
+	assert daemon.conflicts == 1
+	nodeInfo = NodeInfo.load(dirPath)
+	assert (nodeInfo.latestVersion, nodeInfo.versionsToKeep) == (1, 0)
+	# committed again from what it wrote
+	nodeInfo.versionsToKeep = 5
+	nodeInfo.commit()
+	nodeInfo.latestVersion = 2
+	nodeInfo.commit()
+	assert (NodeInfo.load(dirPath).latestVersion, NodeInfo.load(dirPath).versionsToKeep) == (2, 5)
+
+def test_sessions_do_not_lose_each_others_changes(daemon, tmpdir, monkeypatch):
+	_useRemote(monkeypatch, metadaemon.Client(daemon.socketPath))
+	dirPath = _newNode(tmpdir)
+	def session():
+		for i in range(10):
+			while True:
+				nodeInfo = NodeInfo.load(dirPath)
+				nodeInfo.latestVersion += 1
+				try:
+					nodeInfo.commit()
+					break
+				except nodeinfo.WriteConflict:
+					pass
+	threads = [threading.Thread(target=session) for i in range(4)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	assert NodeInfo.load(dirPath).latestVersion == 40
+
+def test_commit_without_the_daemon_sees_changes(tmpdir):
+	dirPath = _newNode(tmpdir)
+	nodeInfo = NodeInfo.load(dirPath)
+	other = NodeInfo.load(dirPath)
+	other.locked = True
+	other.commit()
+	nodeInfo.latestVersion = 1
+	with pytest.raises(nodeinfo.WriteConflict):
+		nodeInfo.commit()
+	assert NodeInfo.load(dirPath).locked
@@ -0,0 +1,48 @@
+"""Tests of renaming and removing project folders from the asset manager (user-025)"""
+
+import os
+
+import pytest
+
+import utilities, trash
+
+def _names(folder):
+	return sorted(entry.name for entry in utilities.getAssetIndex().children(folder))
+
+def test_folder_with_a_checkout_can_not_be_moved(asset, project):
+	pillar = os.path.dirname(asset)
+	utilities.getAssetIndex(project)
+	assert utilities.canRemove(pillar) and utilities.canRename(pillar) and utilities.canRemove(asset)
+	assert not utilities.canRemove(os.environ['PRODUCTION_DIR'])
+	utilities.checkout(asset, True)
+	assert not utilities.canRemove(pillar)
+	assert not utilities.canRename(asset)
+	with pytest.raises(Exception):
+		utilities.removeFolder(pillar)
+	with pytest.raises(Exception):
+		utilities.renameFolder(asset, 'rig')
+	assert os.path.isdir(asset)
+
+def test_remove_folder_moves_it_to_the_trash(asset, project):
+	pillar = os.path.dirname(asset)
+	utilities.getAssetIndex(project)
+	assert not utilities.isEmptyFolder(pillar)
+	utilities.removeFolder(pillar)
+	assert not os.path.exists(pillar)
+	assert _names(project) == []
+	assert [entry for entry in trash.listTrash() if entry.originalPath == pillar]
+
+def test_rename_folder_updates_the_index(asset, project):
+	pillar = os.path.dirname(asset)
+	utilities.getAssetIndex(project)
+	utilities.createNewAssetFolders(project, 'column')
+	with pytest.raises(Exception):
+		utilities.renameFolder(pillar, 'column')
+	with pytest.raises(Exception):
+		utilities.renameFolder(pillar, '../column')
+	arch = utilities.renameFolder(pillar, 'arch')
+	assert arch == os.path.join(project, 'arch')
+	assert _names(project) == ['arch', 'column']
+	entry = utilities.getAssetIndex().get(os.path.join(arch, 'model'))
+	assert entry.versioned and entry.latestVersion == 0
+	utilities.checkout(os.path.join(arch, 'model'), False)
@@ -0,0 +1,65 @@
+"""Tests of the trash: trash folders outside the project and reaping (user-016)"""
+
+import os
+
+import blobstore, trash
+from conftest import writeFile
+
+def _version(project, name, files):
+	src = os.path.join(os.path.dirname(project), 'incoming-' + name)
+	for relPath, data in files.items():
+		writeFile(os.path.join(src, relPath), data)
+	versionDir = os.path.join(project, 'pillar', 'src', name)
+	blobstore.storeTree(src, versionDir)
+	return versionDir
+
+def test_trash_at_the_top_of_another_volume_is_listed_and_reaped(project, tmpdir, monkeypatch):
+	volume = str(tmpdir.join('volume'))
+	doomed = os.path.join(volume, 'renders')
+	writeFile(os.path.join(doomed, 'frame.exr'), 'frame')
+	# as if neither PRODUCTION_DIR nor USER_DIR were on the folder's volume
+	monkeypatch.setattr(trash, '_candidateDirs', lambda: [])
+	monkeypatch.setattr(trash, '_mountPoint', lambda path: volume)
+
+	name = trash.moveToTrash(doomed)
+	assert trash.registeredDirs() == [os.path.join(volume, trash.TRASH_DIR)]
+	assert [entry.name for entry in trash.listTrash()] == [name]
+	# registered once, however often it is used
+	writeFile(os.path.join(doomed, 'frame.exr'), 'frame')
+	trash.moveToTrash(doomed)
+	assert len(trash.registeredDirs()) == 1
+
+	assert trash.reap(0) == 2
+	assert os.listdir(os.path.join(volume, trash.TRASH_DIR)) == []
+
+def test_reap_collects_blobs_of_trashed_versions(project):
+	store = blobstore.BlobStore()
+	v1 = _version(project, 'v001', {'scene.mb': 'one', 'tex.exr': 'shared'})
+	_version(project, 'v002', {'scene.mb': 'two', 'tex.exr': 'shared'})
+	trash.moveToTrash(v1)
+	assert len(store._allDigests()) == 3
+	assert trash.reap(0) == 1
+	assert len(store._allDigests()) == 2
+
+def test_reap_collects_blobs_released_by_a_checkout_without_manifest(project):
+	store = blobstore.BlobStore()
+	v1 = _version(project, 'v001', {'tex.exr': 'texture'})
+	checkout = os.path.join(os.environ['USER_DIR'], 'checkout', 'pillar')
+	blobstore.materialize(v1, checkout, 'hardlink', writable=False)
+
+	trash.moveToTrash(v1)
+	assert trash.reap(0) == 1
+	# still linked by the checkout
+	assert len(store._allDigests()) == 1
+
+	trash.moveToTrash(checkout)
+	assert trash.reap(0) == 1
+	assert store._allDigests() == []
+
+def test_restore_puts_the_folder_back(project):
+	v1 = _version(project, 'v001', {'scene.mb': 'one'})
+	name = trash.moveToTrash(v1)
+	assert not os.path.exists(v1)
+	assert trash.restore(trash.findEntry(name)) == v1
+	assert os.path.exists(os.path.join(v1, 'scene.mb'))
+	assert trash.listTrash() == []
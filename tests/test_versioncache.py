@@ -0,0 +1,57 @@
+"""Tests of the workstation's version cache, and that it is only used from a folder of the user (user-020)"""
+
+import os, stat
+
+import utilities, versioncache
+from conftest import writeFile, readFile
+
+def _checkinNewVersion(asset, data):
+	checkout = utilities.checkout(asset, True)
+	writeFile(os.path.join(checkout, 'pillar_model.mb'), data)
+	return utilities.checkin(checkout, 'saved ' + data)
+
+def test_checkout_is_cached(asset):
+	_checkinNewVersion(asset, 'scene 1')
+	assert versioncache.lookup(asset, 1) is None
+	checkout = utilities.checkout(asset, False)
+	entryDir = versioncache.lookup(asset, 1)
+	assert entryDir is not None
+	assert stat.S_IMODE(os.stat(versioncache.getCacheDir()).st_mode) == 0700
+	assert readFile(os.path.join(entryDir, 'pillar_model.mb')) == 'scene 1'
+	assert readFile(os.path.join(checkout, 'pillar_model.mb')) == 'scene 1'
+
+def _plant(asset, version):
+	"""Creates the cache entry of version of asset with altered files, as another user could"""
+	versionDir = os.path.join(asset, 'src', utilities.versionName(version))
+	entryDir = os.path.join(versioncache.getCacheDir(), versioncache.entryName(asset, version, versioncache._manifestHash(versionDir)))
+	writeFile(os.path.join(entryDir, 'pillar_model.mb'), 'planted')
+	return entryDir
+
+def test_cache_others_can_write_to_is_not_used(asset):
+	_checkinNewVersion(asset, 'scene 1')
+	os.makedirs(versioncache.getCacheDir())
+	os.chmod(versioncache.getCacheDir(), 0777)
+	_plant(asset, 1)
+	assert versioncache.lookup(asset, 1) is None
+	assert versioncache.fetch(asset, 1) is None
+	assert versioncache.entries() == []
+	checkout = utilities.checkout(asset, False)
+	assert readFile(os.path.join(checkout, 'pillar_model.mb')) == 'scene 1'
+
+def test_cache_of_another_user_is_not_used(asset, monkeypatch):
+	_checkinNewVersion(asset, 'scene 1')
+	os.makedirs(versioncache.getCacheDir(), 0700)
+	_plant(asset, 1)
+	uid = os.getuid()
+	with monkeypatch.context() as patch:
+		patch.setattr(os, 'getuid', lambda: uid + 1)
+		assert versioncache.lookup(asset, 1) is None
+		assert versioncache.fetch(asset, 1) is None
+
+def test_linked_cache_folder_is_not_used(asset, tmpdir):
+	_checkinNewVersion(asset, 'scene 1')
+	target = str(tmpdir.join('elsewhere'))
+	os.makedirs(target, 0700)
+	os.symlink(target, versioncache.getCacheDir())
+	assert versioncache.fetch(asset, 1) is None
+	assert os.listdir(target) == []